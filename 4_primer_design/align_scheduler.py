@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import argparse
+import math
+import os
+import subprocess
+import time
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+def fasta_size(fasta_file):
+    '''Number of sequences and mean sequence length of a FASTA file.'''
+    n_sequences = 0
+    total_length = 0
+    with open(fasta_file, 'r') as f:
+        for line in f:
+            if line.startswith('>'):
+                n_sequences += 1
+            else:
+                total_length += len(line.strip())
+    return n_sequences, (total_length / n_sequences if n_sequences else 0.0)
+
+def job_threads(costs, core_budget, max_threads):
+    '''
+    Threads given to each alignment: its share of the core budget in proportion to its cost,
+    between 1 and max_threads (and never more than the budget).
+    '''
+    total_cost = sum(costs) or 1
+    return [max(1, min(max_threads, core_budget, math.ceil(core_budget * cost / total_cost))) for cost in costs]
+
+def startable_jobs(waiting, free_cores, threads=lambda job: job['threads']):
+    '''
+    Jobs to start now among the waiting ones, sorted by decreasing cost: each job whose threads fit in the
+    cores left, so that when the next job does not fit a smaller one is started instead and no core stays idle.
+    '''
+    started = []
+    for job in waiting:
+        if threads(job) <= free_cores:
+            started.append(job)
+            free_cores -= threads(job)
+    return started
+
+def plan_alignments(fasta_files, output_dir, core_budget, max_threads):
+    '''
+    Estimate the cost (number of sequences x mean length) of each FASTA file.
+
+    Returns:
+    list: one dictionary per alignment, sorted by decreasing cost (longest processing time first).
+    '''
+    jobs = []
+    for fasta_file in fasta_files:
+        n_sequences, mean_length = fasta_size(fasta_file)
+        jobs.append({
+            'fasta': fasta_file,
+            'alignment': os.path.join(output_dir, os.path.basename(fasta_file)),
+            'n_sequences': n_sequences,
+            'mean_length': mean_length,
+            'cost': n_sequences * mean_length
+        })
+    jobs.sort(key=lambda job: job['cost'], reverse=True)
+    for job, threads in zip(jobs, job_threads([job['cost'] for job in jobs], core_budget, max_threads)):
+        job['threads'] = threads
+    return jobs
+
+def run_alignments(jobs, core_budget, poll_interval=1.0):
+    '''
+    Run clustalo on the planned jobs concurrently without using more than core_budget threads in total.
+
+    Jobs are started in decreasing cost order; when the next one does not fit in the free cores,
+    the largest smaller job that fits is started instead so that no core stays idle.
+    Each job gets its wall time ('wall_time') and return code ('status').
+    '''
+    waiting = list(jobs)
+    running = []
+    free_cores = core_budget
+
+    while waiting or running:
+        for job in startable_jobs(waiting, free_cores):
+            waiting.remove(job)
+            free_cores -= job['threads']
+            command = ["clustalo", "-i", job['fasta'], "-o", job['alignment'], f"--threads={job['threads']}", "--force"]
+            job['start'] = time.time()
+            try:
+                job['process'] = subprocess.Popen(command)
+            except OSError as e:
+                print(f"An error occurred while aligning {job['fasta']}: {e}")
+                free_cores += job['threads']
+                job['wall_time'] = 0.0
+                job['status'] = 'not_run'
+                continue
+            running.append(job)
+            print(f"Aligning {job['fasta']} ({job['n_sequences']} sequences, {job['threads']} threads)")
+        time.sleep(poll_interval)
+        for job in list(running):
+            status = job['process'].poll()
+            if status is None:
+                continue
+            running.remove(job)
+            free_cores += job['threads']
+            job['wall_time'] = time.time() - job['start']
+            job['status'] = status
+            del job['process']
+            print(f"{job['alignment']}: {'done' if status == 0 else 'failed'} in {job['wall_time']:.1f} s")
+    return jobs
+
+def write_report(jobs, report_file):
+    '''Per-OG wall time, to tune the core budget.'''
+    with open(report_file, 'w') as out_file:
+        out_file.write("Fasta\tNumberOfSeq\tMean_length\tCost\tThreads\tWall_time_s\tStatus\n")
+        for job in jobs:
+            out_file.write(f"{job['fasta']}\t{job['n_sequences']}\t{job['mean_length']:.1f}\t{job['cost']:.0f}\t{job['threads']}\t{job['wall_time']:.1f}\t{job['status']}\n")
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="""Clustal Omega alignment of all OGs under a total core budget.
+
+The cost of each FASTA file is estimated as number of sequences x mean length. Each alignment gets a number of
+threads in proportion to its cost (at least 1, at most -m), and the alignments run concurrently, largest first,
+without using more than -c threads in total. The wall time of each OG is written to the report file.""",
+    formatter_class=argparse.RawTextHelpFormatter,
+    epilog="Exemple: python align_scheduler.py -i ../3_fasta_recovery/*.fa -o alignment -c 3")
+    parser.add_argument("-i", "--input_files", nargs='+', required=True, help="FASTA files to align")
+    parser.add_argument("-o", "--output_dir", default="alignment", help="Output directory")
+    parser.add_argument("-c", "--cores", type=int, default=3, help="Total number of threads used by the alignments running together")
+    parser.add_argument("-m", "--max_threads", type=int, default=4, help="Maximum number of threads of one alignment")
+    parser.add_argument("-r", "--report", default="alignment_times.tsv", help="Report of the wall time of each alignment")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = plan_alignments(args.input_files, args.output_dir, args.cores, args.max_threads)
+    run_alignments(jobs, args.cores)
+    write_report(jobs, args.report)
+    print(f"Report written to {args.report}")
+
+if __name__ == "__main__":
+    main()
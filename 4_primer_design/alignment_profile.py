@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import tempfile
+from contextlib import nullcontext
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from Bio import SeqIO
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+# Symbols counted in each column: the 15 IUPAC nucleotide codes, then the gap ('-' or '.'). Any other character is counted in a last "other" column.
+PROFILE_SYMBOLS = 'ACGTRYSWKMBDHVN-'
+
+SYMBOL_INDEX = np.full(256, len(PROFILE_SYMBOLS), dtype=np.int64)
+for index, symbol in enumerate(PROFILE_SYMBOLS):
+    SYMBOL_INDEX[ord(symbol)] = index
+    SYMBOL_INDEX[ord(symbol.lower())] = index
+SYMBOL_INDEX[ord('.')] = PROFILE_SYMBOLS.index('-')
+
+# Fields of the profile, each one cached in <name>.profile/<field>.npy
+PROFILE_FIELDS = ['counts', 'gap_fraction', 'n_sequences', 'n_columns', 'uniform_length']
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+def get_profile_path(alignment_file):
+    '''alignment/<name>.fa is cached in the folder alignment/<name>.profile'''
+    return os.path.splitext(alignment_file)[0] + '.profile'
+
+def read_alignment_fasta(alignment_file):
+    '''
+    Read an aligned FASTA file.
+
+    Returns:
+    tuple: (list of record descriptions, (sequences x columns) uint8 matrix, length of each sequence).
+    Shorter sequences are padded with gaps.
+    '''
+    descriptions = []
+    sequences = []
+    for record in SeqIO.parse(alignment_file, 'fasta'):
+        descriptions.append(record.description)
+        sequences.append(str(record.seq))
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    width = int(lengths.max()) if len(sequences) else 0
+    matrix = np.full((len(sequences), width), ord('-'), dtype=np.uint8)
+    for i, sequence in enumerate(sequences):
+        matrix[i, :len(sequence)] = np.frombuffer(sequence.encode('ascii'), dtype=np.uint8)
+    return descriptions, matrix, lengths
+
+def column_counts(matrix):
+    '''(columns x symbols) count matrix of PROFILE_SYMBOLS in each column, plus a last column for other characters.'''
+    n_sequences, n_columns = matrix.shape
+    n_symbols = len(PROFILE_SYMBOLS) + 1
+    codes = SYMBOL_INDEX[matrix] + n_symbols * np.arange(n_columns)[None, :]
+    return np.bincount(codes.ravel(), minlength=n_columns * n_symbols).reshape(n_columns, n_symbols)
+
+def build_profile(alignment_file, alignment=None):
+    '''
+    Compute the column profile of an alignment, parsing it unless alignment (see read_alignment_fasta) is given.
+    The aligned sequences are not part of the profile.
+    '''
+    descriptions, matrix, lengths = read_alignment_fasta(alignment_file) if alignment is None else alignment
+    counts = column_counts(matrix)
+    n_sequences = matrix.shape[0]
+    gap_fraction = counts[:, PROFILE_SYMBOLS.index('-')] / n_sequences if n_sequences else np.zeros(matrix.shape[1])
+    return {
+        'counts': counts,
+        'gap_fraction': gap_fraction,
+        'n_sequences': np.int64(n_sequences),
+        'n_columns': np.int64(matrix.shape[1]),
+        'uniform_length': np.bool_(len(set(lengths.tolist())) == 1)
+    }
+
+def is_up_to_date(profile_path, alignment_file):
+    '''Whether all the .npy files of a profile exist and are newer than the alignment.'''
+    paths = [os.path.join(profile_path, field + '.npy') for field in PROFILE_FIELDS]
+    return all(os.path.exists(path) for path in paths) and \
+        min(os.path.getmtime(path) for path in paths) >= os.path.getmtime(alignment_file)
+
+def write_profile(alignment_file, alignment=None):
+    '''
+    Build the profile of an alignment and save it next to it, one .npy file per field so that it can be memory-mapped.
+
+    Each file is written to a temporary file of its own and renamed, so that jobs building the same cache at the same
+    time never read or replace an incomplete file.
+    '''
+    profile = build_profile(alignment_file, alignment)
+    profile_path = get_profile_path(alignment_file)
+    os.makedirs(profile_path, exist_ok=True)
+    for field in PROFILE_FIELDS:
+        fd, tmp_path = tempfile.mkstemp(prefix=field + '.', suffix='.tmp', dir=profile_path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, profile[field])
+            os.replace(tmp_path, os.path.join(profile_path, field + '.npy'))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return profile_path, int(profile['n_sequences']), int(profile['n_columns'])
+
+def load_profile(alignment_file, alignment=None):
+    '''
+    Return the column profile of an alignment from its cache, to be used as a context manager:
+    with load_profile(alignment_file) as profile: ...
+
+    The arrays are memory-mapped (read-only), so only the parts accessed are read. The cache is (re)built when it is
+    missing or older than the alignment, from alignment when it is given (see read_alignment_fasta); when the
+    alignment folder is not writable, the profile is built in memory without caching it.
+    '''
+    profile_path = get_profile_path(alignment_file)
+    if not is_up_to_date(profile_path, alignment_file):
+        if not os.access(os.path.dirname(os.path.abspath(profile_path)), os.W_OK):
+            return nullcontext(build_profile(alignment_file, alignment))
+        write_profile(alignment_file, alignment)
+    return nullcontext({field: np.load(os.path.join(profile_path, field + '.npy'), mmap_mode='r') for field in PROFILE_FIELDS})
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="""Build the column profile cache of alignments, shared by the primer design stages.
+
+For alignment/<name>.fa the cache folder alignment/<name>.profile holds one .npy file per field, memory-mapped when read:
+    - counts.npy: (columns x 17) counts of A C G T R Y S W K M B D H V N, gap and other characters in each column
+    - gap_fraction.npy: fraction of gaps in each column
+    - n_sequences.npy, n_columns.npy, uniform_length.npy: size of the alignment
+The aligned sequences are not cached. trim_alignment.py and couple_primer.py read the column statistics from this cache.
+It is rebuilt automatically when the alignment is newer.""", formatter_class=argparse.RawTextHelpFormatter,
+    epilog="Exemple: python alignment_profile.py -i alignment/*.fa -t 3")
+    parser.add_argument("-i", "--input_files", nargs='+', required=True, help="Aligned FASTA files")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of alignments processed in parallel")
+    args = parser.parse_args()
+
+    with ProcessPoolExecutor(max_workers=args.threads) as executor:
+        futures = {executor.submit(write_profile, alignment_file): alignment_file for alignment_file in args.input_files}
+        for future, alignment_file in futures.items():
+            try:
+                profile_path, n_sequences, n_columns = future.result()
+                print(f"{alignment_file}: {n_sequences} sequences x {n_columns} columns cached in {profile_path}")
+            except Exception as e:
+                print(f"An error occurred while processing {alignment_file}: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,11 @@
 
 import os
 import argparse
+from functools import lru_cache
+import numpy as np
 from Bio.Seq import Seq
-from Bio import SeqIO
+from alignment_profile import load_profile
+from primer_coverage import MASK_TABLE
 
 __author__ = 'Gabryelle Agoutin - INRAE'
 __copyright__ = 'Copyright (C) 2024 INRAE'
@@ -12,6 +15,9 @@ __version__ = '1.0'
 __email__ = 'gabryelle.agoutin@inrae.fr'
 __status__ = 'prod'
 
+# Number of 3' bases of each primer compared for the 3' complementarity between forward and reverse primers
+MAX_3PRIME_OVERLAP = 8
+
 
 def parse_primer_info(line):
     '''Parse a line from the primer information file and return a dictionary with primer details.'''
@@ -33,18 +39,14 @@ def get_og_id(filename):
     '''Extract the OG_ID from the filename by splitting at the underscore.'''
     return filename.split('_')[0]
 
+@lru_cache(maxsize=None)
 def get_alignment_size(og_id, alignment_folder):
-    '''Get the size of sequences in the alignment files for a given OG_ID.'''
-    for file_name in os.listdir(alignment_folder):
-        if file_name.startswith(og_id):
-            sequence_path = os.path.join(alignment_folder, file_name)
-            with open(sequence_path) as fasta_file:
-                records = SeqIO.parse(fasta_file, 'fasta')
-                sizes = set()
-                for record in records:
-                    sizes.add(len(record.seq))
-                if len(sizes) == 1:
-                    return sizes.pop()
+    '''Get the size of sequences in the alignment files for a given OG_ID, from the alignment profile cache.'''
+    for file_name in sorted(os.listdir(alignment_folder)):
+        if file_name.startswith(og_id + '_') and file_name.endswith(('.fa', '.fasta', '.fna')):
+            with load_profile(os.path.join(alignment_folder, file_name)) as profile:
+                if profile['uniform_length']:
+                    return int(profile['n_columns'])
                 else:
                     return "Different sizes for sequences"
     return None
@@ -61,8 +63,52 @@ def amplicon_score(amplicon_size, amplicon_min_size):
     '''Calculate a score for the amplicon size based on the size.'''
     return round(((amplicon_size - amplicon_min_size) / 22), 2)
     
-def process_files(input_files, alignment_folder, amplicon_min_size, amplicon_max_size):
-    '''Process each input TSV file, find primer pairs, and save the results to output files.'''
+def candidate_pairs(positions, lengths, amplicon_min_size, amplicon_max_size):
+    '''
+    All (i, j) pairs, i < j, of primers sorted by position whose amplicon size is in range.
+
+    The amplicon size position_j - position_i - length_i only grows with j, so the partners of
+    each forward primer are one contiguous slice found by binary search.
+    '''
+    starts = np.maximum(np.searchsorted(positions, positions + lengths + amplicon_min_size, side='left'), np.arange(1, len(positions) + 1))
+    stops = np.searchsorted(positions, positions + lengths + amplicon_max_size, side='right')
+    counts = np.maximum(stops - starts, 0)
+    i_index = np.repeat(np.arange(len(positions)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    j_index = np.repeat(starts, counts) + offsets
+    return i_index, j_index
+
+def cross_3prime_complementarity(end_a, start_b):
+    '''
+    IUPAC-aware 3' complementarity between the forward primer and the reverse primer (Reverse_Complement_B).
+
+    The 3' end of Primer_A anneals to the 3' end of Reverse_Complement_B where the last bases of
+    Primer_A are the same as the first bases of Primer_B (its reverse complement). For each overlap
+    of the two 3' ends, bases score +1 when they can pair (their IUPAC masks share a base) and -1
+    otherwise, and the score is the best ungapped alignment anchored on either 3' end.
+
+    Parameters:
+    end_a (np.ndarray): (pairs x K) IUPAC masks of the last K bases of Primer_A.
+    start_b (np.ndarray): (pairs x K) IUPAC masks of the first K bases of Primer_B.
+
+    Returns:
+    np.ndarray: score of each pair (0 to K).
+    '''
+    k = end_a.shape[1]
+    score = np.zeros(len(end_a), dtype=np.int64)
+    for overlap in range(1, k + 1):
+        pairing = np.where((end_a[:, k - overlap:] & start_b[:, :overlap]) != 0, 1, -1)
+        score = np.maximum(score, np.cumsum(pairing[:, ::-1], axis=1).max(axis=1))  # anchored on the 3' end of Primer_A
+        score = np.maximum(score, np.cumsum(pairing, axis=1).max(axis=1))  # anchored on the 3' end of Reverse_Complement_B
+    return score
+
+def process_files(input_files, alignment_folder, amplicon_min_size, amplicon_max_size, max_tm_delta, max_3prime_complementarity, drop_incompatible):
+    '''
+    Process each input TSV file, find primer pairs, and save the results to output files.
+
+    Candidate pairs are generated by amplicon size, then the Tm delta is checked, and the 3'
+    complementarity is only computed for the pairs still compatible when drop_incompatible is set.
+    '''
     all_primer_pairs = []
     
     for tsv_file in input_files:
@@ -72,38 +118,57 @@ def process_files(input_files, alignment_folder, amplicon_min_size, amplicon_max
 
         primers = [parse_primer_info(line) for line in lines[1:]]  # Skip the header line
         primers.sort(key=lambda x: x['Position'])
-
-        for i in range(len(primers)):
-            for j in range(i + 1, len(primers)):
-                primer1_info = primers[i]['Info']
-                primer2_info = primers[j]['Info'].split('\t')
-                position_1 = int(primer1_info.split('\t')[6])
-                position_2 = int(primer2_info[6])
-                primer_length_1 = len(primer1_info.split('\t')[5])
-                potential_amplicon_size = position_2 - position_1 - primer_length_1
-                
-                if potential_amplicon_size < amplicon_min_size or potential_amplicon_size > amplicon_max_size:
-                    continue  # Skip this pair of primers if it doesn't meet the size criteria
-                    
-                amplicon_size_score = amplicon_score(potential_amplicon_size, amplicon_min_size)
-
-                score_percentage_nm_a = float(primers[i]['Score_Percentage_NM'])
-                score_percentage_nm_b = float(primer2_info[10])
-                min_score_percentage_nm = min(score_percentage_nm_a, score_percentage_nm_b)
-                total_score = round(min_score_percentage_nm + amplicon_size_score, 2)
-
-                og_id = get_og_id(primers[i]['OG_ID'])
-                alignment_size = get_alignment_size(og_id, alignment_folder)
+        if not primers:
+            continue
+
+        fields = [primer['Info'].split('\t') for primer in primers]
+        positions = np.array([primer['Position'] for primer in primers], dtype=np.int64)
+        lengths = np.array([len(primer['Primer']) for primer in primers], dtype=np.int64)
+        i_index, j_index = candidate_pairs(positions, lengths, amplicon_min_size, amplicon_max_size)
+
+        tm_nn_min = np.array([float(field[22]) for field in fields])
+        tm_delta = np.round(np.abs(tm_nn_min[i_index] - tm_nn_min[j_index]), 2)
+        compatible = tm_delta <= max_tm_delta
+        complementarity = np.zeros(len(i_index), dtype=np.int64)
+        scored = compatible if drop_incompatible else np.ones(len(i_index), dtype=bool)
+        if scored.any():
+            k = min(MAX_3PRIME_OVERLAP, int(lengths.min()))
+            masks = [MASK_TABLE[np.frombuffer(primer['Primer'].encode('ascii'), dtype=np.uint8)] for primer in primers]
+            end_a = np.array([mask[-k:] for mask in masks])
+            start_b = np.array([mask[:k] for mask in masks])
+            complementarity[scored] = cross_3prime_complementarity(end_a[i_index[scored]], start_b[j_index[scored]])
+        compatible &= complementarity <= max_3prime_complementarity
+        if drop_incompatible:
+            i_index, j_index = i_index[compatible], j_index[compatible]
+            tm_delta, complementarity, compatible = tm_delta[compatible], complementarity[compatible], compatible[compatible]
+
+        reverse_complements = {}
+        for i, j, delta, score, is_compatible in zip(i_index.tolist(), j_index.tolist(), tm_delta.tolist(), complementarity.tolist(), compatible.tolist()):
+            primer1_info = fields[i]
+            primer2_info = fields[j]
+            potential_amplicon_size = int(positions[j] - positions[i] - lengths[i])
+            amplicon_size_score = amplicon_score(potential_amplicon_size, amplicon_min_size)
+
+            score_percentage_nm_a = float(primers[i]['Score_Percentage_NM'])
+            score_percentage_nm_b = float(primer2_info[10])
+            min_score_percentage_nm = min(score_percentage_nm_a, score_percentage_nm_b)
+            total_score = round(min_score_percentage_nm + amplicon_size_score, 2)
+
+            og_id = get_og_id(primers[i]['OG_ID'])
+            alignment_size = get_alignment_size(og_id, alignment_folder)
+            if j not in reverse_complements:
                 reverse_complement_B = str(Seq(primer2_info[5]).reverse_complement())
-                gc_last_thirty_percent_RC_B = count_gc_in_last_thirty_percent(reverse_complement_B)
-                primer_pair = '\t'.join(
-                    [primers[i]['OG_ID'], primers[i]['NumberOfSeq'], primers[i]['SpeciesCount'], primers[i]['PercentSingleCopy'],
-                     primers[i]['GeneName'], str(alignment_size)] + primer1_info.split('\t')[5:] +
-                    primer2_info[5:] + [reverse_complement_B, str(gc_last_thirty_percent_RC_B), str(potential_amplicon_size), str(amplicon_size_score), str(total_score)])
-                all_primer_pairs.append(primer_pair + '\n')
+                reverse_complements[j] = (reverse_complement_B, count_gc_in_last_thirty_percent(reverse_complement_B))
+            reverse_complement_B, gc_last_thirty_percent_RC_B = reverse_complements[j]
+            primer_pair = '\t'.join(
+                [primers[i]['OG_ID'], primers[i]['NumberOfSeq'], primers[i]['SpeciesCount'], primers[i]['PercentSingleCopy'],
+                 primers[i]['GeneName'], str(alignment_size)] + primer1_info[5:21] +
+                primer2_info[5:21] + [reverse_complement_B, str(gc_last_thirty_percent_RC_B), str(potential_amplicon_size), str(amplicon_size_score), str(total_score)] +
+                primer1_info[21:25] + primer2_info[21:25] + [str(delta), str(score), str(is_compatible)])
+            all_primer_pairs.append(primer_pair + '\n')
 
     if all_primer_pairs:
-        header = "OG_ID\tNumberOfSeq\tSpeciesCount\tPercentSingleCopy\tGeneName\tAlignement_size\tPrimer_A\tPosition_A\tPrimer_Size_A\tNumber_matching_A\tPercentage_NM_A\tScore_Percentage_NM_A\tDegenerescence_A\tTm_A_max\tTm_A_min\tGC_percentage_fraction_A\tGC_percentage_max_A\tGC_percentage_min_A\tGC_in_last_thirty_percent_A\tEnds_with_T_A\tSelf_Complementarity_A\tGC_clamp_A\tPrimer_B\tPosition_B\tPrimer_Size_B\tNumber_matching_B\tPercentage_NM_B\tScore_Percentage_NM_B\tDegenerescence_B\tTm_B_max\tTm_B_min\tGC_percentage_fraction_B\tGC_percentage_max_B\tGC_percentage_min_B\tGC_in_last_thirty_percent_B\tEnds_with_T_B\tSelf_Complementarity_B\tGC_clamp2\tReverse_Complement_B\tGC_last_trhity_percent_RC_B\tpotential_amplicon_size\tAmplicon_score\tTotal_score"
+        header = "OG_ID\tNumberOfSeq\tSpeciesCount\tPercentSingleCopy\tGeneName\tAlignement_size\tPrimer_A\tPosition_A\tPrimer_Size_A\tNumber_matching_A\tPercentage_NM_A\tScore_Percentage_NM_A\tDegenerescence_A\tTm_A_max\tTm_A_min\tGC_percentage_fraction_A\tGC_percentage_max_A\tGC_percentage_min_A\tGC_in_last_thirty_percent_A\tEnds_with_T_A\tSelf_Complementarity_A\tGC_clamp_A\tPrimer_B\tPosition_B\tPrimer_Size_B\tNumber_matching_B\tPercentage_NM_B\tScore_Percentage_NM_B\tDegenerescence_B\tTm_B_max\tTm_B_min\tGC_percentage_fraction_B\tGC_percentage_max_B\tGC_percentage_min_B\tGC_in_last_thirty_percent_B\tEnds_with_T_B\tSelf_Complementarity_B\tGC_clamp2\tReverse_Complement_B\tGC_last_trhity_percent_RC_B\tpotential_amplicon_size\tAmplicon_score\tTotal_score\tTm_NN_A_max\tTm_NN_A_min\tDegeprime_d_A\tDegeprime_l_A\tTm_NN_B_max\tTm_NN_B_min\tDegeprime_d_B\tDegeprime_l_B\tTm_NN_delta\tCross_3prime_complementarity\tCompatible"
         with open(output_file, 'w') as out_file:
             out_file.write(header + '\n')
             for pair in all_primer_pairs:
@@ -156,15 +221,30 @@ Columns in the output file:
     - $40 GC_last_trhity_percent_RC_B 
     - $41 potential_amplicon_size: amplicon size between the two primers
     - $42 Amplicon_score: +1 every 22 bases (amplicon_size - amplicon_min_size) / 22
-    - $43 Total_score: Score_Percentage_NM the lowest score of Score_Percentage_NM + the amplicon_score. We take the weakest base, because that's the one that would catch the most primers.""", formatter_class=argparse.RawTextHelpFormatter,
+    - $43 Total_score: Score_Percentage_NM the lowest score of Score_Percentage_NM + the amplicon_score. We take the weakest base, because that's the one that would catch the most primers.
+    - $44 Tm_NN_A_max: Highest nearest-neighbour Tm over the concrete sequences of the forward primer
+    - $45 Tm_NN_A_min: Lowest nearest-neighbour Tm over the concrete sequences of the forward primer
+    - $46 Degeprime_d_A: DegePrime maximum degeneracy (-d) of the run that gave the forward primer (NA for concatenated_<OG>.tsv inputs without these columns)
+    - $47 Degeprime_l_A: DegePrime primer length (-l) of the run that gave the forward primer (NA for concatenated_<OG>.tsv inputs without these columns)
+    - $48 Tm_NN_B_max
+    - $49 Tm_NN_B_min
+    - $50 Degeprime_d_B
+    - $51 Degeprime_l_B
+    - $52 Tm_NN_delta: Difference between Tm_NN_A_min and Tm_NN_B_min
+    - $53 Cross_3prime_complementarity: Best score (+1 pairing, -1 mismatch, IUPAC-aware) of the 3' ends of Primer_A and Reverse_Complement_B annealed together, on the last 8 bases
+    - $54 Compatible: Tm_NN_delta <= --max_tm_delta and Cross_3prime_complementarity <= --max_3prime_complementarity""", formatter_class=argparse.RawTextHelpFormatter,
     epilog="python couple_primer.py -i $file -f alignment/ --amplicon_min_size 150 --amplicon_max_size 590")
     parser.add_argument("-i", "--input_files", nargs='+', help="Paths to the input TSV files")
     parser.add_argument('-f', '--alignment_folder', type=str, required=True, help='The folder containing alignment files')
     parser.add_argument('--amplicon_min_size', type=int, default=150, help='Minimum size of the amplicon')
     parser.add_argument('--amplicon_max_size', type=int, default=490, help='Maximum size of the amplicon')
+    parser.add_argument('--max_tm_delta', type=float, default=5, help='Maximum difference between the Tm_NN_min of the two primers')
+    parser.add_argument('--max_3prime_complementarity', type=int, default=3, help="Maximum 3' complementarity score between the two primers")
+    parser.add_argument('--drop_incompatible', action='store_true', help='Remove the pairs flagged as not compatible instead of keeping them with Compatible=False')
     args = parser.parse_args()
 
-    process_files(args.input_files, args.alignment_folder, args.amplicon_min_size, args.amplicon_max_size)
+    process_files(args.input_files, args.alignment_folder, args.amplicon_min_size, args.amplicon_max_size,
+                  args.max_tm_delta, args.max_3prime_complementarity, args.drop_incompatible)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from alignment_profile import read_alignment_fasta
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+DEGENERACIES = [8, 12, 24, 48, 96]
+LENGTHS = list(range(14, 25))
+DEGEPRIME_HEADER = "Pos\tTotalSeq\tUniqueMers\tEntropy\tPrimerDeg\tPrimerSeq\tPrimerMatching\n"
+# concatenated_<OG>.tsv rows keep the parameters of their combination, read by process_primers_stat.py
+CONCATENATED_HEADER = DEGEPRIME_HEADER.rstrip('\n') + "\tDegeprime_d\tDegeprime_l\n"
+
+# IUPAC letter of each combination of 4-bit nucleotide masks (A=1, C=2, G=4, T=8)
+IUPAC_FROM_MASK = {1: 'A', 2: 'C', 4: 'G', 8: 'T', 3: 'M', 5: 'R', 9: 'W', 6: 'S', 10: 'Y', 12: 'K',
+                   7: 'V', 11: 'H', 13: 'D', 14: 'B', 15: 'N'}
+POPCOUNT = np.array([bin(mask).count('1') for mask in range(16)], dtype=np.int64)
+
+# Maximum number of unmatched k-mers tried at each greedy step, taken by decreasing abundance
+MAX_CANDIDATES = 64
+# k-mers are packed 2 bits per base in a uint64
+MAX_LENGTH = 32
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+def encode_bases(matrix):
+    '''Return the 2-bit base index (A=0, C=1, G=2, T=3) of each cell and the mask of cells holding A, C, G or T (any case).'''
+    index_table = np.zeros(256, dtype=np.uint64)
+    valid_table = np.zeros(256, dtype=bool)
+    for i, base in enumerate('ACGT'):
+        for character in (base, base.lower()):
+            index_table[ord(character)] = i
+            valid_table[ord(character)] = True
+    return index_table[matrix], valid_table[matrix]
+
+def decode_kmers(codes, length):
+    '''Turn 2-bit packed k-mers into a (k-mers x length) matrix of 4-bit nucleotide masks.'''
+    shifts = (2 * (length - 1 - np.arange(length))).astype(np.uint64)
+    indexes = (codes[:, None] >> shifts[None, :]) & np.uint64(3)
+    return (np.uint8(1) << indexes.astype(np.uint8)).astype(np.uint8)
+
+def shannon_entropy(counts):
+    '''Shannon entropy (bits) of the k-mer distribution of a window.'''
+    frequencies = counts / counts.sum()
+    return float(-(frequencies * np.log2(frequencies)).sum())
+
+def design_degenerate_primer(kmer_bits, kmer_counts, max_degeneracy):
+    '''
+    Greedy degenerate primer design on the unique k-mers of one window.
+
+    This is a heuristic of its own, not the algorithm of DegePrime.pl: its primers and matching counts
+    can differ from DegePrime's. The primer starts as the most abundant k-mer. At each step the unmatched k-mers are tried
+    by decreasing abundance: each one is merged into the primer and the merge covering the most
+    additional sequences without exceeding max_degeneracy is kept (the lowest degeneracy wins ties).
+    The design stops when no merge covers additional sequences. Only the MAX_CANDIDATES most abundant
+    unmatched k-mers are tried at each step, so a rarer k-mer giving a better merge can be missed.
+
+    Parameters:
+    kmer_bits (np.ndarray): (k-mers x length) 4-bit nucleotide masks, sorted by decreasing abundance.
+    kmer_counts (np.ndarray): number of sequences carrying each k-mer.
+    max_degeneracy (int): maximum degeneracy of the primer.
+
+    Returns:
+    tuple: (primer masks, degeneracy, number of matching sequences)
+    '''
+    primer = kmer_bits[0].copy()
+    degeneracy = 1
+    matched = np.all((kmer_bits & primer) != 0, axis=1)
+    matching = int(kmer_counts[matched].sum())
+
+    while not matched.all():
+        candidates = np.flatnonzero(~matched)[:MAX_CANDIDATES]
+        merged = kmer_bits[candidates] | primer
+        degeneracies = np.prod(POPCOUNT[merged], axis=1)
+        feasible = degeneracies <= max_degeneracy
+        if not feasible.any():
+            break
+        merged = merged[feasible]
+        degeneracies = degeneracies[feasible]
+        coverage = np.all((kmer_bits[None, :, :] & merged[:, None, :]) != 0, axis=2)
+        gains = coverage @ kmer_counts - matching
+        best = np.lexsort((degeneracies, -gains))[0]
+        if gains[best] <= 0:
+            break
+        primer = merged[best]
+        degeneracy = int(degeneracies[best])
+        matched = coverage[best]
+        matching += int(gains[best])
+    return primer, degeneracy, matching
+
+def sweep_alignment(matrix, degeneracies, lengths):
+    '''
+    Design the best degenerate primer of every window for all (degeneracy, length) combinations.
+
+    The alignment is scanned once. For a given start position the packed k-mer codes and the
+    mask of gap-free sequences are extended one column at a time, so windows of increasing
+    length share their prefix computations. The unique k-mers of a window are shared by all
+    degeneracies.
+
+    Yields:
+    tuple: (degeneracy, length, DegePrime-formatted row) for every window holding at least one gap-free sequence.
+    '''
+    base_index, base_valid = encode_bases(matrix)
+    n_sequences, n_columns = matrix.shape
+    wanted_lengths = set(lengths)
+    max_length = max(lengths)
+
+    for position in range(n_columns - min(lengths) + 1):
+        codes = np.zeros(n_sequences, dtype=np.uint64)
+        valid = np.ones(n_sequences, dtype=bool)
+        for offset in range(min(max_length, n_columns - position)):
+            codes = (codes << np.uint64(2)) | base_index[:, position + offset]
+            valid &= base_valid[:, position + offset]
+            length = offset + 1
+            if length not in wanted_lengths or not valid.any():
+                continue
+            unique_codes, counts = np.unique(codes[valid], return_counts=True)
+            order = np.argsort(-counts, kind='stable')
+            unique_codes, counts = unique_codes[order], counts[order]
+            kmer_bits = decode_kmers(unique_codes, length)
+            total_seq = int(counts.sum())
+            entropy = shannon_entropy(counts)
+            for degeneracy in degeneracies:
+                primer, primer_degeneracy, matching = design_degenerate_primer(kmer_bits, counts, degeneracy)
+                primer_seq = ''.join(IUPAC_FROM_MASK[int(mask)] for mask in primer)
+                row = f"{position}\t{total_seq}\t{len(unique_codes)}\t{entropy:.4f}\t{primer_degeneracy}\t{primer_seq}\t{matching}\n"
+                yield degeneracy, length, row
+
+def get_og_name(alignment_file):
+    '''Name used by DegePrime output files: trimmed_<OG>_fasta.fna gives <OG>_fasta.'''
+    name = os.path.splitext(os.path.basename(alignment_file))[0]
+    return name[len('trimmed_'):] if name.startswith('trimmed_') else name
+
+def process_alignment(alignment_file, output_dir, degeneracies, lengths, per_parameter_files):
+    '''
+    Run the sweep on one trimmed alignment and write the results.
+
+    By default one concatenated_<OG>.tsv file is written, as expected by process_primers_stat.py, with the d and l
+    of each row in two extra columns.
+    With per_parameter_files, one <OG>_fasta_d<d>_l<l>.tsv file per combination is written instead,
+    like the DegePrime sarray.
+    '''
+    og_name = get_og_name(alignment_file)
+    matrix = read_alignment_fasta(alignment_file)[1]
+    n_rows = 0
+
+    if per_parameter_files:
+        out_files = {}
+        for d in degeneracies:
+            for l in lengths:
+                out_files[(d, l)] = open(os.path.join(output_dir, f"{og_name}_d{d}_l{l}.tsv"), 'w')
+                out_files[(d, l)].write(DEGEPRIME_HEADER)
+        try:
+            for d, l, row in sweep_alignment(matrix, degeneracies, lengths):
+                out_files[(d, l)].write(row)
+                n_rows += 1
+        finally:
+            for out_file in out_files.values():
+                out_file.close()
+        output = os.path.join(output_dir, f"{og_name}_d*_l*.tsv")
+    else:
+        output = os.path.join(output_dir, f"concatenated_{og_name.split('_')[0]}.tsv")
+        with open(output, 'w') as out_file:
+            out_file.write(CONCATENATED_HEADER)
+            for d, l, row in sweep_alignment(matrix, degeneracies, lengths):
+                out_file.write(f"{row[:-1]}\t{d}\t{l}\n")
+                n_rows += 1
+    return output, n_rows
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="""Degenerate primer design for every trimmed alignment, for all degeneracies and lengths in one pass.
+
+This is an alternative to the DegePrime.pl sarray: each alignment is read once and all (degeneracy, length) combinations are
+computed in the same scan. The primers come from a greedy heuristic (the most abundant k-mer, then at each step the best
+merge among the 64 most abundant unmatched k-mers), not from DegePrime's algorithm, so primers and PrimerMatching can differ
+from DegePrime.pl. Lengths are limited to 32. The output rows follow the DegePrime format read by process_primers_stat.py:
+    - $1 Pos: 0-based start of the window in the trimmed alignment
+    - $2 TotalSeq: Number of sequences without gap or ambiguous base in the window
+    - $3 UniqueMers: Number of distinct k-mers in the window
+    - $4 Entropy: Shannon entropy of the k-mer distribution
+    - $5 PrimerDeg: Degeneracy of the primer
+    - $6 PrimerSeq: Degenerate primer sequence
+    - $7 PrimerMatching: Number of sequences matched by the primer
+    - $8 Degeprime_d, $9 Degeprime_l: Maximum degeneracy and length of the combination (concatenated_<OG>.tsv only)""", formatter_class=argparse.RawTextHelpFormatter,
+    epilog="Exemple: python degeprime_sweep.py -i alignment/trimmed_* -o degeprime_result -t 4")
+    parser.add_argument("-i", "--input_files", nargs='+', required=True, help="Trimmed alignments (alignment/trimmed_*.fna)")
+    parser.add_argument("-o", "--output_dir", default="degeprime_result", help="Output directory")
+    parser.add_argument("-d", "--degeneracies", type=int, nargs='+', default=DEGENERACIES, help="Maximum degeneracies to test")
+    parser.add_argument("-l", "--lengths", type=int, nargs='+', default=LENGTHS, help="Primer lengths to test")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of alignments processed in parallel")
+    parser.add_argument("--per_parameter_files", action="store_true", help="Write one <OG>_d<d>_l<l>.tsv file per combination instead of concatenated_<OG>.tsv")
+    args = parser.parse_args()
+    if max(args.lengths) > MAX_LENGTH:
+        parser.error(f"primer lengths above {MAX_LENGTH} are not supported (-l {max(args.lengths)})")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.threads) as executor:
+        futures = {executor.submit(process_alignment, alignment_file, args.output_dir, args.degeneracies, args.lengths, args.per_parameter_files): alignment_file
+                   for alignment_file in args.input_files}
+        for future, alignment_file in futures.items():
+            try:
+                output, n_rows = future.result()
+                print(f"{alignment_file}: {n_rows} rows written to {output}")
+            except Exception as e:
+                print(f"An error occurred while processing {alignment_file}: {e}")
+
+if __name__ == "__main__":
+    main()
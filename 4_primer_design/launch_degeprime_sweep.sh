@@ -0,0 +1,12 @@
+#!/bin/bash
+#SBATCH -J launch_degeprime_sweep
+#SBATCH -p unlimitq
+#SBATCH --mem=50G
+#SBATCH -c 8
+#SBATCH --mail-type=BEGIN,END,FAIL
+
+module load devel/python/Python-3.11.1
+
+mkdir -p degeprime_result/
+
+python degeprime_sweep.py -i alignment/trimmed_*.fna -o degeprime_result -d 8 12 24 48 96 -l 14 15 16 17 18 19 20 21 22 23 24 -t 8
@@ -1,7 +1,16 @@
 #!/usr/bin/env python
 
 import argparse
+import hashlib
 import os
+import shlex
+import subprocess
+import sys
+from multiprocessing import Pool
+
+# ecoPCR output reader shared with script_treatment_ecopcr_result/format_ecopcr_result.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'script_treatment_ecopcr_result'))
+from ecopcr_reader import read_blocks, read_ecopcr_columns
 
 __author__ = 'Gabryelle Agoutin - INRAE'
 __copyright__ = 'Copyright (C) 2024 INRAE'
@@ -12,58 +21,213 @@ __status__ = 'prod'
 
 #script written in python 2.7 to be compatible with EcoPCR in the conda environment
 
+# Columns of the ecoPCR output read for the statistics
+STAT_FIELDS = ['length', 'taxid', 'forward_mismatches', 'reverse_mismatches']
+
+ECOPCR_DB_EXTENSIONS = ['.adx', '.ndx', '.rdx', '.tdx']
+
+AMPLICON_COLUMNS = ['min_size_amplicon', 'max_size_amplicon', 'median_size_amplicon', 'amplicon_count', 'taxid_count', 'mismatch_distribution']
 
-def find_database_path(og_id, db_paths):
+
+def index_databases(db_paths):
     """
-    Find the database path that matches the given OG_ID.
+    Index the ecoPCR databases by OG_ID.
+
+    A database is the prefix of its .adx/.ndx/.rdx/.tdx files (ecoPCR_db_<OG>/<OG> as written by
+    launch_obiconvert_fasta_OG.sh), so the OG_ID is the exact name of the prefix. A path may be a
+    database directory or a database prefix.
 
     Parameters:
-    og_id (str): The OG_ID to search for.
     db_paths (list of str): List of paths to the formatted ecoPCR databases.
 
     Returns:
-    str: Path to the database that matches the OG_ID, or None if not found.
+    tuple: (dict OG_ID -> database prefix, list of (database prefix, missing extensions) of the incomplete databases)
     """
+    database_index = {}
+    incomplete = []
     for path in db_paths:
-        if og_id in os.path.basename(path):
-            return path
-    return None
+        if os.path.isdir(path):
+            prefixes = sorted(os.path.join(path, name[:-len('.adx')]) for name in os.listdir(path) if name.endswith('.adx'))
+            if not prefixes:
+                incomplete.append((path, ['.adx']))
+        else:
+            prefixes = [path[:-len('.adx')] if path.endswith('.adx') else path]
+        for db_prefix in prefixes:
+            missing = [extension for extension in ECOPCR_DB_EXTENSIONS if not os.path.exists(db_prefix + extension)]
+            if missing:
+                incomplete.append((db_prefix, missing))
+                continue
+            og_id = os.path.basename(db_prefix)
+            if og_id in database_index:
+                print("Database {0} already found for {1}, {2} is ignored".format(database_index[og_id], og_id, db_prefix))
+                continue
+            database_index[og_id] = db_prefix
+    return database_index, incomplete
 
-def extract_amplicon_sizes(ecopcr_file):
+class AmpliconStats(object):
     """
-    Extract amplicon sizes from the ecoPCR output file.
+    Statistics of the amplicons of one ecoPCR run, updated one block of output lines at a time.
+
+    The number of amplicons of each length is counted in a {length: count} dictionary, so the exact
+    median is obtained without keeping the list of lengths, whatever the amplicon sizes.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.min_size = None
+        self.max_size = None
+        self.length_counts = {}
+        self.taxids = set()
+        self.mismatches = {}
+
+    def add_block(self, data):
+        """Add a block of whole lines of ecoPCR output (bytes). Comments and incorrect lines are ignored."""
+        values = read_ecopcr_columns(data, STAT_FIELDS, strict=False)
+        sizes = values['length']
+        if not sizes:
+            return
+        self.count += len(sizes)
+        self.min_size = min(sizes) if self.min_size is None else min(self.min_size, min(sizes))
+        self.max_size = max(sizes) if self.max_size is None else max(self.max_size, max(sizes))
+        for size in sizes:
+            self.length_counts[size] = self.length_counts.get(size, 0) + 1
+        self.taxids.update(values['taxid'])
+        for forward, reverse in zip(values['forward_mismatches'], values['reverse_mismatches']):
+            self.mismatches[forward + reverse] = self.mismatches.get(forward + reverse, 0) + 1
+
+    def median(self):
+        """Median amplicon length read from the length counts."""
+        if not self.count:
+            return None
+        middle_ranks = [(self.count - 1) // 2, self.count // 2]
+        values = []
+        seen = 0
+        for size in sorted(self.length_counts):
+            seen += self.length_counts[size]
+            while middle_ranks and middle_ranks[0] < seen:
+                values.append(size)
+                middle_ranks.pop(0)
+            if not middle_ranks:
+                break
+        return (values[0] + values[1]) / 2.0
+
+    def columns(self):
+        """Values of AMPLICON_COLUMNS (empty when ecoPCR found no amplicon)."""
+        if not self.count:
+            return ['', '', '', '0', '0', '']
+        return [str(self.min_size), str(self.max_size), '{0:g}'.format(self.median()), str(self.count), str(len(self.taxids)),
+                ','.join('{0}:{1}'.format(mismatches, n) for mismatches, n in sorted(self.mismatches.items()))]
+
+def summarize_ecopcr_file(ecopcr_file):
+    """
+    Amplicon statistics of an ecoPCR output file.
 
     Parameters:
     ecopcr_file (str): Path to the ecoPCR output file.
 
     Returns:
-    list of int: List of amplicon sizes extracted from the file.
+    list of str: Values of AMPLICON_COLUMNS.
     """
-    sizes = []
-    with open(ecopcr_file, 'r') as file:
-        for line in file:
-            if line.startswith('#'):
-                continue
-            parts = line.split(' | ')
-            if len(parts) > 19:
-                try:
-                    size = int(parts[19].strip())
-                    sizes.append(size)
-                except ValueError:
-                    continue
-    return sizes
-
-def run_ecopcr(tsv_file, db_paths):
+    stats = AmpliconStats()
+    with open(ecopcr_file, 'rb') as file:
+        for data in read_blocks(file):
+            stats.add_block(data)
+    return stats.columns()
+
+def write_atomically(output_file, content):
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'w') as out:
+        out.write(content)
+    os.rename(tmp_file, output_file)
+
+def ecopcr_cache_file(cache_dir, db_prefix, primer_a, reverse_complement_b, ecopcr_options):
+    """
+    Path of the cached ecoPCR output of a (database, primers, options) combination.
+
+    The file name holds a hash of the combination, so the same primers on the same database with the
+    same options always give the same file, whatever the row of the table.
     """
-    Run ecoPCR for each line in the TSV file and analyze the output files.
+    key = '\t'.join([os.path.abspath(db_prefix), primer_a, reverse_complement_b, ecopcr_options])
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(cache_dir, "{0}_{1}.ecopcr".format(os.path.basename(db_prefix), digest[:20]))
+
+def stats_cache_file(output_file):
+    """The statistics of <hash>.ecopcr are cached in <hash>.stats"""
+    return os.path.splitext(output_file)[0] + '.stats'
+
+def run_ecopcr_job(job):
+    """
+    Run one ecoPCR command unless its statistics are already cached.
+
+    ecoPCR's output is read through a pipe and summarised on the fly. It is only written to the
+    cache when keep_raw is set; an already cached raw output is summarised without running ecoPCR.
+    Cache files are written to a temporary file and renamed at the end, so an interrupted run never
+    leaves a partial file in the cache. When ecoPCR cannot be started (not in the PATH, incorrect
+    options), the job fails with return code -1 and the other jobs go on.
+
+    Parameters:
+    job (tuple): (database prefix, Primer_A, Reverse_Complement_B, ecoPCR options, output file, keep_raw)
+
+    Returns:
+    tuple: (output file, True if ecoPCR was run, return code, values of AMPLICON_COLUMNS)
+    """
+    db_prefix, primer_a, reverse_complement_b, ecopcr_options, output_file, keep_raw = job
+    stats_file = stats_cache_file(output_file)
+    # the cached statistics are enough unless the raw output is requested and missing
+    if os.path.exists(stats_file) and (not keep_raw or os.path.exists(output_file)):
+        with open(stats_file, 'r') as f:
+            return output_file, False, 0, f.readline().rstrip('\n').split('\t')
+    if os.path.exists(output_file):
+        columns = summarize_ecopcr_file(output_file)
+        write_atomically(stats_file, '\t'.join(columns) + '\n')
+        return output_file, False, 0, columns
+
+    stats = AmpliconStats()
+    tmp_file = output_file + '.tmp'
+    raw_out = open(tmp_file, 'wb') if keep_raw else None
+    try:
+        command = ["ecoPCR", "-d", db_prefix] + shlex.split(ecopcr_options) + [primer_a, reverse_complement_b]
+        print("Running: {0}".format(' '.join(command)))
+        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        for data in read_blocks(process.stdout):
+            stats.add_block(data)
+            if raw_out is not None:
+                raw_out.write(data)
+        process.stdout.close()
+        return_code = process.wait()
+    except (OSError, ValueError) as e:
+        print("ecoPCR could not be run for {0}: {1}".format(output_file, e))
+        return_code = -1
+    finally:
+        if raw_out is not None:
+            raw_out.close()
+
+    columns = stats.columns()
+    if return_code == 0:
+        if keep_raw:
+            os.rename(tmp_file, output_file)
+        write_atomically(stats_file, '\t'.join(columns) + '\n')
+    elif keep_raw:
+        os.remove(tmp_file)
+    return output_file, True, return_code, columns
+
+def run_ecopcr(tsv_file, db_paths, threads=1, cache_dir='ecopcr_cache', ecopcr_options='', keep_raw=False):
+    """
+    Run ecoPCR for each line in the TSV file and add the amplicon statistics (AMPLICON_COLUMNS).
+
+    Rows sharing the same database and primers give one ecoPCR run. The runs are executed in a pool of
+    processes, each one parsing the output of its ecoPCR run, so the parsing is not serialised by the GIL.
+    Their statistics are kept in cache_dir, so re-annotating an updated table only runs ecoPCR for the
+    new primer pairs.
 
     Parameters:
     tsv_file (str): Path to the TSV file containing primer information.
     db_paths (list of str): List of paths to the formatted ecoPCR databases.
+    threads (int): Number of ecoPCR commands run (and outputs parsed) at the same time.
+    cache_dir (str): Directory of the ecoPCR outputs.
+    ecopcr_options (str): Options added to every ecoPCR command (they are part of the cache key).
+    keep_raw (bool): Also keep the raw ecoPCR outputs in cache_dir.
     """
-    min_sizes = []
-    max_sizes = []
-
     # Read the TSV file line by line
     with open(tsv_file, 'r') as f:
         headers = f.readline().strip().split('\t')
@@ -74,42 +238,55 @@ def run_ecopcr(tsv_file, db_paths):
     primer_a_idx = headers.index('Primer_A')
     reverse_complement_b_idx = headers.index('Reverse_Complement_B')
 
-    # Iterate through each row of the TSV file
-    for index, row in enumerate(rows):
-        og_id = row[og_id_idx]
-        primer_a = row[primer_a_idx]
-        reverse_complement_b = row[reverse_complement_b_idx]
-        
-        # Find the appropriate database path
-        db_path = find_database_path(og_id, db_paths)
-        if db_path:
-            # Construct the output file name
-            output_file = "{0}_{1}.ecopcr".format(og_id, index + 1)
-            command = "ecoPCR -d {0}/{1} {2} {3} > {4}".format(db_path, og_id, primer_a, reverse_complement_b, output_file)
-            print("Running: {0}".format(command))
-            os.system(command)
-
-            # Analyze the output file
-            sizes = extract_amplicon_sizes(output_file)
-            if sizes:
-                min_sizes.append(int(min(sizes)))
-                max_sizes.append(int(max(sizes)))
-            else:
-                min_sizes.append(None)
-                max_sizes.append(None)
-        else:
-            print("Database for {0} not found. Skipping...".format(og_id))
-            min_sizes.append(None)
-            max_sizes.append(None)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Check the databases once, before running anything
+    database_index, incomplete = index_databases(db_paths)
+    for db_prefix, missing in incomplete:
+        print("Incomplete database {0} (missing {1}). Skipping...".format(db_prefix, ', '.join(missing)))
+    missing_og_ids = sorted(set(row[og_id_idx] for row in rows) - set(database_index))
+    if missing_og_ids:
+        print("Database not found for {0} OG(s), their rows are skipped: {1}".format(len(missing_og_ids), ', '.join(missing_og_ids)))
+
+    # One job per distinct (database, primers), in order of first appearance
+    row_outputs = []
+    jobs = []
+    job_outputs = set()
+    for row in rows:
+        db_prefix = database_index.get(row[og_id_idx])
+        if db_prefix is None:
+            row_outputs.append(None)
+            continue
+        output_file = ecopcr_cache_file(cache_dir, db_prefix, row[primer_a_idx], row[reverse_complement_b_idx], ecopcr_options)
+        if output_file not in job_outputs:
+            job_outputs.add(output_file)
+            jobs.append((db_prefix, row[primer_a_idx], row[reverse_complement_b_idx], ecopcr_options, output_file, keep_raw))
+        row_outputs.append(output_file)
+
+    pool = Pool(threads)
+    try:
+        # one job at a time per process, the ecoPCR runs can be long
+        results = pool.map(run_ecopcr_job, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    n_run = sum(1 for _, was_run, _, _ in results if was_run)
+    failed = set(output_file for output_file, _, return_code, _ in results if return_code != 0)
+    print("{0} distinct ecoPCR runs for {1} rows: {2} run, {3} from cache, {4} failed".format(
+        len(jobs), len(rows), n_run, len(jobs) - n_run, len(failed)))
+
+    amplicon_stats = {}
+    for output_file, _, return_code, columns in results:
+        amplicon_stats[output_file] = columns if return_code == 0 else [''] * len(AMPLICON_COLUMNS)
 
     # Write updated TSV with new columns
     output_tsv_file = tsv_file.replace('.tsv', '_updated.tsv')
     with open(output_tsv_file, 'w') as f_out:
-        f_out.write('\t'.join(headers + ['min_size_amplicon', 'max_size_amplicon']) + '\n')
-        for i, row in enumerate(rows):
-            min_size = str(min_sizes[i]) if min_sizes[i] is not None else ''
-            max_size = str(max_sizes[i]) if max_sizes[i] is not None else ''
-            f_out.write('\t'.join(row + [min_size, max_size]) + '\n')
+        f_out.write('\t'.join(headers + AMPLICON_COLUMNS) + '\n')
+        for row, output_file in zip(rows, row_outputs):
+            columns = amplicon_stats[output_file] if output_file is not None else [''] * len(AMPLICON_COLUMNS)
+            f_out.write('\t'.join(row + columns) + '\n')
 
     print("Updated TSV file saved as: {0}".format(output_tsv_file))
 
@@ -119,7 +296,11 @@ if __name__ == "__main__":
     epilog='python script.py sorted_results.tsv /path/to/db1 /path/to/db2 or /path/to/db*')
     parser.add_argument("tsv_file", help="Path to the TSV file containing primer information.")
     parser.add_argument("db_paths", nargs='+', help="Paths to the formatted ecoPCR databases.")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of ecoPCR commands run at the same time.")
+    parser.add_argument("--cache_dir", default="ecopcr_cache", help="Directory where the ecoPCR outputs are kept and reused.")
+    parser.add_argument("--ecopcr_options", default="", help="Options added to every ecoPCR command, e.g. \"-e 3 -l 50 -L 800\".")
+    parser.add_argument("--keep_raw", action="store_true", help="Also keep the raw ecoPCR outputs in the cache directory.")
     
     args = parser.parse_args()
     
-    run_ecopcr(args.tsv_file, args.db_paths)
+    run_ecopcr(args.tsv_file, args.db_paths, args.threads, args.cache_dir, args.ecopcr_options, args.keep_raw)
@@ -9,4 +9,4 @@ module load devel/python/Python-3.11.1
 module load bioinfo/ecoPCR/1.0.1
 
 
-python launch_ecopcr_and_add_amplicon_length_info.py sorted_results.tsv ecoPCR_db_*
+python launch_ecopcr_and_add_amplicon_length_info.py sorted_results.tsv ecoPCR_db_* -t 3
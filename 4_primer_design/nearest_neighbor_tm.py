@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import argparse
+import math
+from collections import OrderedDict
+import numpy as np
+from Bio.SeqUtils import MeltingTemp as mt
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+# Same parameters as the defaults of Bio.SeqUtils.MeltingTemp.Tm_NN, so that a non-degenerate primer gets the value of mt.Tm_NN(primer)
+NN_TABLE = mt.DNA_NN3
+IMM_TABLE = mt.DNA_IMM1
+SODIUM = 50
+DNAC1 = 25
+DNAC2 = 25
+R = 1.987
+
+BASES = 'ACGT'
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+IUPAC_BASES = {'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+               'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'}
+
+# Degenerate primers up to this degeneracy are expanded and every expansion is computed, the others go through the dynamic programming
+MAX_ENUMERATED_DEGENERACY = 16
+CACHE_SIZE = 1000000
+
+##################################################################################################################################################
+#
+# PARAMETERS
+#
+##################################################################################################################################################
+
+def nn_parameters(neighbors):
+    '''(dH, dS) of a Watson-Crick dinucleotide, looked up like mt.Tm_NN does.'''
+    for table in (IMM_TABLE, NN_TABLE):
+        if neighbors in table:
+            return table[neighbors]
+        if neighbors[::-1] in table:
+            return table[neighbors[::-1]]
+    raise KeyError(neighbors)
+
+def terminal_parameters(base, penalised_base):
+    '''(dH, dS) of a terminal base pair. init_5T/A applies to a 5' T and to a 3' A.'''
+    dh, ds = NN_TABLE['init_A/T'] if base in 'AT' else NN_TABLE['init_G/C']
+    if base == penalised_base:
+        dh += NN_TABLE['init_5T/A'][0]
+        ds += NN_TABLE['init_5T/A'][1]
+    return dh, ds
+
+# dH/dS of each step between states A, C, G, T
+NN_H = np.array([[nn_parameters(a + b + '/' + COMPLEMENT[a] + COMPLEMENT[b])[0] for b in BASES] for a in BASES])
+NN_S = np.array([[nn_parameters(a + b + '/' + COMPLEMENT[a] + COMPLEMENT[b])[1] for b in BASES] for a in BASES])
+START_H = np.array([terminal_parameters(base, 'T')[0] for base in BASES])
+START_S = np.array([terminal_parameters(base, 'T')[1] for base in BASES])
+END_H = np.array([terminal_parameters(base, 'A')[0] for base in BASES])
+END_S = np.array([terminal_parameters(base, 'A')[1] for base in BASES])
+# init_allA/T and init_oneG/C are both 0 in DNA_NN3, so the general initiation does not depend on the expansion
+INIT_H = NN_TABLE['init'][0] + NN_TABLE['init_oneG/C'][0]
+INIT_S = NN_TABLE['init'][1] + NN_TABLE['init_oneG/C'][1]
+
+# Per-byte tables of the concrete bases (indexes in BASES) each IUPAC code stands for
+OPTION_COUNTS = np.ones(256, dtype=np.int64)
+OPTIONS = np.zeros((256, 4), dtype=np.int64)
+ALLOWED = np.zeros((256, 4), dtype=bool)
+for code, concrete_bases in IUPAC_BASES.items():
+    OPTION_COUNTS[ord(code)] = len(concrete_bases)
+    for option, concrete in enumerate(concrete_bases):
+        OPTIONS[ord(code), option] = BASES.index(concrete)
+        ALLOWED[ord(code), BASES.index(concrete)] = True
+
+def entropy_constant(length):
+    '''Part of the denominator of Tm that only depends on the primer length: salt correction (method 5) and primer concentration.'''
+    salt = mt.salt_correction(Na=SODIUM, method=5, seq='A' * length)
+    return INIT_S + salt + R * math.log((DNAC1 - DNAC2 / 2.0) * 1e-9)
+
+def melting_temperature(delta_h, delta_s, length):
+    '''Tm (degrees C) of duplexes from their summed enthalpy and entropy.'''
+    return (1000 * (delta_h + INIT_H)) / (delta_s + entropy_constant(length)) - 273.15
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+def encode_primers(primers):
+    '''(primers x length) uint8 matrix of primers of the same length.'''
+    return np.frombuffer(''.join(primers).encode('ascii'), dtype=np.uint8).reshape(len(primers), -1)
+
+def enumerated_tm_ranges(matrix):
+    '''
+    Exact (Tm max, Tm min) of primers of the same length by computing every concrete expansion.
+
+    Expansion k of a primer takes, at each position, option (k // stride) % count of its base, with
+    the strides of a mixed-radix number. k runs up to the highest degeneracy of the batch for every
+    primer, taken modulo its degeneracy, so that all primers are expanded at once (repeated
+    expansions do not change the bounds).
+    '''
+    n_primers, length = matrix.shape
+    counts = OPTION_COUNTS[matrix]
+    strides = np.cumprod(np.concatenate([np.ones((n_primers, 1), dtype=np.int64), counts[:, :-1]], axis=1), axis=1)
+    degeneracy = strides[:, -1] * counts[:, -1]
+    k = np.arange(degeneracy.max())[None, :] % degeneracy[:, None]
+    options = (k[:, :, None] // strides[:, None, :]) % counts[:, None, :]
+    expansions = OPTIONS[matrix[:, None, :], options]
+    delta_h = START_H[expansions[:, :, 0]] + END_H[expansions[:, :, -1]] + NN_H[expansions[:, :, :-1], expansions[:, :, 1:]].sum(axis=2)
+    delta_s = START_S[expansions[:, :, 0]] + END_S[expansions[:, :, -1]] + NN_S[expansions[:, :, :-1], expansions[:, :, 1:]].sum(axis=2)
+    tm = melting_temperature(delta_h, delta_s, length)
+    return tm.max(axis=1), tm.min(axis=1)
+
+def dynamic_tm_bound(allowed, maximize, max_iterations=100):
+    '''
+    Exact maximum (or minimum) Tm over the expansions of degenerate primers of the same length.
+
+    Tm = 1000 * dH / (dS + constant) is a ratio of two sums over the dinucleotide steps, so the best
+    expansion is found by Dinkelbach iterations: for the current ratio t, the expansion optimising
+    the additive score -1000 * dH + t * dS is found by dynamic programming over the 4 base states
+    (Viterbi), and t is replaced by the Tm of that expansion until it no longer changes.
+    All primers of the batch are processed at once.
+
+    Parameters:
+    allowed (np.ndarray): (primers x length x 4) bases allowed at each position (ALLOWED[matrix]).
+    maximize (bool): True for Tm max, False for Tm min.
+
+    Returns:
+    np.ndarray: Tm (degrees C) of each primer.
+    '''
+    n_primers, length, _ = allowed.shape
+    sign = 1.0 if maximize else -1.0
+    constant_s = entropy_constant(length)
+    t = np.zeros(n_primers)
+    rows = np.arange(n_primers)
+
+    for _ in range(max_iterations):
+        score = np.where(allowed[:, 0], sign * (-1000 * START_H + t[:, None] * START_S), -np.inf)
+        delta_h = np.broadcast_to(START_H, (n_primers, 4)).copy()
+        delta_s = np.broadcast_to(START_S, (n_primers, 4)).copy()
+        step = sign * (-1000 * NN_H[None, :, :] + t[:, None, None] * NN_S[None, :, :])
+        for position in range(1, length):
+            candidates = np.where(allowed[:, position][:, None, :], score[:, :, None] + step, -np.inf)
+            previous = candidates.argmax(axis=1)
+            score = np.take_along_axis(candidates, previous[:, None, :], axis=1)[:, 0, :]
+            delta_h = np.take_along_axis(delta_h, previous, axis=1) + NN_H[previous, np.arange(4)]
+            delta_s = np.take_along_axis(delta_s, previous, axis=1) + NN_S[previous, np.arange(4)]
+        score = score + sign * (-1000 * END_H + t[:, None] * END_S)
+        best = score.argmax(axis=1)
+        delta_h = delta_h[rows, best] + END_H[best]
+        delta_s = delta_s[rows, best] + END_S[best]
+        new_t = (1000 * (delta_h + INIT_H)) / (delta_s + constant_s)
+        if np.allclose(new_t, t, rtol=0, atol=1e-9):
+            break
+        t = new_t
+    return new_t - 273.15
+
+def primer_degeneracy(primer):
+    return math.prod(len(IUPAC_BASES[base]) for base in primer)
+
+TM_CACHE = OrderedDict()
+
+def nn_tm_ranges(primers):
+    '''
+    Nearest-neighbour (Tm max, Tm min) over all the concrete expansions of each primer, rounded to 2 decimals.
+
+    Primers of low degeneracy are enumerated, the others are solved by dynamic programming, grouped by length.
+    Results are kept in an LRU cache keyed by primer sequence.
+
+    Returns:
+    tuple: (Tm max array, Tm min array), in the order of primers.
+    '''
+    missing = []
+    for primer in dict.fromkeys(primers):
+        if primer in TM_CACHE:
+            TM_CACHE.move_to_end(primer)
+        else:
+            missing.append(primer)
+
+    by_length = {}
+    for primer in missing:
+        by_length.setdefault(len(primer), []).append(primer)
+    for length, group in by_length.items():
+        matrix = encode_primers(group)
+        tm_max = np.empty(len(group))
+        tm_min = np.empty(len(group))
+        enumerated = np.prod(OPTION_COUNTS[matrix], axis=1) <= MAX_ENUMERATED_DEGENERACY
+        if enumerated.any():
+            tm_max[enumerated], tm_min[enumerated] = enumerated_tm_ranges(matrix[enumerated])
+        if not enumerated.all():
+            allowed = ALLOWED[matrix[~enumerated]]
+            tm_max[~enumerated] = dynamic_tm_bound(allowed, maximize=True)
+            tm_min[~enumerated] = dynamic_tm_bound(allowed, maximize=False)
+        for primer, high, low in zip(group, tm_max.tolist(), tm_min.tolist()):
+            TM_CACHE[primer] = (round(high, 2), round(low, 2))
+
+    values = [TM_CACHE[primer] for primer in primers]
+    while len(TM_CACHE) > CACHE_SIZE:
+        TM_CACHE.popitem(last=False)
+    tm_max = np.array([value[0] for value in values], dtype=np.float64)
+    tm_min = np.array([value[1] for value in values], dtype=np.float64)
+    return tm_max, tm_min
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="""Nearest-neighbour melting temperature range of degenerate primers.
+
+Tm is computed as Bio.SeqUtils.MeltingTemp.Tm_NN with its default parameters (DNA_NN3 table, Na 50 mM, 25 nM primers),
+for every concrete sequence the degenerate primer stands for. Tm_NN_max and Tm_NN_min are the highest and lowest values.""",
+    formatter_class=argparse.RawTextHelpFormatter,
+    epilog="Exemple: python nearest_neighbor_tm.py -p ACGTRYAGCTNACGTAGC TTGACCGGA")
+    parser.add_argument("-p", "--primers", nargs='+', required=True, help="Primer sequences (IUPAC)")
+    args = parser.parse_args()
+
+    primers = [primer.upper() for primer in args.primers]
+    tm_max, tm_min = nn_tm_ranges(primers)
+    print("Primer\tDegenerescence\tTm_NN_max\tTm_NN_min")
+    for primer, high, low in zip(primers, tm_max, tm_min):
+        print(f"{primer}\t{primer_degeneracy(primer)}\t{high}\t{low}")
+
+if __name__ == "__main__":
+    main()
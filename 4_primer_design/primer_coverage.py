@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import os
+import re
+import numpy as np
+from alignment_profile import read_alignment_fasta
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+# 4-bit IUPAC masks: A=1, C=2, G=4, T=8. Gaps and unknown characters are 0 and never match.
+IUPAC_MASKS = {'A': 1, 'C': 2, 'G': 4, 'T': 8, 'U': 8, 'R': 5, 'Y': 10, 'S': 6, 'W': 9, 'K': 12, 'M': 3,
+               'B': 14, 'D': 13, 'H': 11, 'V': 7, 'N': 15}
+MASK_TABLE = np.zeros(256, dtype=np.uint8)
+for base, mask in IUPAC_MASKS.items():
+    MASK_TABLE[ord(base)] = mask
+    MASK_TABLE[ord(base.lower())] = mask
+
+TAXID_PATTERN = re.compile(r'taxid=(\d+)')
+
+COVERAGE_COLUMNS = ["Matching_seq_A", "Matching_seq_B", "Matching_seq_pair", "Species_A", "Species_B",
+                    "Species_pair", "Species_total", "Percentage_species_pair", "Taxids_pair"]
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+def encode_primer(primer):
+    '''4-bit IUPAC masks of a primer.'''
+    return MASK_TABLE[np.frombuffer(primer.encode('ascii'), dtype=np.uint8)]
+
+class AlignmentCoverage:
+    '''
+    Sequence and species coverage of primers on one alignment.
+
+    The aligned sequences are encoded once as 4-bit IUPAC masks. A base matches a primer position
+    when their masks share a bit, so mismatches are counted for all sequences at once. The species
+    of each sequence is the taxid of its header (step 3 FASTA: >ID| taxid=<taxid>; species).
+    '''
+
+    def __init__(self, alignment_file, max_mismatches=0):
+        descriptions, matrix, _ = read_alignment_fasta(alignment_file)
+        self.masks = MASK_TABLE[matrix]
+        self.max_mismatches = max_mismatches
+        taxids = []
+        for description in descriptions:
+            match = TAXID_PATTERN.search(str(description))
+            taxids.append(match.group(1) if match else 'Unknown')
+        self.taxid_names, self.taxid_index = np.unique(np.array(taxids, dtype=str), return_inverse=True)
+        self.matched_cache = {}
+
+    def mismatches(self, primer, position):
+        '''Number of mismatches of the primer placed at position (0-based) against every sequence.'''
+        primer_masks = encode_primer(primer)
+        window = self.masks[:, position:position + len(primer_masks)]
+        if window.shape[1] < len(primer_masks):
+            return np.full(self.masks.shape[0], len(primer_masks))
+        return np.count_nonzero((window & primer_masks) == 0, axis=1)
+
+    def matched(self, primer, position):
+        '''Boolean vector of the sequences matched with at most max_mismatches mismatches (memoised).'''
+        key = (primer, position)
+        if key not in self.matched_cache:
+            self.matched_cache[key] = self.mismatches(primer, position) <= self.max_mismatches
+        return self.matched_cache[key]
+
+    def species(self, matched):
+        '''Taxid indexes of the species having at least one matched sequence.'''
+        return np.unique(self.taxid_index[matched])
+
+    def pair_coverage(self, primer_a, position_a, primer_b, position_b):
+        '''Coverage columns (see COVERAGE_COLUMNS) of a primer pair. A sequence is covered by the pair when both primers match it.'''
+        matched_a = self.matched(primer_a, position_a)
+        matched_b = self.matched(primer_b, position_b)
+        matched_pair = matched_a & matched_b
+        species_pair = self.species(matched_pair)
+        species_total = len(self.taxid_names)
+        return [
+            int(matched_a.sum()),
+            int(matched_b.sum()),
+            int(matched_pair.sum()),
+            len(self.species(matched_a)),
+            len(self.species(matched_b)),
+            len(species_pair),
+            species_total,
+            round(len(species_pair) / species_total * 100, 2) if species_total else 0.0,
+            ','.join(self.taxid_names[species_pair])
+        ]
+
+def find_trimmed_alignment(og_id, alignment_folder):
+    '''Trimmed alignment on which the primer positions were computed: <alignment_folder>/trimmed_<OG>_*.fna'''
+    alignment_files = sorted(glob.glob(os.path.join(alignment_folder, f"trimmed_{og_id}_*.fna")))
+    return alignment_files[0] if alignment_files else None
+
+def add_coverage(tsv_file, alignment_folder, max_mismatches):
+    '''
+    Add the coverage columns to a primer pair table and sort it by number of covered species.
+
+    Returns:
+    str: path of the <name>_coverage.tsv file written.
+    '''
+    with open(tsv_file, 'r') as f:
+        header = f.readline().rstrip('\n').split('\t')
+        rows = [line.rstrip('\n').split('\t') for line in f if line.strip()]
+
+    og_id_idx = header.index('OG_ID')
+    primer_a_idx = header.index('Primer_A')
+    position_a_idx = header.index('Position_A')
+    primer_b_idx = header.index('Primer_B')
+    position_b_idx = header.index('Position_B')
+
+    coverages = {}
+    annotated_rows = []
+    for row in rows:
+        og_id = row[og_id_idx].split('_')[0]
+        if og_id not in coverages:
+            alignment_file = find_trimmed_alignment(og_id, alignment_folder)
+            coverages[og_id] = AlignmentCoverage(alignment_file, max_mismatches) if alignment_file else None
+            if alignment_file is None:
+                print(f"Trimmed alignment for {og_id} not found. Skipping...")
+        coverage = coverages[og_id]
+        if coverage is None:
+            annotated_rows.append(row + [''] * len(COVERAGE_COLUMNS))
+            continue
+        annotated_rows.append(row + [str(value) for value in coverage.pair_coverage(
+            row[primer_a_idx], int(row[position_a_idx]), row[primer_b_idx], int(row[position_b_idx]))])
+
+    species_pair_idx = len(header) + COVERAGE_COLUMNS.index("Species_pair")
+    annotated_rows.sort(key=lambda row: int(row[species_pair_idx]) if row[species_pair_idx] else -1, reverse=True)
+
+    output_file = tsv_file.replace('.tsv', '_coverage.tsv')
+    with open(output_file, 'w') as out_file:
+        out_file.write('\t'.join(header + COVERAGE_COLUMNS) + '\n')
+        for row in annotated_rows:
+            out_file.write('\t'.join(row) + '\n')
+    return output_file
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="""Sequence and species coverage of primer pairs computed on the trimmed alignments, to rank pairs before ecoPCR.
+
+Each primer is compared, at its position (0-based, as written by degeprime_sweep.py), to every sequence of the trimmed alignment
+of its OG. A sequence is matched when it has at most -k mismatches (IUPAC-aware). Species are the taxids of the step 3 FASTA headers.
+Columns added to the table, which is sorted by Species_pair:
+    - Matching_seq_A / Matching_seq_B: Number of sequences matched by the forward / reverse primer
+    - Matching_seq_pair: Number of sequences matched by both primers
+    - Species_A / Species_B: Number of species with at least one sequence matched by the forward / reverse primer
+    - Species_pair: Number of species with at least one sequence matched by both primers
+    - Species_total: Number of species in the alignment
+    - Percentage_species_pair: Species_pair / Species_total
+    - Taxids_pair: Taxids of the species covered by the pair""", formatter_class=argparse.RawTextHelpFormatter,
+    epilog="Exemple: python primer_coverage.py -i sorted_results.tsv -f alignment/ -k 1")
+    parser.add_argument("-i", "--input_files", nargs='+', required=True, help="Primer pair tables (couple_primer.py output or sorted_results.tsv)")
+    parser.add_argument("-f", "--alignment_folder", required=True, help="Folder containing the trimmed alignments (trimmed_<OG>*.fna)")
+    parser.add_argument("-k", "--max_mismatches", type=int, default=0, help="Maximum number of mismatches between a primer and a sequence")
+    args = parser.parse_args()
+
+    for tsv_file in args.input_files:
+        try:
+            output_file = add_coverage(tsv_file, args.alignment_folder, args.max_mismatches)
+            print(f"Results written to {output_file}")
+        except Exception as e:
+            print(f"An error occurred while processing {tsv_file}: {e}")
+
+if __name__ == "__main__":
+    main()
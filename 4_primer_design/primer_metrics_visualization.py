@@ -3,6 +3,9 @@
 import pandas as pd
 import json
 import argparse
+import glob
+import os
+from trim_alignment import read_position_map
 
 __author__ = 'Gabryelle Agoutin - INRAE'
 __copyright__ = 'Copyright (C) 2024 INRAE'
@@ -16,6 +19,11 @@ def read_primers_from_table(filename):
     df = pd.read_csv(filename, delimiter='\t')
     return df
 
+def find_position_map(og_id, position_map_dir):
+    '''Return the position map (trimmed -> alignment column) written by trim_alignment.py for an OG, or None.'''
+    map_files = glob.glob(os.path.join(position_map_dir, f"trimmed_{og_id}_*.map.tsv"))
+    return read_position_map(map_files[0]) if map_files else None
+
 def generate_split_yaxis_highcharts_script(primers_A, primers_B, chart_id_prefix, title):
     letter_mapping = {
         'A': 1, 'C': 1, 'G': 1, 'T': 1,
@@ -277,6 +285,7 @@ if __name__ == "__main__":
 
     parser.add_argument('-i', '--input', required=True, help="Path to input file. This is the array of primers with selected pairs (sorted_results.tsv).")
     parser.add_argument('-o', '--output', required=True, help="Output HTML file name.")
+    parser.add_argument('-m', '--position_map_dir', help="Folder containing the trimmed_<OG>*.map.tsv files of trim_alignment.py (e.g. alignment/). Primer positions are then drawn on the untrimmed alignment.")
 
     args = parser.parse_args()
 
@@ -410,13 +419,19 @@ if __name__ == "__main__":
     for og_id in og_ids:
         og_data = df[df['OG_ID'] == og_id]
         alignment_size = og_data['Alignement_size'].iloc[0]
+        position_map = find_position_map(og_id.split('_')[0], args.position_map_dir) if args.position_map_dir else None
         primers = []
         for i, row in og_data.iterrows():
+            position_A = row['Position_A']
+            position_B = row['Position_B']
+            if position_map is not None:
+                position_A = int(position_map[position_A])
+                position_B = int(position_map[position_B])
             primers.append({
                 'Index': i + 1,
-                'Position_A': row['Position_A'],
+                'Position_A': position_A,
                 'Primer_Size_A': row['Primer_Size_A'],
-                'Position_B': row['Position_B'],
+                'Position_B': position_B,
                 'Primer_Size_B': row['Primer_Size_B']
             })
         xrange_scripts += generate_xrange_chart_script(og_id, alignment_size, primers, primer_colors) + "\n"
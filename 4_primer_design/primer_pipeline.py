@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from align_scheduler import fasta_size, job_threads, startable_jobs
+from degeprime_sweep import DEGENERACIES, LENGTHS, process_alignment
+from trim_alignment import trim_alignment, get_trimmed_name
+from process_primers_stat import read_og_info, process_rows, stream_degeprime_rows, write_output_table
+import couple_primer
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+ALIGNMENT_DIR = 'alignment'
+DEGEPRIME_DIR = 'degeprime_result'
+STAT_DIR = 'result_stat_primers'
+
+
+##################################################################################################################################################
+#
+# TASKS
+#
+##################################################################################################################################################
+
+class Task:
+    '''
+    One step of the pipeline for one OG.
+
+    Like make, a task is skipped when all its outputs exist and are newer than all its inputs.
+    threads is the number of cores the task uses, cost the estimated cost of its OG (see align_scheduler.py).
+    '''
+
+    def __init__(self, name, function, args, inputs, outputs, dependencies=(), threads=1, cost=0):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.inputs = inputs
+        self.outputs = outputs
+        self.dependencies = list(dependencies)
+        self.threads = threads
+        self.cost = cost
+
+    def is_up_to_date(self):
+        if not all(os.path.exists(output) for output in self.outputs):
+            return False
+        inputs = [path for path in self.inputs if os.path.exists(path)]
+        if not inputs:
+            return True
+        return min(os.path.getmtime(output) for output in self.outputs) >= max(os.path.getmtime(path) for path in inputs)
+
+def run_task(function, args):
+    '''Run a task function and return its wall time.'''
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+def align_fasta(fasta_file, alignment_file, threads):
+    subprocess.run(["clustalo", "-i", fasta_file, "-o", alignment_file, f"--threads={threads}", "--force"], check=True)
+
+def run_degeprime_perl(trimmed_file, output_files, degeneracies, lengths):
+    '''DegePrime.pl run for each (degeneracy, length), as in the sarray of the shell pipeline.'''
+    for (d, l), output_file in zip(((d, l) for d in degeneracies for l in lengths), output_files):
+        subprocess.run(["perl", "DEGEPRIME/DegePrime.pl", "-i", trimmed_file, "-d", str(d), "-l", str(l), "-o", output_file], check=True)
+
+def run_primer_stat(og_id, degeprime_files, og_info, stat_file, nm_threshold, tm_max_threshold, tm_min_threshold):
+    files = [(path, str(d), str(l)) for path, d, l in degeprime_files]
+    results = process_rows(stream_degeprime_rows(files), og_id, og_info, nm_threshold, tm_max_threshold, tm_min_threshold)
+    write_output_table(results, stat_file)
+
+def concatenate_sort_results(couple_files, sorted_results_file, top_scores=3):
+    '''
+    Concatenate the pair tables and keep the pairs with the top_scores highest Total_score values, sorted by decreasing score
+    (step 9 of primer_pipeline.sh).
+    '''
+    header = None
+    rows = []
+    for couple_file in couple_files:
+        if not os.path.exists(couple_file) or os.path.getsize(couple_file) == 0:
+            continue
+        with open(couple_file, 'r') as f:
+            header = f.readline()
+            rows.extend(line for line in f if line.strip())
+    if header is None:
+        open(sorted_results_file, 'w').close()
+        return
+    score_idx = header.rstrip('\n').split('\t').index('Total_score')
+    rows.sort(key=lambda row: float(row.split('\t')[score_idx]), reverse=True)
+    best_scores = sorted({float(row.split('\t')[score_idx]) for row in rows}, reverse=True)[:top_scores]
+    with open(sorted_results_file, 'w') as out_file:
+        out_file.write(header)
+        for row in rows:
+            if float(row.split('\t')[score_idx]) in best_scores:
+                out_file.write(row)
+
+def build_og_tasks(fasta_file, args, og_info, clustalo_threads, cost=0):
+    '''Chain of tasks of one OG: alignment -> trimming -> DegePrime -> primer statistics -> primer pairs.'''
+    name = os.path.splitext(os.path.basename(fasta_file))[0]
+    og_id = name.split('_')[0]
+    alignment_file = os.path.join(ALIGNMENT_DIR, name + '.fa')
+    trimmed_name = get_trimmed_name(alignment_file)
+    trimmed_file = os.path.join(ALIGNMENT_DIR, trimmed_name + '.fna')
+    map_file = os.path.join(ALIGNMENT_DIR, trimmed_name + '.map.tsv')
+    degeprime_files = [(os.path.join(DEGEPRIME_DIR, f"{name}_d{d}_l{l}.tsv"), d, l) for d in args.degeneracies for l in args.lengths]
+    degeprime_paths = [path for path, _, _ in degeprime_files]
+    stat_file = os.path.join(STAT_DIR, f"concatenated_{og_id}_stat_primer.tsv")
+    couple_file = stat_file.replace('.tsv', '_couple.tsv')
+
+    align = Task(f"{og_id}:align", align_fasta, (fasta_file, alignment_file, clustalo_threads), [fasta_file], [alignment_file],
+                 threads=clustalo_threads)
+    trim = Task(f"{og_id}:trim", trim_alignment, (alignment_file, ALIGNMENT_DIR, args.min_occupancy), [alignment_file], [trimmed_file, map_file], [align])
+    if args.degeprime_engine == 'perl':
+        degeprime = Task(f"{og_id}:degeprime", run_degeprime_perl, (trimmed_file, degeprime_paths, args.degeneracies, args.lengths),
+                         [trimmed_file], degeprime_paths, [trim])
+    else:
+        degeprime = Task(f"{og_id}:degeprime", process_alignment, (trimmed_file, DEGEPRIME_DIR, args.degeneracies, args.lengths, True),
+                         [trimmed_file], degeprime_paths, [trim])
+    stat = Task(f"{og_id}:stat", run_primer_stat, (og_id, degeprime_files, og_info, stat_file, args.nm_threshold, args.tm_max_threshold, args.tm_min_threshold),
+                degeprime_paths + [args.og_file], [stat_file], [degeprime])
+    couple = Task(f"{og_id}:couple", couple_primer.process_files, ([stat_file], ALIGNMENT_DIR, args.amplicon_min_size, args.amplicon_max_size,
+                                                                   args.max_tm_delta, args.max_3prime_complementarity, False),
+                  [stat_file, alignment_file], [couple_file], [stat])
+    for task in (align, trim, degeprime, stat, couple):
+        task.cost = cost
+    return [align, trim, degeprime, stat, couple]
+
+##################################################################################################################################################
+#
+# BACKENDS
+#
+##################################################################################################################################################
+
+def run_local(tasks, threads, force):
+    '''
+    Run the tasks in a process pool as soon as their dependencies are done, without using more than threads cores.
+
+    The OGs are not synchronised: the next task of an OG is submitted as soon as its previous one
+    finishes, so one OG can be in DegePrime while another is still aligning. As in align_scheduler.py,
+    the ready tasks are started by decreasing cost of their OG (largest first), each one whose threads
+    fit in the free cores (an alignment uses its clustalo threads, the other steps one core). Tasks whose
+    inputs are older than their outputs are skipped, and the tasks depending on a failed task are not run.
+
+    Returns:
+    list: names of the failed tasks.
+    '''
+    done = set()
+    failed = []
+    waiting = sorted(tasks, key=lambda task: task.cost, reverse=True)
+    checked = set()
+    running = {}
+    free_cores = threads
+
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        while waiting or running:
+            ready = True
+            while ready:
+                ready = False
+                for task in list(waiting):
+                    if any(dependency.name in failed for dependency in task.dependencies):
+                        waiting.remove(task)
+                        ready = True
+                        failed.append(task.name)
+                        print(f"{task.name}: not run, a previous step failed")
+                    elif task.name not in checked and all(dependency.name in done for dependency in task.dependencies):
+                        checked.add(task.name)
+                        if not force and task.is_up_to_date():
+                            waiting.remove(task)
+                            print(f"{task.name}: up to date, skipped")
+                            done.add(task.name)
+                            ready = True
+            for task in startable_jobs([task for task in waiting if task.name in checked], free_cores, lambda task: task.threads):
+                waiting.remove(task)
+                free_cores -= task.threads
+                running[executor.submit(run_task, task.function, task.args)] = task
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                free_cores += task.threads
+                try:
+                    print(f"{task.name}: done in {future.result():.1f} s")
+                    done.add(task.name)
+                except Exception as e:
+                    print(f"{task.name}: an error occurred: {e}")
+                    failed.append(task.name)
+    return failed
+
+def per_og_command(fasta_file, args):
+    '''Command running the whole chain of one OG with the local backend, for one line of the sarray.'''
+    command = [sys.executable if args.python is None else args.python, os.path.abspath(__file__), "-i", fasta_file, "-og", args.og_file,
+               "-d"] + [str(d) for d in args.degeneracies] + ["-l"] + [str(l) for l in args.lengths] + [
+               "-nm", str(args.nm_threshold), "-tm_max", str(args.tm_max_threshold), "-tm_min", str(args.tm_min_threshold),
+               "-min", str(args.min_occupancy), "--amplicon_min_size", str(args.amplicon_min_size), "--amplicon_max_size", str(args.amplicon_max_size),
+               "--max_tm_delta", str(args.max_tm_delta), "--max_3prime_complementarity", str(args.max_3prime_complementarity),
+               "--clustalo_threads", str(args.clustalo_threads or 4), "--degeprime_engine", args.degeprime_engine,
+               "-t", str(args.clustalo_threads or 4), "--no_final"]
+    if args.force:
+        command.append("--force")
+    return ' '.join(shlex.quote(part) for part in command)
+
+def run_slurm(fasta_files, args):
+    '''Submit one sarray task per OG, each running the chain of its OG, and wait for the array to finish.'''
+    with open(args.sarray_file, 'w') as s_array:
+        for fasta_file in fasta_files:
+            s_array.write(args.sarray_prefix + per_og_command(fasta_file, args) + '\n')
+    output = subprocess.run(["sarray", "-J", "primer_pipeline"] + args.sarray_options.split() + [args.sarray_file],
+                            check=True, capture_output=True, text=True).stdout
+    job_id = output.split()[-1]
+    print(f"Submitted batch job {job_id}")
+    while subprocess.run(["squeue", "-j", job_id], capture_output=True).returncode == 0:
+        print("Sarray jobs still running...")
+        time.sleep(60)
+    print("Sarray jobs completed")
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="""Primer design pipeline (steps of primer_pipeline.sh) run OG by OG.
+
+Each OG goes through: clustalo alignment -> trim_alignment.py -> DegePrime (DegePrime.pl, or degeprime_sweep.py with --degeprime_engine sweep)
+-> process_primers_stat.py -> couple_primer.py, then all the pair tables are concatenated into sorted_results.tsv.
+A step is only run when its outputs are missing or older than its inputs, so an interrupted or updated run
+only redoes what changed. With the local backend the OGs progress independently in a process pool; with the
+slurm backend each OG is one task of a sarray and the final concatenation runs when the array is finished.""",
+    formatter_class=argparse.RawTextHelpFormatter,
+    epilog="Exemple: python primer_pipeline.py -i ../3_fasta_recovery/*.fa -og ../3_fasta_recovery/updated_OG_1578_selected.tab -t 8")
+    parser.add_argument("-i", "--input_files", nargs='+', required=True, help="FASTA files of the OGs (3_fasta_recovery/*.fa)")
+    parser.add_argument("-og", "--og_file", required=True, help="Path to the OG information file")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of tasks run in parallel (local backend)")
+    parser.add_argument("--backend", choices=['local', 'slurm'], default='local', help="Run the tasks in a local process pool or as a sarray")
+    parser.add_argument("--force", action="store_true", help="Run every step even when its outputs are up to date")
+    parser.add_argument("--clustalo_threads", type=int, default=None, help="Threads of each clustalo run (default: share of -t in proportion to the size of the OG, see align_scheduler.py). The tasks running together never use more than -t cores")
+    parser.add_argument("-min", "--min_occupancy", type=float, default=0.9, help="Minimum fraction of non-gap characters to keep a column")
+    parser.add_argument("--degeprime_engine", choices=['perl', 'sweep'], default='perl', help="DEGEPRIME/DegePrime.pl (default) or degeprime_sweep.py, a greedy heuristic whose primers can differ from DegePrime.pl")
+    parser.add_argument("-d", "--degeneracies", type=int, nargs='+', default=DEGENERACIES, help="Maximum degeneracies to test")
+    parser.add_argument("-l", "--lengths", type=int, nargs='+', default=LENGTHS, help="Primer lengths to test")
+    parser.add_argument("-nm", "--nm_threshold", type=float, default=80, help="Threshold for percentage NM filtering")
+    parser.add_argument("-tm_max", "--tm_max_threshold", type=float, default=65, help="Threshold for maximum temperature filtering")
+    parser.add_argument("-tm_min", "--tm_min_threshold", type=float, default=54, help="Threshold for minimum temperature filtering")
+    parser.add_argument('--amplicon_min_size', type=int, default=150, help='Minimum size of the amplicon')
+    parser.add_argument('--amplicon_max_size', type=int, default=590, help='Maximum size of the amplicon')
+    parser.add_argument('--max_tm_delta', type=float, default=5, help='Maximum difference between the Tm_NN_min of the two primers')
+    parser.add_argument('--max_3prime_complementarity', type=int, default=3, help="Maximum 3' complementarity score between the two primers")
+    parser.add_argument("-o", "--sorted_results", default="sorted_results.tsv", help="Concatenated pairs with the three best scores")
+    parser.add_argument("--no_final", action="store_true", help="Do not concatenate the pair tables (used by the sarray tasks)")
+    parser.add_argument("--sarray_file", default="primer_pipeline.sarray", help="sarray file written by the slurm backend")
+    parser.add_argument("--sarray_options", default="--mem=50G", help="Options given to sarray")
+    parser.add_argument("--sarray_prefix", default="module load devel/python/Python-3.11.1;", help="Commands run before each sarray task")
+    parser.add_argument("--python", default=None, help="Python executable of the sarray tasks (default: the current one)")
+    args = parser.parse_args()
+
+    for directory in (ALIGNMENT_DIR, DEGEPRIME_DIR, STAT_DIR):
+        os.makedirs(directory, exist_ok=True)
+
+    if args.backend == 'slurm':
+        run_slurm(args.input_files, args)
+        failed = []
+    else:
+        og_info = read_og_info(args.og_file)
+        costs = [n_sequences * mean_length for n_sequences, mean_length in map(fasta_size, args.input_files)]
+        if args.clustalo_threads is None:
+            clustalo_threads = job_threads(costs, args.threads, 4)
+        else:
+            clustalo_threads = [min(args.clustalo_threads, args.threads)] * len(args.input_files)
+        tasks = [task for fasta_file, threads, cost in zip(args.input_files, clustalo_threads, costs)
+                 for task in build_og_tasks(fasta_file, args, og_info, threads, cost)]
+        failed = run_local(tasks, args.threads, args.force)
+
+    if not args.no_final:
+        couple_files = sorted(os.path.join(STAT_DIR, file_name) for file_name in os.listdir(STAT_DIR) if file_name.endswith('_primer_couple.tsv'))
+        concatenate_sort_results(couple_files, args.sorted_results)
+        print(f"Results written to {args.sorted_results}")
+    if failed:
+        print(f"{len(failed)} steps failed or were not run: {', '.join(failed)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -8,25 +8,18 @@
 
 # Load necessary modules
 module load bioinfo/ClustalOmega/1.2.4
+module load devel/python/Python-3.11.1
 
 # Step 1: Alignment with clustalOmega
 echo "Starting Step 1: Alignment"
 mkdir -p alignment/
 
-for fichier in ../3_fasta_recovery/*.fa; do
-    nom_fichier=$(basename "$fichier")
-    echo "Aligning $fichier"
-    clustalo -i "$fichier" -o "alignment/$nom_fichier" --threads=4 --force
-done
+python align_scheduler.py -i ../3_fasta_recovery/*.fa -o alignment -c 3 -m 4
 echo "Step 1 completed"
 
 # Step 2: Trimming alignments
 echo "Starting Step 2: Trimming alignments"
-for fichier in alignment/*.fa; do
-    nom_fichier=$(basename "$fichier" .fa)
-    echo "Trimming $fichier"
-    perl DEGEPRIME/TrimAlignment.pl -i "$fichier" -min 0.9 -o "alignment/trimmed_$nom_fichier.fna"
-done
+python trim_alignment.py -i alignment/*.fa -min 0.9 -o alignment -t 3
 echo "Step 2 completed"
 
 mkdir -p degeprime_result/
@@ -76,46 +69,16 @@ while squeue -j $job_id > /dev/null 2>&1; do
 done
 echo "Sarray jobs completed"
 
-# Step 5: Concatenate results
-echo "Starting Step 5: Concatenating results"
+# Step 5: Check DegePrime results
+# process_primers_stat.py groups the degeprime_result/<OG>_d*_l*.tsv files by OG itself, no concatenation is needed
+echo "Starting Step 5: Checking DegePrime results"
 directory="degeprime_result"
-ls -l "$directory"
 
 # Verify files existence before proceeding
 if [ $(ls -1 "$directory"/*.tsv 2>/dev/null | wc -l) -eq 0 ]; then
     echo "No .tsv files found in $directory"
     exit 1
 fi
-
-# Retrieve file prefixes
-prefixes=$(ls -1 "$directory" | grep -E ".*\.tsv$" | cut -d'_' -f1 | sort | uniq)
-echo "Prefixes: $prefixes"
-
-# Check if prefixes is empty
-if [ -z "$prefixes" ]; then
-    echo "Error: No prefixes found"
-    exit 1
-fi
-
-# Loop through each prefix
-for prefix in $prefixes; do
-    echo "Processing prefix: $prefix"
-    # Concatenate all files with the same prefix
-    files=$(ls -1 "$directory"/"$prefix"* 2>/dev/null | grep -E ".*\.tsv$")
-    echo "Files for prefix $prefix: $files"
-    if [ ! -z "$files" ]; then
-        echo "Concatenating files for prefix $prefix"
-        concatenated_file="$directory/concatenated_$prefix.tsv"
-        # Concatenate all files, removing the header except for the first file
-        cat $(echo "$files" | head -n1) > "$concatenated_file"
-        for file in $(echo "$files" | tail -n+2); do
-            tail -n +2 "$file" >> "$concatenated_file"
-        done
-    else
-        echo "No files found for prefix $prefix"
-    fi
-done
-
 echo "Step 5 completed"
 
 # Step 6: Process Primers Stat
@@ -131,7 +94,7 @@ sbatch --wait <<-EOF
 #SBATCH -c 3
 #SBATCH --mail-type=BEGIN,END,FAIL
 module load devel/python/Python-3.11.1
-python process_primers_stat.py -i degeprime_result/concatenated_* -og ../3_fasta_recovery/updated_OG_1760_selected.tab -o result_stat_primers -nm 80 -tm_max 65 -tm_min 54
+python process_primers_stat.py -i degeprime_result/ -og ../3_fasta_recovery/updated_OG_1760_selected.tab -o result_stat_primers -nm 80 -tm_max 65 -tm_min 54
 EOF
 echo "Step 6 completed"
 
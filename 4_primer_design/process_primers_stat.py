@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 import argparse
-from Bio.Seq import Seq
+import glob
+import re
 from Bio.SeqUtils import MeltingTemp as mt, GC123
 import csv
 import os
+import numpy as np
+from nearest_neighbor_tm import nn_tm_ranges
 
 __author__ = 'Gabryelle Agoutin - INRAE'
 __copyright__ = 'Copyright (C) 2024 INRAE'
@@ -25,11 +28,64 @@ def process_file_tsv(file_path):
         for line in reader:
             yield line
 
+DEGEPRIME_PARAMETERS = re.compile(r'_d(\d+)_l(\d+)\.tsv$')
+
+def expand_input_paths(input_paths):
+    '''
+    Function to list the DegePrime result files given as files, directories or glob patterns.
+    A directory gives its <OG>_d*_l*.tsv files, or its .tsv files when there are none.
+    '''
+    files = []
+    for input_path in input_paths:
+        if os.path.isdir(input_path):
+            files.extend(sorted(glob.glob(os.path.join(input_path, '*_d*_l*.tsv'))) or sorted(glob.glob(os.path.join(input_path, '*.tsv'))))
+        elif glob.has_magic(input_path):
+            files.extend(sorted(glob.glob(input_path)))
+        else:
+            validate_file_exists(input_path)
+            files.append(input_path)
+    return files
+
+def group_files_by_og(files):
+    '''
+    Function to group DegePrime result files by OG.
+    concatenated_<OG>.tsv gives <OG>, <OG>_fasta_d<d>_l<l>.tsv gives <OG> with its parameters d and l ('NA' when unknown).
+    '''
+    groups = {}
+    for file_path in files:
+        file_name = os.path.basename(file_path)
+        if file_name.startswith('concatenated_'):
+            og_id = file_name.split('_')[1].split('.')[0]
+        else:
+            og_id = file_name.split('_')[0]
+        parameters = DEGEPRIME_PARAMETERS.search(file_name)
+        degeneracy, length = parameters.groups() if parameters else ('NA', 'NA')
+        groups.setdefault(og_id, []).append((file_path, degeneracy, length))
+    return groups
+
+def stream_degeprime_rows(files):
+    '''
+    Function to yield the rows of several DegePrime result files, skipping each header and adding the d and l parameters of the file.
+    Files without parameters in their name keep the d and l columns of their rows when they have them (degeprime_sweep.py concatenated_<OG>.tsv).
+    '''
+    for file_path, degeneracy, length in files:
+        for line in process_file_tsv(file_path):
+            if degeneracy == 'NA' and len(line) >= 9:
+                yield line[:9]
+            else:
+                yield line[:7] + [degeneracy, length]
+
+# Base classes shared by the per-primer functions and the lookup tables of the feature engine
+BASE_DEG_GC = {'G': 1, 'C': 1, 'S': 1, 'R': 0.5, 'Y': 0.5, 'K': 0.5, 'M': 0.5, 'B': 0.667, 'V': 0.667, 'D': 0.333, 'H': 0.333, 'N': 0.5}
+BASES_GC_MAX = {'G', 'C', 'R', 'Y', 'S', 'K', 'M', 'B', 'V', 'D', 'H', 'N'}
+BASES_GC_MIN = {'G', 'C', 'S'}
+# W and R are counted on the GC side of Tm_mini, as they always have been
+BASES_AT_TM_MIN = {'A', 'T', 'Y', 'K', 'M', 'B', 'V', 'D', 'H', 'N'}
+COMPLEMENT_TABLE = str.maketrans('ACGTRYKMSWBDHVN', 'TGCAYRMKSWVHDBN')
+
 def calculate_gc_percentage_with_degeneracy(sequence):
     '''Function to calculate GC percentage considering base degeneracy'''
-    base_deg = {'G': 1, 'C': 1, 'S': 1, 'R': 0.5, 'Y': 0.5, 'K': 0.5, 'M': 0.5, 'B': 0.667, 'V': 0.667, 'D': 0.333, 'H': 0.333, 'N': 0.5}
-
-    gc_count = sum(base_deg.get(base, 0) for base in sequence)
+    gc_count = sum(BASE_DEG_GC.get(base, 0) for base in sequence)
     total_bases = len(sequence)
 
     gc_percentage = gc_count / total_bases if total_bases > 0 else 0.0
@@ -37,9 +93,7 @@ def calculate_gc_percentage_with_degeneracy(sequence):
 
 def calculate_gc_percentage_max(sequence):
     '''Function to calculate maximum GC percentage'''
-    allowed_bases = {'G', 'C', 'R', 'Y', 'S', 'K', 'M', 'B', 'V', 'D', 'H', 'N'}
-
-    gc_count = sum(1 for base in sequence if base in allowed_bases)
+    gc_count = sum(1 for base in sequence if base in BASES_GC_MAX)
     total_bases = len(sequence)
 
     gc_percentage = gc_count / total_bases if total_bases > 0 else 0.0
@@ -47,7 +101,7 @@ def calculate_gc_percentage_max(sequence):
 
 def calculate_gc_percentage_min(sequence):
     '''Function to calculate minimum GC percentage'''
-    gc_count = sum(1 for base in sequence if base in {'G', 'C', 'S'})
+    gc_count = sum(1 for base in sequence if base in BASES_GC_MIN)
     total_bases = len(sequence)
 
     gc_percentage = gc_count / total_bases if total_bases > 0 else 0.0
@@ -97,15 +151,14 @@ def ends_with_t(sequence):
 
 def self_complementarity(sequence):
     '''Function to check if the sequence is self-complementary'''
-    return sequence == sequence.reverse_complement()
+    return str(sequence) == str(sequence).translate(COMPLEMENT_TABLE)[::-1]
 
 def Tm_maxi(sequence):
     tm = 0 
     nuc_GC = 0
     nuc_AT = 0
-    bases_GC = {'G', 'C', 'R', 'Y', 'S', 'K', 'M', 'B', 'V', 'D', 'H', 'N'}
     for base in sequence:
-        if base in bases_GC:
+        if base in BASES_GC_MAX:
             nuc_GC += 1
         else:
             nuc_AT +=1        
@@ -116,81 +169,168 @@ def Tm_mini(sequence):
     tm = 0 
     nuc_GC = 0
     nuc_AT = 0
-    bases_AT = {'A', 'T','W' 'R', 'Y', 'K', 'M', 'B', 'V', 'D', 'H', 'N'}
     for base in sequence:
-        if base in bases_AT:
+        if base in BASES_AT_TM_MIN:
             nuc_AT += 1
         else:
             nuc_GC +=1        
     tm = float(2*(nuc_AT)+4*(nuc_GC))
     return(tm)
 
-def process_line(columns, og_id, og_info, nm_threshold, tm_max_threshold, tm_min_threshold):
-    '''Function to process a line and extract features'''
-    position = columns[0]
-    primer = Seq(columns[5])
-    primer_size = len(primer)
-    number_matching = int(columns[6])
-    degenerescence = int(columns[4])
-    tm_max = Tm_maxi(primer)
-    tm_min = Tm_mini(primer)
-    gc_percentage = calculate_gc_percentage_with_degeneracy(primer)
-    gc_percentage_max = calculate_gc_percentage_max(primer)
-    gc_percentage_min = calculate_gc_percentage_min(primer)
-    gc_in_last_thirty_percent = count_gc_in_last_thirty_percent(primer)
-    ends_with_t_flag = ends_with_t(primer)
-    self_complementarity_flag = self_complementarity(primer)
-    gc_clamp_flag = has_single_gc_clamp(primer)
-    og_id= str(og_id) # sinon j'ai erreur : invalid literal for int() with base 10: '72971at1578'
+def build_lookup_table(base_value, dtype):
+    '''Build a 256-entry table giving, for each byte, the value of the corresponding base'''
+    table = np.zeros(256, dtype=dtype)
+    for code in range(1, 256):
+        table[code] = base_value(chr(code))
+    return table
+
+# Per-byte tables derived from the scalar functions above, so that the engine gives the same values
+TM_MAX_TABLE = build_lookup_table(Tm_maxi, np.int64)
+TM_MIN_TABLE = build_lookup_table(Tm_mini, np.int64)
+GC_DEG_TABLE = build_lookup_table(lambda base: BASE_DEG_GC.get(base, 0), np.float64)
+GC_MAX_TABLE = build_lookup_table(lambda base: base in BASES_GC_MAX, np.int64)
+GC_MIN_TABLE = build_lookup_table(lambda base: base in BASES_GC_MIN, np.int64)
+GC_STRICT_TABLE = build_lookup_table(lambda base: base in {'G', 'C'}, np.int64)
+T_TABLE = build_lookup_table(lambda base: base == 'T', np.bool_)
+
+def encode_primers(primers):
+    '''Encode a list of primers as a zero-padded uint8 matrix and return it with the primer lengths'''
+    lengths = np.fromiter((len(primer) for primer in primers), dtype=np.int64, count=len(primers))
+    width = max(int(lengths.max()) if len(primers) else 0, 1)
+    matrix = np.zeros((len(primers), width), dtype=np.uint8)
+    for i, primer in enumerate(primers):
+        matrix[i, :lengths[i]] = np.frombuffer(primer.encode('ascii'), dtype=np.uint8)
+    return matrix, lengths
+
+def compute_tm_features(matrix, lengths):
+    '''Compute Tm_max and Tm_min of every encoded primer. Padding bytes are ignored.'''
+    valid = np.arange(matrix.shape[1]) < lengths[:, None]
+    tm_max = np.where(valid, TM_MAX_TABLE[matrix], 0).sum(axis=1)
+    tm_min = np.where(valid, TM_MIN_TABLE[matrix], 0).sum(axis=1)
+    return tm_max.astype(np.float64), tm_min.astype(np.float64)
+
+def compute_gc_features(primers, matrix, lengths):
+    '''Compute the GC features of every encoded primer and return one dictionary per primer'''
+    columns = np.arange(matrix.shape[1])
+    valid = columns < lengths[:, None]
+    # Sequential accumulation keeps the float sum identical to calculate_gc_percentage_with_degeneracy
+    gc_deg = np.cumsum(np.where(valid, GC_DEG_TABLE[matrix], 0.0), axis=1)[:, -1]
+    gc_max = np.where(valid, GC_MAX_TABLE[matrix], 0).sum(axis=1)
+    gc_min = np.where(valid, GC_MIN_TABLE[matrix], 0).sum(axis=1)
+    thirty_percent_length = (lengths * 0.3).astype(np.int64)
+    thirty_percent_start = np.where(thirty_percent_length > 0, lengths - thirty_percent_length, 0)
+    in_last_thirty = valid & (columns >= thirty_percent_start[:, None])
+    gc_last_thirty = np.where(in_last_thirty, GC_STRICT_TABLE[matrix], 0).sum(axis=1)
+    in_clamp = valid & (columns >= np.maximum(lengths - 5, 0)[:, None])
+    gc_clamp = np.where(in_clamp, GC_MIN_TABLE[matrix], 0).any(axis=1)
+    ends_t = T_TABLE[matrix[np.arange(len(primers)), np.maximum(lengths - 1, 0)]]
+
+    features = []
+    for i, primer in enumerate(primers):
+        total_bases = int(lengths[i])
+        features.append({
+            "GC_percentage_fraction": round((float(gc_deg[i]) / total_bases if total_bases > 0 else 0.0)*100, 2),
+            "GC_percentage_max": round((int(gc_max[i]) / total_bases if total_bases > 0 else 0.0)*100, 2),
+            "GC_percentage_min": round((int(gc_min[i]) / total_bases if total_bases > 0 else 0.0)*100, 2),
+            "GC_in_last_thirty_percent": int(gc_last_thirty[i]),
+            "Ends_with_T": bool(ends_t[i]),
+            "Self_Complementarity": self_complementarity(primer),
+            "GC_clamp": bool(gc_clamp[i])
+        })
+    return features
+
+def collapse_primer_rows(rows):
+    '''Group DegePrime rows sharing the same (position, primer) and keep the row numbers they come from'''
+    collapsed = {}
+    for row_number, columns in enumerate(rows):
+        collapsed.setdefault((columns[0], columns[5]), []).append(row_number)
+    return collapsed
+
+def process_rows(rows, og_id, og_info, nm_threshold, tm_max_threshold, tm_min_threshold, tm_nn_max_threshold=None, tm_nn_min_threshold=None):
+    '''Function to extract the features of DegePrime rows, computing them once per unique primer.
+    The Tm and NM thresholds are applied before the nearest-neighbour Tm and the GC features are computed.
+    The nearest-neighbour Tm thresholds are optional (None disables them).
+    Rows are returned in their input order.'''
+    rows = list(rows)
+    if not rows:
+        return []
+    og_id = str(og_id) # sinon j'ai erreur : invalid literal for int() with base 10: '72971at1578'
     og_data = og_info.get(og_id, {})
-    number_of_seq = og_data.get("NumberOfSeq", "")
-    percentage_nm = percent_NM(int(number_matching), int(number_of_seq))
-    score_percentage = score_percentage_nm(float(percentage_nm), nm_threshold)
-    
-    if score_percentage == "under_threshold" or tm_max > tm_max_threshold or tm_min < tm_min_threshold:
-        return None
-
-    return {
-        "OG_ID": og_id,
-        "NumberOfSeq": og_data.get("NumberOfSeq", ""),
-        "SpeciesCount": og_data.get("SpeciesCount", ""),
-        "PercentSingleCopy": og_data.get("percent_single_copy", ""),
-        "GeneName": og_data.get("gene_name", ""),
-        "Primer": str(primer),
-        "Position": position,
-        "Primer_Size": primer_size,
-        "Number_matching": number_matching,
-        "Percentage_NM": percentage_nm,
-        "Score_Percentage_NM": score_percentage,
-        "Degenerescence": degenerescence,
-        "Tm_max": tm_max,
-        "Tm_min": tm_min,
-        "GC_percentage_fraction": gc_percentage,
-        "GC_percentage_max": gc_percentage_max,
-        "GC_percentage_min": gc_percentage_min,
-        "GC_in_last_thirty_percent": gc_in_last_thirty_percent,
-        "Ends_with_T": ends_with_t_flag,
-        "Self_Complementarity": self_complementarity_flag,
-        "GC_clamp": gc_clamp_flag
-    }
-
-def process_file(file_path, og_id, og_info, nm_threshold, tm_max_threshold, tm_min_threshold):
-    '''Function to process a TSV file and return a list of processed lines'''
+    number_of_seq = int(og_data.get("NumberOfSeq", ""))
+
+    collapsed = collapse_primer_rows(rows)
+    primer_index = {}
+    for _, primer in collapsed:
+        primer_index.setdefault(primer, len(primer_index))
+    primers = list(primer_index)
+    matrix, lengths = encode_primers(primers)
+    tm_max, tm_min = compute_tm_features(matrix, lengths)
+    tm_ok = (tm_max <= tm_max_threshold) & (tm_min >= tm_min_threshold)
+
+    kept_rows = []
+    for (position, primer), row_numbers in collapsed.items():
+        i = primer_index[primer]
+        if not tm_ok[i]:
+            continue
+        for row_number in row_numbers:
+            columns = rows[row_number]
+            number_matching = int(columns[6])
+            percentage_nm = percent_NM(number_matching, number_of_seq)
+            score_percentage = score_percentage_nm(float(percentage_nm), nm_threshold)
+            if score_percentage == "under_threshold":
+                continue
+            kept_rows.append((row_number, i, number_matching, percentage_nm, score_percentage))
+    kept_rows.sort()
+
+    kept_primers = sorted({i for _, i, _, _, _ in kept_rows})
+    tm_nn_max, tm_nn_min = nn_tm_ranges([primers[i] for i in kept_primers])
+    tm_nn = {i: (float(tm_nn_max[k]), float(tm_nn_min[k])) for k, i in enumerate(kept_primers)}
+    if tm_nn_max_threshold is not None:
+        kept_rows = [kept_row for kept_row in kept_rows if tm_nn[kept_row[1]][0] <= tm_nn_max_threshold]
+    if tm_nn_min_threshold is not None:
+        kept_rows = [kept_row for kept_row in kept_rows if tm_nn[kept_row[1]][1] >= tm_nn_min_threshold]
+    kept_primers = sorted({i for _, i, _, _, _ in kept_rows})
+    kept_position = {i: k for k, i in enumerate(kept_primers)}
+    gc_features = compute_gc_features([primers[i] for i in kept_primers], matrix[kept_primers], lengths[kept_primers])
+
     results = []
-    for line in process_file_tsv(file_path):
-        result = process_line(line, og_id, og_info, nm_threshold, tm_max_threshold, tm_min_threshold)
-        if result:
-            results.append(result)
+    for row_number, i, number_matching, percentage_nm, score_percentage in kept_rows:
+        columns = rows[row_number]
+        result = {
+            "OG_ID": og_id,
+            "NumberOfSeq": og_data.get("NumberOfSeq", ""),
+            "SpeciesCount": og_data.get("SpeciesCount", ""),
+            "PercentSingleCopy": og_data.get("percent_single_copy", ""),
+            "GeneName": og_data.get("gene_name", ""),
+            "Primer": primers[i],
+            "Position": columns[0],
+            "Primer_Size": int(lengths[i]),
+            "Number_matching": number_matching,
+            "Percentage_NM": percentage_nm,
+            "Score_Percentage_NM": score_percentage,
+            "Degenerescence": int(columns[4]),
+            "Tm_max": float(tm_max[i]),
+            "Tm_min": float(tm_min[i]),
+            "Degeprime_d": columns[7] if len(columns) > 7 else 'NA',
+            "Degeprime_l": columns[8] if len(columns) > 8 else 'NA'
+        }
+        result.update(gc_features[kept_position[i]])
+        result["Tm_NN_max"], result["Tm_NN_min"] = tm_nn[i]
+        results.append(result)
     return results
 
+def process_file(file_path, og_id, og_info, nm_threshold, tm_max_threshold, tm_min_threshold, tm_nn_max_threshold=None, tm_nn_min_threshold=None):
+    '''Function to process a TSV file and return a list of processed lines'''
+    return process_rows(process_file_tsv(file_path), og_id, og_info, nm_threshold, tm_max_threshold, tm_min_threshold, tm_nn_max_threshold, tm_nn_min_threshold)
+
 def write_output_table(results, output_file):
     '''Function to write the output table to a file in the current directory'''
     current_directory = os.getcwd()
     output_path = os.path.join(current_directory, output_file)
     with open(output_path, 'w') as out_file:
-        out_file.write("OG_ID\tNumberOfSeq\tSpeciesCount\tPercentSingleCopy\tGeneName\tPrimer\tPosition\tPrimer_Size\tNumber_matching\tPercentage_NM\tScore_Percentage_NM\tDegenerescence\tTm_max\tTm_min\tGC_percentage_fraction\tGC_percentage_max\tGC_percentage_min\tGC_in_last_thirty_percent\tEnds_with_T\tSelf_Complementarity\tGC_clamp\n")
+        out_file.write("OG_ID\tNumberOfSeq\tSpeciesCount\tPercentSingleCopy\tGeneName\tPrimer\tPosition\tPrimer_Size\tNumber_matching\tPercentage_NM\tScore_Percentage_NM\tDegenerescence\tTm_max\tTm_min\tGC_percentage_fraction\tGC_percentage_max\tGC_percentage_min\tGC_in_last_thirty_percent\tEnds_with_T\tSelf_Complementarity\tGC_clamp\tTm_NN_max\tTm_NN_min\tDegeprime_d\tDegeprime_l\n")
         for result in results:
-            out_file.write("\t".join(str(result[key]) for key in ["OG_ID","NumberOfSeq", "SpeciesCount", "PercentSingleCopy", "GeneName", "Primer", "Position", "Primer_Size", "Number_matching","Percentage_NM", "Score_Percentage_NM", "Degenerescence", "Tm_max", "Tm_min", "GC_percentage_fraction","GC_percentage_max", "GC_percentage_min","GC_in_last_thirty_percent", "Ends_with_T", "Self_Complementarity", "GC_clamp"]) + "\n")
+            out_file.write("\t".join(str(result[key]) for key in ["OG_ID","NumberOfSeq", "SpeciesCount", "PercentSingleCopy", "GeneName", "Primer", "Position", "Primer_Size", "Number_matching","Percentage_NM", "Score_Percentage_NM", "Degenerescence", "Tm_max", "Tm_min", "GC_percentage_fraction","GC_percentage_max", "GC_percentage_min","GC_in_last_thirty_percent", "Ends_with_T", "Self_Complementarity", "GC_clamp", "Tm_NN_max", "Tm_NN_min", "Degeprime_d", "Degeprime_l"]) + "\n")
 
 def read_og_info(og_file):
     '''Function to read OG info from a file and store it in a dictionary'''
@@ -236,34 +376,40 @@ Columns in the output file:
     - $18 GC_in_last_thirty_percent: Number of GC bases in the last thirty percent base of the primer.To check GC content at the end of the primer
     - $19 Ends_with_T: Whether the primer ends with 'T'
     - $20 Self_Complementarity: Whether the primer is self-complementary
-    - $21 GC_clamp: Whether the primer has a single GC clamp""", formatter_class=argparse.RawTextHelpFormatter,
-    epilog="Exemple: python process_primers_stat.py -i degeprime_result/concatenated_* -og ../2_search_taxid_and_monocopy_calculation/OG_selected_1578.tab -o result_stat_primers -nm 80 -tm_max 70 -tm_min 50")
-    parser.add_argument("-i", "--input_files", nargs='+', help="Paths to the input TSV files")
+    - $21 GC_clamp: Whether the primer has a single GC clamp
+    - $22 Tm_NN_max: Highest nearest-neighbour Tm (Biopython Tm_NN defaults) over the concrete sequences of the degenerate primer
+    - $23 Tm_NN_min: Lowest nearest-neighbour Tm over the concrete sequences of the degenerate primer
+    - $24 Degeprime_d: DegePrime maximum degeneracy (-d) of the run that gave the primer (NA for concatenated_<OG>.tsv inputs without these columns)
+    - $25 Degeprime_l: DegePrime primer length (-l) of the run that gave the primer
+
+The inputs can be the raw DegePrime results (degeprime_result/<OG>_fasta_d<d>_l<l>.tsv), a directory holding them,
+a quoted glob pattern, or concatenated_<OG>.tsv files. Files are grouped by OG and one concatenated_<OG>_stat_primer.tsv is written per OG.""", formatter_class=argparse.RawTextHelpFormatter,
+    epilog="Exemple: python process_primers_stat.py -i degeprime_result/ -og ../2_search_taxid_and_monocopy_calculation/OG_selected_1578.tab -o result_stat_primers -nm 80 -tm_max 70 -tm_min 50")
+    parser.add_argument("-i", "--input_files", nargs='+', help="DegePrime result files, directories or glob patterns")
     parser.add_argument("-og", "--og_file", help="Path to the OG information file")
     parser.add_argument("-o", "--output_dir", help="Répertoire de sortie pour les fichiers de sortie")
     parser.add_argument("-nm", "--nm_threshold", type=float, default=80, help="Threshold for percentage NM filtering")
     parser.add_argument("-tm_max", "--tm_max_threshold", type=float, default=70, help="Threshold for maximum temperature filtering")
     parser.add_argument("-tm_min", "--tm_min_threshold", type=float, default=50, help="Threshold for minimum temperature filtering")
+    parser.add_argument("-tm_nn_max", "--tm_nn_max_threshold", type=float, default=None, help="Threshold on Tm_NN_max (not applied by default)")
+    parser.add_argument("-tm_nn_min", "--tm_nn_min_threshold", type=float, default=None, help="Threshold on Tm_NN_min (not applied by default)")
     args = parser.parse_args()
 
     og_info = read_og_info(args.og_file)
 
-    for input_file in args.input_files:
-        validate_file_exists(input_file)
+    groups = group_files_by_og(expand_input_paths(args.input_files))
 
+    for og_id, files in groups.items():
         try:
-            # Extract OG ID from filename
-            og_id = os.path.basename(input_file).split('_')[1].split('.')[0]
+            results = process_rows(stream_degeprime_rows(files), og_id, og_info, args.nm_threshold, args.tm_max_threshold, args.tm_min_threshold, args.tm_nn_max_threshold, args.tm_nn_min_threshold)
 
-            results = process_file(input_file, og_id, og_info, args.nm_threshold, args.tm_max_threshold, args.tm_min_threshold)
-            
-            # Create output file name based on input file name
-            output_file = os.path.join(args.output_dir, os.path.basename(os.path.splitext(input_file)[0]) + "_stat_primer.tsv")
+            # One output file per OG, named as for a concatenated_<OG>.tsv input
+            output_file = os.path.join(args.output_dir, f"concatenated_{og_id}_stat_primer.tsv")
             # Write the results to the output file  
             write_output_table(results, output_file)
-            print(f"Results written to {output_file}")
+            print(f"Results written to {output_file} ({len(files)} DegePrime files)")
         except Exception as e:
-            print(f"An error occurred while processing {input_file}: {e}")
+            print(f"An error occurred while processing {og_id}: {e}")
 
 if __name__ == "__main__":
     main()
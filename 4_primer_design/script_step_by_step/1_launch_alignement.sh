@@ -6,12 +6,10 @@
 #SBATCH --mail-type=BEGIN,END,FAIL
 
 module load bioinfo/ClustalOmega/1.2.4
+module load devel/python/Python-3.11.1
 
 mkdir -p alignment/
 
-for files in ../3_fasta_recovery/*.fa; do
-    file_name=$(basename "$fichier")
-    clustalo -i "$files" -o "alignment/$file_name" --threads=4
-done
+python align_scheduler.py -i ../3_fasta_recovery/*.fa -o alignment -c 3 -m 4
 
 
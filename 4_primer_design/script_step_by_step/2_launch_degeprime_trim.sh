@@ -5,7 +5,6 @@
 #SBATCH -c 3
 #SBATCH --mail-type=BEGIN,END,FAIL
 
-for files in alignment/*.fa; do
-    file_name=$(basename "$fichier" .fa)
-    perl DEGEPRIME/TrimAlignment.pl -i "$files" -min 0.9 -o "alignment/trimmed_$file_name.fna"
-done
+module load devel/python/Python-3.11.1
+
+python trim_alignment.py -i alignment/*.fa -min 0.9 -o alignment -t 3
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from alignment_profile import load_profile, read_alignment_fasta
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+def kept_columns(gap_fraction, min_occupancy):
+    '''Indexes of the alignment columns where the fraction of non-gap characters is at least min_occupancy.'''
+    return np.flatnonzero(1.0 - gap_fraction >= min_occupancy)
+
+def get_trimmed_name(alignment_file):
+    '''alignment/<OG>_fasta.fa gives trimmed_<OG>_fasta'''
+    return 'trimmed_' + os.path.splitext(os.path.basename(alignment_file))[0]
+
+def write_position_map(columns, map_file):
+    '''Write the 0-based position of each trimmed column in the original alignment.'''
+    with open(map_file, 'w') as out_file:
+        out_file.write("Trimmed_position\tAlignment_position\n")
+        for trimmed_position, alignment_position in enumerate(columns):
+            out_file.write(f"{trimmed_position}\t{alignment_position}\n")
+
+def read_position_map(map_file):
+    '''Read a position map written by write_position_map into an array indexed by trimmed position.'''
+    with open(map_file, 'r') as in_file:
+        next(in_file)  # Skip header
+        return np.array([int(line.split('\t')[1]) for line in in_file], dtype=np.int64)
+
+def trim_alignment(alignment_file, output_dir, min_occupancy):
+    '''
+    Drop the columns of an alignment whose occupancy is under min_occupancy.
+    The alignment is parsed once; the gap fractions come from its profile cache (see alignment_profile.py),
+    which is built from this parse when it is missing.
+
+    Writes <output_dir>/trimmed_<name>.fna and the position map <output_dir>/trimmed_<name>.map.tsv.
+
+    Returns:
+    tuple: (trimmed alignment path, number of columns kept, number of columns in the alignment)
+    '''
+    alignment = read_alignment_fasta(alignment_file)
+    descriptions, matrix, _ = alignment
+    with load_profile(alignment_file, alignment) as profile:
+        columns = kept_columns(profile['gap_fraction'], min_occupancy)
+        n_columns = int(profile['n_columns'])
+    trimmed = matrix[:, columns]
+
+    trimmed_name = get_trimmed_name(alignment_file)
+    trimmed_file = os.path.join(output_dir, trimmed_name + '.fna')
+    with open(trimmed_file, 'w') as out_file:
+        for description, row in zip(descriptions, trimmed):
+            out_file.write(f">{description}\n")
+            out_file.write(row.tobytes().decode('ascii') + "\n")
+    write_position_map(columns, os.path.join(output_dir, trimmed_name + '.map.tsv'))
+    return trimmed_file, len(columns), n_columns
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="""Trim Clustal Omega alignments before primer design (replaces DEGEPRIME/TrimAlignment.pl).
+
+Columns where the fraction of sequences without gap is under -min are removed. For each alignment the script writes
+trimmed_<name>.fna and trimmed_<name>.map.tsv, which gives for each trimmed column (0-based) its position in the original alignment.""",
+    formatter_class=argparse.RawTextHelpFormatter,
+    epilog="Exemple: python trim_alignment.py -i alignment/*.fa -min 0.9 -o alignment -t 3")
+    parser.add_argument("-i", "--input_files", nargs='+', required=True, help="Aligned FASTA files (alignment/*.fa)")
+    parser.add_argument("-o", "--output_dir", default="alignment", help="Output directory")
+    parser.add_argument("-min", "--min_occupancy", type=float, default=0.9, help="Minimum fraction of non-gap characters to keep a column")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of alignments trimmed in parallel")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=args.threads) as executor:
+        futures = {executor.submit(trim_alignment, alignment_file, args.output_dir, args.min_occupancy): alignment_file
+                   for alignment_file in args.input_files}
+        for future, alignment_file in futures.items():
+            try:
+                trimmed_file, n_kept, n_columns = future.result()
+                print(f"Trimming {alignment_file}: {n_kept}/{n_columns} columns kept in {trimmed_file}")
+            except Exception as e:
+                print(f"An error occurred while trimming {alignment_file}: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import os
+import shlex
+import subprocess
+import time
+from multiprocessing.pool import ThreadPool
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+#script written in python 2.7 to be compatible with EcoPCR in the conda environment
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+def parse_primer_pairs(primer_list):
+    """
+    Primer pairs of the -a option of 1_ecopcr_command.sh: 'F1 R1,F2 R2'
+
+    Returns:
+    list of tuple: (forward primer, reverse primer)
+    """
+    primer_pairs = []
+    for primer_pair in primer_list.split(','):
+        primers = primer_pair.split()
+        if len(primers) != 2:
+            raise ValueError("Incorrect primer pair '{0}': expected a forward and a reverse primer separated by a space".format(primer_pair))
+        primer_pairs.append((primers[0], primers[1]))
+    return primer_pairs
+
+def chunk_size(db_prefix):
+    """Size in bytes of the sequence files (<prefix>_*.sdx) of a database chunk."""
+    return sum(os.path.getsize(sdx_file) for sdx_file in glob.glob(db_prefix + '_*.sdx'))
+
+def plan_tasks(primer_pairs, assembly_dir, output_dir):
+    """
+    One task per (primer pair x .adx chunk), written to <output_dir>/<n>_<F>-<R>/<chunk>.ecopcr as 1_ecopcr_command.sh does.
+
+    Returns:
+    list: one dictionary per task, largest chunks first.
+    """
+    chunks = []
+    for adx_file in glob.glob(os.path.join(assembly_dir, '*.adx')):
+        db_prefix = adx_file[:-len('.adx')]
+        chunks.append((db_prefix, chunk_size(db_prefix)))
+
+    tasks = []
+    for counter, (primer_f, primer_r) in enumerate(primer_pairs, start=1):
+        pair_dir = os.path.join(output_dir, "{0}_{1}-{2}".format(counter, primer_f, primer_r))
+        for db_prefix, size in chunks:
+            tasks.append({
+                'primer_f': primer_f,
+                'primer_r': primer_r,
+                'db_prefix': db_prefix,
+                'sdx_size': size,
+                'output': os.path.join(pair_dir, os.path.basename(db_prefix) + '.ecopcr')
+            })
+    tasks.sort(key=lambda task: task['sdx_size'], reverse=True)
+    return tasks
+
+def run_task(task_and_options):
+    """
+    Run ecoPCR for one primer pair on one chunk, unless its output already exists.
+
+    The output is written to a temporary file and renamed at the end, so an existing output is always
+    complete and an interrupted run can be resumed.
+
+    Returns:
+    dict: the task with its wall time ('wall_time') and status ('done', 'skipped' or 'failed (<return code or error>)')
+    """
+    task, ecopcr_options = task_and_options
+    if os.path.exists(task['output']):
+        task['wall_time'] = 0.0
+        task['status'] = 'skipped'
+        return task
+    command = ["ecoPCR", "-d", task['db_prefix']] + shlex.split(ecopcr_options) + [task['primer_f'], task['primer_r']]
+    tmp_file = task['output'] + '.tmp'
+    start = time.time()
+    try:
+        with open(tmp_file, 'w') as out:
+            return_code = subprocess.call(command, stdout=out)
+    except OSError as e:
+        # ecoPCR missing or not executable: fail this task only, so the other tasks and the report still complete
+        return_code = e
+    task['wall_time'] = time.time() - start
+    if return_code == 0:
+        os.rename(tmp_file, task['output'])
+        task['status'] = 'done'
+    else:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        task['status'] = 'failed ({0})'.format(return_code)
+    print("{0}: {1} in {2:.1f} s".format(task['output'], task['status'], task['wall_time']))
+    return task
+
+def run_tasks(tasks, threads, ecopcr_options=''):
+    """Run the tasks on a pool of threads, in the planned order."""
+    for output_dir in set(os.path.dirname(task['output']) for task in tasks):
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+    pool = ThreadPool(threads)
+    try:
+        return pool.map(run_task, [(task, ecopcr_options) for task in tasks], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def write_report(tasks, report_file):
+    """Wall time of each (primer pair x chunk) task."""
+    with open(report_file, 'w') as out_file:
+        out_file.write("Primer_F\tPrimer_R\tDatabase\tSdx_size\tWall_time_s\tStatus\tOutput\n")
+        for task in tasks:
+            out_file.write("{0}\t{1}\t{2}\t{3}\t{4:.1f}\t{5}\t{6}\n".format(
+                task['primer_f'], task['primer_r'], task['db_prefix'], task['sdx_size'], task['wall_time'], task['status'], task['output']))
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = argparse.ArgumentParser(description="""Run locally the ecoPCR commands of 1_ecopcr_command.sh (one per primer pair x .adx file) on a pool of workers.
+
+The .adx files are processed largest first (size of their .sdx files). The outputs are written to
+<output_dir>/<n>_<F>-<R>/<name>.ecopcr as with the sarray file, through a temporary file, so that a rerun
+skips the outputs already present and only runs the missing ones. The wall time of each task is written to the report file.""",
+    formatter_class=argparse.RawTextHelpFormatter,
+    epilog="Exemple: python ecopcr_local_runner.py -a 'TSRTCAAGAACRTBGARR SAYGTYCTGBACRTCRTC,TSRTCAAGAACRTBGARR AYGTYCTGNACRTCGTCV' -d /BD_TaxonMarker/BD_ecoPCR/ecoPCR_db/assemblies/ -t 8")
+    parser.add_argument("-a", "--primers", required=True, help="Comma-separated list of primer pairs, forward and reverse primers separated by a space")
+    parser.add_argument("-d", "--assembly_dir", required=True, help="Folder containing the .adx files of the ecoPCR database")
+    parser.add_argument("-o", "--output_dir", default="result", help="Output directory")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of ecoPCR commands run at the same time")
+    parser.add_argument("--ecopcr_options", default="", help="Options added to every ecoPCR command, e.g. \"-e 3 -l 50 -L 800\"")
+    parser.add_argument("-r", "--report", default="ecopcr_times.tsv", help="Report of the wall time of each task")
+    args = parser.parse_args()
+
+    tasks = plan_tasks(parse_primer_pairs(args.primers), args.assembly_dir, args.output_dir)
+    if not tasks:
+        print("No .adx file found in {0}".format(args.assembly_dir))
+        return
+    print("{0} ecoPCR tasks on {1} threads".format(len(tasks), args.threads))
+    start = time.time()
+    tasks = run_tasks(tasks, args.threads, args.ecopcr_options)
+    write_report(tasks, args.report)
+    n_done = sum(1 for task in tasks if task['status'] == 'done')
+    n_skipped = sum(1 for task in tasks if task['status'] == 'skipped')
+    print("{0} run, {1} already present, {2} failed in {3:.1f} s. Report written to {4}".format(
+        n_done, n_skipped, len(tasks) - n_done - n_skipped, time.time() - start, args.report))
+
+if __name__ == "__main__":
+    main()
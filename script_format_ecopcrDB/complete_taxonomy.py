@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 
 import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'script_treatment_ecopcr_result'))
+from taxonomy_store import build_store
 
 __author__ = 'Gabryelle Agoutin - INRAE'
 __copyright__ = 'Copyright (C) 2024 INRAE'
@@ -36,8 +41,11 @@ if __name__ == "__main__":
     parser.add_argument('name_seq_file', type=str, help='File containing sequences without taxonomy')
     parser.add_argument('taxo_file', type=str, help='File containing taxonomy information')
     parser.add_argument('output_file', type=str, help='Output file with completed taxonomy')
+    parser.add_argument('-i', '--index', action='store_true', help='Also index the output file by sequence ID (<output_file>.sqlite) for format_ecopcr_result.py and Launch_swarm.py')
 
     args = parser.parse_args()
 
     main(args.name_seq_file, args.taxo_file, args.output_file)
+    if args.index:
+        build_store(args.output_file)
 
@@ -9,7 +9,7 @@ ml devel/Miniconda/Miniconda3
 source $MY_CONDA_PATH
 conda activate TaxonMarker_swarm
 
-python $PATH_TAXONMARKER/script_treatment_ecopcr_result/format_ecopcr_result.py -o analysis_[PRIMER_FOLDER] -t $PATH_BD_ECOPCR/name_seq_with_taxo.txt results/[PRIMER_FOLDER]/*ecopcr
+python $PATH_TAXONMARKER/script_treatment_ecopcr_result/format_ecopcr_result.py -o analysis_[PRIMER_FOLDER] -t $PATH_BD_ECOPCR/name_seq_with_taxo.txt results/[PRIMER_FOLDER]/*ecopcr -p 3
 
 '''
 for example, if there are several files to execute, you can put several commands.
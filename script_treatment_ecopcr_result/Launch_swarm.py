@@ -1,9 +1,12 @@
 #!/usr/bin/env python
 
+import os
 import subprocess
 import argparse
 import logging
-from collections import defaultdict
+from taxonomy_store import TaxonomyStore, split_taxonomy_info
+from lineage_table import LineageTable, TAXONOMY_LEVELS
+import swarm_d1
 
 __author__ = 'Gabryelle Agoutin - INRAE'
 __copyright__ = 'Copyright (C) 2024 INRAE'
@@ -12,18 +15,29 @@ __version__ = '1.0'
 __email__ = 'gabryelle.agoutin@inrae.fr'
 __status__ = 'prod'
 
-def parse_name_seq_with_taxo(taxonomy_file):
-    """Parse the name_seq_with_taxo.txt file to extract taxonomy information."""
-    taxonomy_dict = {}
-    with open(taxonomy_file, 'r') as f:
-        for line in f:
-            if line.startswith(">"):
-                header = line.strip()
-                parts = header[1:].split(" ", 1)
-                seq_id = parts[0].split("|")[0]
-                taxonomy_info = parts[1] if len(parts) > 1 else ""
-                taxonomy_dict[seq_id] = taxonomy_info
-    return taxonomy_dict
+def parse_name_seq_with_taxo(taxonomy_store, clusters):
+    """Taxonomy information of the sequences of the Swarm clusters, looked up in the indexed name_seq_with_taxo.txt file."""
+    seq_ids = set()
+    for cluster_ids in clusters:
+        seq_ids.update(cluster_id.split("|")[0] for cluster_id in cluster_ids)
+    return taxonomy_store.lookup(seq_ids)
+
+def intern_taxonomy(taxonomy_dict, lineage_table):
+    """
+    Parse the taxonomy information of each sequence once.
+
+    Returns:
+    tuple: (seq_id -> row dictionary, taxid of each row, NumPy array of the lineage ID of each row)
+    """
+    seq_rows = {}
+    taxids = []
+    lineages = []
+    for seq_id, info in taxonomy_dict.items():
+        taxid, tax = split_taxonomy_info(info)
+        seq_rows[seq_id] = len(taxids)
+        taxids.append(taxid)
+        lineages.append(tax)
+    return seq_rows, taxids, lineage_table.intern_all(lineages)
     
 def parse_vsearch_clusters(vsearch_cluster_file):
     """Parse the output_vsearch_cluster.txt file to create a mapping of centroids to their sequences."""
@@ -43,12 +57,18 @@ def parse_vsearch_clusters(vsearch_cluster_file):
                 cluster_dict[centroid] = []  # No associated sequences
     return cluster_dict
 
-def augment_swarm_clusters(swarm_file, vsearch_cluster_file, output_swarm_file):
-    """Augment Swarm clusters with sequences from vsearch clusters."""
+def augment_swarm_clusters(swarm_file, vsearch_cluster_file):
+    """
+    Parse the Swarm output once and augment its clusters with sequences from vsearch clusters.
+
+    Returns:
+    list of list: the sorted members (ID|abundance) of each cluster, in the order of the Swarm output.
+    """
     logging.info("Augmenting Swarm clusters with VSEARCH clusters...")
     vsearch_clusters = parse_vsearch_clusters(vsearch_cluster_file)
+    clusters = []
     
-    with open(swarm_file, 'r') as f_in, open(output_swarm_file, 'w') as f_out:
+    with open(swarm_file, 'r') as f_in:
         for line in f_in:
             cluster_sequences = line.strip().split()
             augmented_cluster = set(cluster_sequences)  # Use a set to avoid duplicates
@@ -57,23 +77,31 @@ def augment_swarm_clusters(swarm_file, vsearch_cluster_file, output_swarm_file):
             for seq_full in cluster_sequences:
                 seq_id = seq_full.split("|")[0]  # Extract the part before '|'
                 
-                # Check if this sequence has associated sequences in the VSEARCH clusters
-                if seq_id in vsearch_clusters:
-                    associated_sequences = vsearch_clusters[seq_id]
-                    
-                    # Add associated sequences to the cluster if not already present
-                    for associated_seq in associated_sequences:
-                        augmented_cluster.add(associated_seq + "|_1")
+                # Add the sequences associated in the VSEARCH clusters if not already present
+                for associated_seq in vsearch_clusters.get(seq_id, []):
+                    augmented_cluster.add(associated_seq + "|_1")
             
-            # Write the augmented cluster to the output file
-            f_out.write(' '.join(sorted(augmented_cluster)) + '\n')
+            clusters.append(sorted(augmented_cluster))
     
-    logging.info(f"Augmented Swarm clusters written to {output_swarm_file}")
+    logging.info(f"{len(clusters)} Swarm clusters augmented")
+    return clusters
 
 
 
-def run_swarm(fasta_file, output_file, threads=4, abundance=1, distance=1):
-    """Run Swarm to cluster sequences."""
+def run_swarm(fasta_file, output_file, threads=4, abundance=1, distance=1, engine="swarm"):
+    """
+    Run Swarm to cluster sequences.
+
+    With engine "native", the clustering is done in-process by swarm_d1.py (d = 1 only), with the same
+    options as the swarm command below (-f: fastidious) and the same output format.
+    """
+    if engine == "native":
+        if distance != 1:
+            raise ValueError(f"The native engine only clusters with a distance of 1 (-d {distance} requested), use --engine swarm")
+        logging.info("Running Swarm (native d = 1 engine)...")
+        swarm_d1.cluster_fasta(fasta_file, output_file, threads, abundance, fastidious=True)
+        logging.info(f"Swarm output written to {output_file}")
+        return
     logging.info("Running Swarm...")
     cmd = [
         "swarm",
@@ -86,79 +114,92 @@ def run_swarm(fasta_file, output_file, threads=4, abundance=1, distance=1):
     subprocess.run(cmd, check=True)
     logging.info(f"Swarm output written to {output_file}")
 
-def process_swarm_output(swarm_file, taxonomy_dict, output_info_file):
-    """Process the Swarm output to generate a detailed report."""
+def run_swarm_sharded(fasta_file, output_file, threads=4, abundance=1, distance=1, engine="swarm", shards=2):
+    """
+    Cluster on length bands concurrently, with the same result as a single run.
+
+    With d = 1, amplicons one difference apart differ in length by at most one. The lengths are split into
+    shards bands of consecutive lengths of similar cost; each band also reads the amplicons of the next length,
+    so the edges crossing its border are found in it. The edges of the bands are searched concurrently by the
+    native engine (swarm_d1.py, -t processes), then the swarms are grown once, in seed order, on the stitched
+    graph and the light swarms are grafted as in a single run.
+    """
+    if distance != 1:
+        raise ValueError(f"Length-band shards need a distance of 1 (-d {distance} requested)")
+    if engine != "native":
+        logging.info("Length-band shards are clustered by the native d = 1 engine (swarm_d1.py)")
+    logging.info(f"Running Swarm (native d = 1 engine, {shards} length bands)...")
+    swarm_d1.cluster_fasta(fasta_file, output_file, threads, abundance, fastidious=True, bands=shards)
+    logging.info(f"Swarm output written to {output_file}")
+
+def write_swarm_reports(clusters, sequence_taxonomy, lineage_table, augmented_swarm_file, output_info_file,
+                        output_info_file_html=None, cluster_table_file=None):
+    """
+    Write, in a single pass over the clusters, the augmented Swarm file, the detailed report and optionally
+    the HTML report and the cluster table.
+
+    The cluster table is a TSV file (cluster_id, seq_id, taxid, lineage_id) with one line per sequence;
+    the lineage of each lineage_id is written to <cluster_table_file>_lineages.tsv.
+    sequence_taxonomy: see intern_taxonomy.
+    """
     logging.info("Processing Swarm output...")
-    with open(swarm_file, 'r') as clusters_file, open(output_info_file, 'w') as out_file:
-        clusters = clusters_file.readlines()
-        for i, cluster in enumerate(clusters, start=1):
-            cluster_ids = cluster.strip().split()
+    seq_rows, taxids, lineage_ids = sequence_taxonomy
+    with open(augmented_swarm_file, 'w') as swarm_out, open(output_info_file, 'w') as out_file, \
+         open(output_info_file_html or os.devnull, 'w') as html_file, open(cluster_table_file or os.devnull, 'w') as table_file:
+        html_file.write("<html><body>\n")
+        table_file.write("cluster_id\tseq_id\ttaxid\tlineage_id\n")
+        for i, cluster_ids in enumerate(clusters, start=1):
+            swarm_out.write(' '.join(cluster_ids) + '\n')
             out_file.write(f"Cluster {i}:\n")
+            html_file.write(f"<h2>Cluster {i}:</h2>\n<ul>\n")
             for cluster_id in cluster_ids:
                 seq_id = cluster_id.split("|")[0]
-                if seq_id in taxonomy_dict:
-                    info = taxonomy_dict[seq_id]
-                    parts = info.split(' ', 1)
-                    taxid_part = parts[0] if parts else ""
-                    tax_part = parts[1] if len(parts) > 1 else ""
-                    taxid = taxid_part.split('=')[1].split(';')[0] if 'taxid=' in taxid_part else "Unknown"
-                    tax = tax_part.strip() if tax_part else "Unknown"
+                row = seq_rows.get(seq_id)
+                if row is not None:
+                    taxid = taxids[row]
+                    tax = lineage_table.lineages[lineage_ids[row]]
                     out_file.write(f"{seq_id}\t{taxid}\t{tax}\n")
+                    # Create a clickable link for the taxid
+                    html_file.write(f"<li>{seq_id}\t<a href='https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id={taxid}' target='_blank'>{taxid}</a>\t{tax}</li>\n")
+                    table_file.write(f"{i}\t{seq_id}\t{taxid}\t{lineage_ids[row]}\n")
                 else:
                     out_file.write(f"No info found for {seq_id} in the file.\n")
+                    html_file.write(f"<li>No info found for {seq_id} in the file.</li>\n")
+                    table_file.write(f"{i}\t{seq_id}\tUnknown\tNA\n")
+            html_file.write("</ul>\n")
+        html_file.write("</body></html>\n")
+    logging.info(f"Augmented Swarm clusters written to {augmented_swarm_file}")
     logging.info(f"Swarm processing results written to {output_info_file}")
-
-def process_swarm_output_html(swarm_file, taxonomy_dict, output_info_file_html):
-    """Process the Swarm output to generate a detailed HTML report."""
-    logging.info("Generating HTML report...")
-    with open(swarm_file, 'r') as clusters_file, open(output_info_file_html, 'w') as out_file:
-        clusters = clusters_file.readlines()
-        out_file.write("<html><body>\n")
-        for i, cluster in enumerate(clusters, start=1):
-            cluster_ids = cluster.strip().split()
-            out_file.write(f"<h2>Cluster {i}:</h2>\n<ul>\n")
-            for cluster_id in cluster_ids:
-                seq_id = cluster_id.split("|")[0]
-                if seq_id in taxonomy_dict:
-                    info = taxonomy_dict[seq_id]
-                    parts = info.split(' ', 1)
-                    taxid_part = parts[0] if parts else ""
-                    tax_part = parts[1] if len(parts) > 1 else ""
-                    taxid = taxid_part.split('=')[1].split(';')[0] if 'taxid=' in taxid_part else "Unknown"
-                    tax = tax_part.strip() if tax_part else "Unknown"
-                    # Create a clickable link for the taxid
-                    out_file.write(f"<li>{seq_id}\t<a href='https://www.ncbi.nlm.nih.gov/Taxonomy/Browser/wwwtax.cgi?id={taxid}' target='_blank'>{taxid}</a>\t{tax}</li>\n")
-                else:
-                    out_file.write(f"<li>No info found for {seq_id} in the file.</li>\n")
-            out_file.write("</ul>\n")
-        out_file.write("</body></html>\n")
-    logging.info(f"HTML report written to {output_info_file_html}")
-
-def generate_taxonomy_table(taxonomy_dict, output_table_file="taxonomy_rank_table.txt"):
-    """Generate a table with taxonomy ranks (Kingdom, Phylum, etc.) and unique counts."""
+    if output_info_file_html:
+        logging.info(f"HTML report written to {output_info_file_html}")
+    if cluster_table_file:
+        lineage_file = cluster_table_file.rsplit('.', 1)[0] + '_lineages.tsv'
+        with open(lineage_file, 'w') as f:
+            f.write("lineage_id\tlineage\n")
+            for lineage_id, lineage in enumerate(lineage_table.lineages):
+                f.write(f"{lineage_id}\t{lineage}\n")
+        logging.info(f"Cluster table written to {cluster_table_file} (lineages in {lineage_file})")
+
+def generate_taxonomy_table(taxonomy_infos, output_table_file="taxonomy_rank_table.txt"):
+    """Generate a table with taxonomy ranks (Kingdom, Phylum, etc.) and unique counts from the taxonomy information of the database."""
     logging.info("Generating taxonomy rank table...")
-    taxonomy_levels = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
-    rank_dict = {level: set() for level in taxonomy_levels}
+    lineage_table = LineageTable()
+    for tax_info in taxonomy_infos:
+        lineage_table.intern(tax_info.split(" ")[-1])
+    rank_lists = [lineage_table.rank_names(i) for i in range(len(TAXONOMY_LEVELS))]
 
     with open(output_table_file, 'w') as out_file:
-        out_file.write("\t".join(taxonomy_levels) + "\n")
-
-        for tax_info in taxonomy_dict.values():
-            tax_ranks = tax_info.split(" ")[-1].split(";")
-            if len(tax_ranks) == 7:
-                for i, level in enumerate(taxonomy_levels):
-                    rank_dict[level].add(tax_ranks[i].strip())
+        out_file.write("\t".join(TAXONOMY_LEVELS) + "\n")
 
         # Write the unique counts for each rank
-        unique_counts = [str(len(rank_dict[level])) for level in taxonomy_levels]
+        unique_counts = [str(len(rank_list)) for rank_list in rank_lists]
         out_file.write("\t".join(unique_counts) + "\n")
 
         # Write the unique names for each rank
-        max_rows = max(len(rank_dict[level]) for level in taxonomy_levels)
-        rank_lists = [list(rank_dict[level]) for level in taxonomy_levels]
+        max_rows = max(len(rank_list) for rank_list in rank_lists)
         for i in range(max_rows):
             row = [
-                rank_lists[j][i] if i < len(rank_lists[j]) else "" for j in range(len(taxonomy_levels))
+                rank_list[i] if i < len(rank_list) else "" for rank_list in rank_lists
             ]
             out_file.write("\t".join(row) + "\n")
     logging.info(f"Taxonomy rank table written to {output_table_file}")
@@ -175,31 +216,38 @@ def main():
     parser.add_argument("-oh", "--output_info_file_html", type=str, required=False, help="The output HTML info file (cluster.html).")
     parser.add_argument("-vsearch", "--vsearch_cluster_file", type=str, required=True, help="The VSEARCH cluster file (output_vsearch_cluster.txt).")
     parser.add_argument("-taxo", "--taxonomy_file", type=str, required=True, help="The taxonomy file (name_seq_with_taxo.txt).")
+    parser.add_argument("-e", "--engine", type=str, choices=["swarm", "native"], default="swarm", help="Clustering engine: the swarm binary, or the in-process d = 1 engine (swarm_d1.py) that does not need swarm.")
+    parser.add_argument("-sh", "--shards", type=int, default=1, help="Number of length bands whose edges are searched concurrently by the native engine (-d 1 only), stitched into the same result as a single run.")
+    parser.add_argument("-ct", "--cluster_table_file", type=str, required=False, help="The output cluster table, one line per sequence: cluster_id, seq_id, taxid, lineage_id (cluster_table.tsv).")
     args = parser.parse_args()
 
     logging.basicConfig(level=logging.INFO, format='%(message)s')
 
-    # Step 1: Parse and extract taxonomy information from the taxonomy file
-    logging.info("Parsing taxonomy file for taxonomy information...")
-    taxonomy_dict = parse_name_seq_with_taxo(args.taxonomy_file)
+    # Step 1: Open the taxonomy file, indexed on first use (see taxonomy_store.py)
+    logging.info("Opening the indexed taxonomy file...")
+    taxonomy_store = TaxonomyStore(args.taxonomy_file)
 
     # Step 2: Run Swarm
-    run_swarm(args.fasta_file, args.swarm_output_file, args.threads, args.abundance, args.distance)
+    if args.shards > 1:
+        run_swarm_sharded(args.fasta_file, args.swarm_output_file, args.threads, args.abundance, args.distance, args.engine, args.shards)
+    else:
+        run_swarm(args.fasta_file, args.swarm_output_file, args.threads, args.abundance, args.distance, args.engine)
 
-    # Step 3: Augment Swarm clusters using VSEARCH clusters
+    # Step 3: Parse the Swarm output once and augment its clusters using VSEARCH clusters
     augmented_swarm_file = args.swarm_output_file.replace('.txt', '_complete.txt')
-    augment_swarm_clusters(args.swarm_output_file, args.vsearch_cluster_file, augmented_swarm_file)
-
-    # Step 4: Process augmented Swarm output to generate the desired report
-    process_swarm_output(augmented_swarm_file, taxonomy_dict, args.output_info_file)
+    clusters = augment_swarm_clusters(args.swarm_output_file, args.vsearch_cluster_file)
+
+    # Step 4: Write the augmented Swarm clusters and the reports (text, HTML and cluster table) in one pass
+    taxonomy_dict = parse_name_seq_with_taxo(taxonomy_store, clusters)
+    lineage_table = LineageTable()
+    sequence_taxonomy = intern_taxonomy(taxonomy_dict, lineage_table)
+    write_swarm_reports(clusters, sequence_taxonomy, lineage_table, augmented_swarm_file, args.output_info_file,
+                        args.output_info_file_html, args.cluster_table_file)
     logging.info(f"Results written to {args.output_info_file}")
 
     # Step 5: Generate taxonomy rank table
-    generate_taxonomy_table(taxonomy_dict)
-
-    # Step 6: Generate HTML file
-    if args.output_info_file_html:
-        process_swarm_output_html(augmented_swarm_file, taxonomy_dict, args.output_info_file_html)
+    generate_taxonomy_table(taxonomy_store.distinct_taxonomies())
+    taxonomy_store.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+# Shared by format_ecopcr_result.py and 4_primer_design/launch_ecopcr_and_add_amplicon_length_info.py,
+# so it stays compatible with python 2.7 (EcoPCR conda environment).
+
+import sys
+from argparse import ArgumentParser
+
+try:
+    maketrans = bytes.maketrans
+except AttributeError:
+    from string import maketrans
+
+# NumPy reads the regular blocks column-wise; without it (EcoPCR environment), they are read line by line
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Fields of an ecoPCR output line (' | ' separated) that can be read
+FIELDS = {
+    'assembly': 0,
+    'taxid': 2,
+    'forward_primer': 13,
+    'forward_mismatches': 14,
+    'reverse_primer': 16,
+    'reverse_mismatches': 17,
+    'length': 19,
+    'sequence': 20
+}
+INT_FIELDS = set(['taxid', 'forward_mismatches', 'reverse_mismatches', 'length'])
+# A line must have at least this number of fields
+MIN_FIELDS = 20
+
+SEPARATOR = b' | '
+# Size of the blocks read by read_blocks
+BLOCK_SIZE = 16 * 1024 * 1024
+COMPLEMENT = maketrans(b'ACGTUMRWSYKVHDBNXacgtumrwsykvhdbnx', b'TGCAAKYWSRMBDHVNXtgcaakywsrmbdhvnx')
+
+REVERSE_COMPLEMENTS = {}
+
+# Bytes stripped around the values, as bytes.strip() does on ecoPCR fields
+BLANKS = b' \t\r'
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+def reverse_complement(primer):
+    """Reverse complement (IUPAC) of a primer as bytes, cached per distinct primer."""
+    result = REVERSE_COMPLEMENTS.get(primer)
+    if result is None:
+        result = primer.translate(COMPLEMENT)[::-1]
+        REVERSE_COMPLEMENTS[primer] = result
+    return result
+
+def read_ecopcr(lines, columns, strict=True):
+    """
+    Read the requested columns of ecoPCR output lines.
+
+    Lines are bytes (file opened in binary mode, or a pipe). Only the fields up to the last requested
+    column are split, and only the requested ones are stripped. 'assembly' is the first field up to
+    '|', integer columns (INT_FIELDS) are converted to int, the others stay bytes. Comment lines are skipped.
+
+    Parameters:
+    lines (iterable of bytes): ecoPCR output lines.
+    columns (list of str): names of FIELDS, in the order of the returned tuples.
+    strict (bool): raise an IndexError on an incorrect line (too few fields or non-integer value)
+                   instead of skipping it.
+
+    Returns:
+    generator of tuple: one tuple of values per amplicon.
+    """
+    indexes = [FIELDS[column] for column in columns]
+    is_int = [column in INT_FIELDS for column in columns]
+    is_assembly = [column == 'assembly' for column in columns]
+    n_splits = max(indexes) + 1
+    n_required = max(n_splits, MIN_FIELDS)
+    for i, line in enumerate(lines):
+        if line.startswith(b'#'):
+            continue
+        parts = line.split(SEPARATOR, n_splits)
+        if len(parts) < n_required:
+            # when fewer fields than MIN_FIELDS are split, the last part holds the rest of the line
+            if len(parts) + (parts[-1].count(SEPARATOR) if len(parts) > n_splits else 0) < n_required:
+                if strict:
+                    raise IndexError('ecopcr line {0} ({1}) is incorrect'.format(i, line))
+                continue
+        values = []
+        try:
+            for index, to_int, assembly in zip(indexes, is_int, is_assembly):
+                value = parts[index]
+                if assembly:
+                    value = value.split(b'|', 1)[0]
+                value = value.strip()
+                values.append(int(value) if to_int else value)
+        except ValueError:
+            if strict:
+                raise IndexError('ecopcr line {0} ({1}) is incorrect'.format(i, line))
+            continue
+        yield tuple(values)
+
+def strip_comment_lines(data):
+    """Block of ecoPCR output (bytes) without its comment lines."""
+    if not data.startswith(b'#') and b'\n#' not in data:
+        return data
+    pieces = []
+    start = 0
+    while start < len(data):
+        if data.startswith(b'#', start):
+            comment = start
+        else:
+            comment = data.find(b'\n#', start) + 1
+            if not comment:
+                pieces.append(data[start:])
+                break
+            pieces.append(data[start:comment])
+        end = data.find(b'\n', comment)
+        start = len(data) if end == -1 else end + 1
+    return b''.join(pieces)
+
+def line_layout(data):
+    """
+    Positions of the lines and separators of a block of ecoPCR output lines (bytes without comments), found with NumPy.
+
+    Returns:
+    tuple: (buffer, line starts, line ends, line x separator array of separator positions), or None when the
+           lines do not all have the same number of separators.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == ord('\n'))
+    if not data.endswith(b'\n'):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    is_separator = buf[1:-1] == ord('|')
+    is_separator &= buf[:-2] == ord(' ')
+    is_separator &= buf[2:] == ord(' ')
+    separators = np.flatnonzero(is_separator)
+    if not len(ends) or not len(separators) or len(separators) % len(ends):
+        return None
+    separators = separators.reshape(len(ends), -1)
+    # the separators of each row must lie on its line, and not overlap as in ' | | '
+    if (separators[:, 0] < starts).any() or (separators[:, -1] >= ends).any() or (np.diff(separators, axis=1) < len(SEPARATOR)).any():
+        return None
+    return buf, starts, ends, separators
+
+def strip_bounds(buf, start, end):
+    """Bounds of the fields [start, end) of a buffer without their surrounding blanks."""
+    blanks = np.zeros(256, dtype=bool)
+    blanks[list(bytearray(BLANKS))] = True
+    while True:
+        leading = (start < end) & blanks[buf[np.minimum(start, len(buf) - 1)]]
+        if not leading.any():
+            break
+        start = start + leading
+    while True:
+        trailing = (end > start) & blanks[buf[end - 1]]
+        if not trailing.any():
+            break
+        end = end - trailing
+    return start, end
+
+def parse_int_column(buf, start, end):
+    """int64 array of the unsigned integers in the fields [start, end) of a buffer, or None when one is not."""
+    width = end - start
+    if not len(width):
+        return np.zeros(0, dtype=np.int64)
+    if width.min() == 0 or width.max() > 18:
+        return None
+    values = np.zeros(len(width), dtype=np.int64)
+    for digit in range(int(width.max())):
+        in_field = width > digit
+        digits = buf[np.where(in_field, start + digit, 0)].astype(np.int64) - ord('0')
+        if ((digits < 0) | (digits > 9))[in_field].any():
+            return None
+        values = np.where(in_field, values * 10 + digits, values)
+    return values
+
+def read_ecopcr_arrays(data, columns):
+    """
+    Read the requested columns of a block of ecoPCR output (bytes made of whole lines) with NumPy: the separators
+    of all the lines are found at once, and the integer columns are parsed without Python objects.
+
+    Returns:
+    dict: column name -> int64 array for INT_FIELDS, list of bytes otherwise; None when the block is not
+          regular (lines with different numbers of fields, too few fields, non-integer values), to be read
+          line by line.
+    """
+    data = strip_comment_lines(data)
+    if data in (b'', b'\n'):
+        return dict((column, np.zeros(0, dtype=np.int64) if column in INT_FIELDS else []) for column in columns)
+    layout = line_layout(data)
+    if layout is None:
+        return None
+    buf, starts, ends, separators = layout
+    stride = separators.shape[1]
+    if stride + 1 < MIN_FIELDS or max(FIELDS[column] for column in columns) > stride:
+        return None
+
+    result = {}
+    for column in columns:
+        index = FIELDS[column]
+        start = starts if index == 0 else separators[:, index - 1] + len(SEPARATOR)
+        end = ends if index == stride else separators[:, index]
+        if column == 'assembly':
+            # up to the first '|' of the field
+            first_field_end = end
+            end = starts.copy()
+            while True:
+                in_name = (end < first_field_end) & (buf[end] != ord('|'))
+                if not in_name.any():
+                    break
+                end += in_name
+        start, end = strip_bounds(buf, start, end)
+        if column in INT_FIELDS:
+            values = parse_int_column(buf, start, end)
+            if values is None:
+                return None
+        else:
+            values = [data[i:j] for i, j in zip(start.tolist(), end.tolist())]
+        result[column] = values
+    return result
+
+def read_ecopcr_columns(data, columns, strict=True):
+    """
+    Read the requested columns of a block of ecoPCR output (bytes made of whole lines).
+
+    All the lines of an ecoPCR output have the same number of fields: with NumPy, the block is read by
+    read_ecopcr_arrays, otherwise each column is read with one split per line limited to the fields
+    before it, or after it when it is closer to the end of the line (the amplicon sequence is the
+    second to last field). Blocks whose lines do not all have the same number of fields are read line
+    by line with read_ecopcr.
+
+    Returns:
+    dict: column name -> list of values (int for INT_FIELDS, bytes otherwise), one per amplicon.
+    """
+    if np is not None:
+        arrays = read_ecopcr_arrays(data, columns)
+        if arrays is not None:
+            return dict((column, values.tolist() if column in INT_FIELDS else values) for column, values in arrays.items())
+    if data.endswith(b'\n'):
+        data = data[:-1]
+    lines = data.split(b'\n') if data else []
+    if data.startswith(b'#') or b'\n#' in data:
+        lines = [line for line in lines if not line.startswith(b'#')]
+    if not lines:
+        return dict((column, []) for column in columns)
+
+    separators = set(line.count(SEPARATOR) for line in lines)
+    stride = separators.pop()
+    if separators or stride + 1 < MIN_FIELDS or max(FIELDS[column] for column in columns) > stride:
+        records = list(read_ecopcr(lines, columns, strict))
+        return dict((column, [record[i] for record in records]) for i, column in enumerate(columns))
+
+    result = {}
+    for column in columns:
+        index = FIELDS[column]
+        if column == 'assembly':
+            values = [line.split(b'|', 1)[0].strip() for line in lines]
+        elif index <= stride - index:
+            values = [line.split(SEPARATOR, index + 1)[index].strip() for line in lines]
+        else:
+            values = [line.rsplit(SEPARATOR, stride - index + 1)[1].strip() for line in lines]
+        if column in INT_FIELDS:
+            try:
+                values = [int(value) for value in values]
+            except ValueError:
+                records = list(read_ecopcr(lines, columns, strict))
+                return dict((column, [record[i] for record in records]) for i, column in enumerate(columns))
+        result[column] = values
+    return result
+
+def read_ecopcr_file(ecopcr_file, columns, start=0, end=None, strict=True):
+    """read_ecopcr_columns on a file, or on the byte range [start, end) of a file (start and end at line boundaries)."""
+    with open(ecopcr_file, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start) if end is not None else f.read()
+    return read_ecopcr_columns(data, columns, strict)
+
+def read_blocks(f, block_size=BLOCK_SIZE):
+    """Blocks of whole lines (bytes) of a file or pipe opened in binary mode."""
+    rest = b''
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        data = rest + data
+        newline = data.rfind(b'\n')
+        if newline == -1:
+            rest = data
+            continue
+        rest = data[newline + 1:]
+        yield data[:newline + 1]
+    if rest:
+        yield rest
+
+def ecopcr_batches(ecopcr_file, columns, block_size=BLOCK_SIZE, strict=True):
+    """
+    Read an ecoPCR output file by blocks as NumPy column batches.
+
+    Returns:
+    generator of dict: column name -> array (int64 for INT_FIELDS, bytes otherwise), one batch per block.
+    """
+    with open(ecopcr_file, 'rb') as f:
+        for data in read_blocks(f, block_size):
+            values = read_ecopcr_arrays(data, columns)
+            if values is None:
+                values = read_ecopcr_columns(data, columns, strict)
+            yield dict((column, np.asarray(values[column], dtype=np.int64) if column in INT_FIELDS else np.array(values[column]))
+                       for column in columns)
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = ArgumentParser(description="Print selected columns of ecoPCR output files as a TSV table. Columns: " + ', '.join(sorted(FIELDS, key=FIELDS.get)))
+    parser.add_argument("ecopcr_files", nargs='+', help="EcoPCR output files")
+    parser.add_argument("-c", "--columns", nargs='+', default=['assembly', 'taxid', 'length'], choices=sorted(FIELDS), help="Columns to print")
+    args = parser.parse_args()
+
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(('\t'.join(args.columns) + '\n').encode('ascii'))
+    for ecopcr_file in args.ecopcr_files:
+        values = read_ecopcr_file(ecopcr_file, args.columns)
+        for record in zip(*[values[column] for column in args.columns]):
+            out.write(b'\t'.join(value if isinstance(value, bytes) else str(value).encode('ascii') for value in record) + b'\n')
+
+if __name__ == "__main__":
+    main()
@@ -9,104 +9,285 @@ __status__ = 'prod'
 
 import os
 import sys
+import heapq
+import shutil
+import hashlib
 import logging
+import tempfile
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
-from collections import defaultdict
-from Bio.Seq import Seq
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
 from subprocess import run
+from ecopcr_reader import read_ecopcr_file, reverse_complement
+from taxonomy_store import TaxonomyStore
 
-def get_seq_from_ecopcr_file(ecopcrfile, add_primer_sequences):
-    """Get amplicon sequences from an ecopcr file."""
-    assembly_counter = defaultdict(int)
-    with open(ecopcrfile, encoding="latin-1") as fl:
-        for i, l in enumerate(fl):
-            if l.startswith('#'):
-                continue
-            splitted_l = [e.strip() for e in l.split(' | ')]
-            if len(splitted_l) < 20:
-                logging.critical(f'ecopcr line {i} ({l}) in file {ecopcrfile} is incorrect')
-                raise IndexError(f'ecopcr line {i} ({l}) in file {ecopcrfile} is incorrect')
-            assembly = splitted_l[0].split('|')[0]
-            assembly_counter[assembly] += 1
-            f_primer = splitted_l[13]
-            r_primer = splitted_l[16]
-            if add_primer_sequences:
-                r_primer_seq = Seq(r_primer)
-                sequence = f_primer + splitted_l[20] + str(r_primer_seq.reverse_complement())
-            else:
-                sequence = splitted_l[20]
-            header = f'{assembly}|seq{assembly_counter[assembly]}'
-            yield header, sequence
-
-def write_ecopcr_file_seq_to_fasta(ecopcrfile, output_file, add_primer_sequences):
-    """Write fasta sequences from an ecopcr file."""
-    logging.info(f'Writing sequences in {output_file}')
-    with open(output_file, 'w') as fl:
-        for header, seq in get_seq_from_ecopcr_file(ecopcrfile, add_primer_sequences):
-            fl.write(f'>{header}\n')
-            fl.write(seq + '\n')
-
-def parse_taxonomy_file(taxonomy_file):
-    taxonomy_dict = {}
-    with open(taxonomy_file, 'r') as f:
-        for line in f:
-            if line.startswith(">"):
-                parts = line.split(" ", 1)
-                seq_id = parts[0][1:].split("|")[0]
-                taxonomy_info = parts[1].strip()
-                taxonomy_dict[seq_id] = taxonomy_info
+# Size of the ecopcr file chunks parsed by each process
+CHUNK_SIZE = 32 * 1024 * 1024
+
+# Same defaults as vsearch --derep_fulllength: shorter and longer sequences are discarded, output sequences are wrapped at 80 characters
+MIN_SEQ_LENGTH = 32
+MAX_SEQ_LENGTH = 50000
+FASTA_WIDTH = 80
+DEREP_PARTITIONS = 64
+
+VALID_NUCLEOTIDES = b"ACTG"
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+def sequence_digest(sequence):
+    """128-bit digest (hex) of a sequence, compared as vsearch does: case-insensitive, U read as T."""
+    return hashlib.blake2b(sequence.upper().replace('U', 'T').encode('latin-1'), digest_size=16).hexdigest()
+
+def split_ecopcr_file(ecopcrfile, chunk_size=CHUNK_SIZE):
+    """Line-aligned (start, end) byte ranges of about chunk_size bytes covering an ecopcr file (one empty range for an empty file)."""
+    file_size = os.path.getsize(ecopcrfile)
+    ranges = []
+    start = 0
+    with open(ecopcrfile, 'rb') as fl:
+        while start < file_size:
+            fl.seek(min(start + chunk_size, file_size))
+            fl.readline()
+            end = min(fl.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+    return ranges or [(0, 0)]
+
+def parse_ecopcr_chunk(task):
+    """
+    Parse a byte range of an ecopcr file.
+
+    Returns:
+    tuple: (list of assemblies, list of amplicon sequences, list of sequence digests if with_digests), in the order of the file.
+    """
+    ecopcrfile, start, end, add_primer_sequences, with_digests = task
+    columns = ['assembly', 'sequence', 'forward_primer', 'reverse_primer'] if add_primer_sequences else ['assembly', 'sequence']
+    try:
+        values = read_ecopcr_file(ecopcrfile, columns, start, end)
+    except IndexError as e:
+        logging.critical(f'{e} in file {ecopcrfile} (bytes {start}-{end})')
+        raise IndexError(f'{e} in file {ecopcrfile} (bytes {start}-{end})')
+    if not values['assembly']:
+        return [], [], []
+    if add_primer_sequences:
+        sequences = [f_primer + sequence + reverse_complement(r_primer) for f_primer, sequence, r_primer in
+                     zip(values['forward_primer'], values['sequence'], values['reverse_primer'])]
+    else:
+        sequences = values['sequence']
+    # decode all the values at once
+    assemblies = b'\n'.join(values['assembly']).decode('latin-1').split('\n')
+    sequences = b'\n'.join(sequences).decode('latin-1').split('\n')
+    digests = [sequence_digest(sequence) for sequence in sequences] if with_digests else []
+    return assemblies, sequences, digests
+
+def ordered_results(executor, function, tasks, window):
+    """Results of function on each task, in the order of tasks, with at most window tasks submitted ahead of the writer."""
+    pending = deque()
+    for task in tasks:
+        pending.append((task, executor.submit(function, task)))
+        if len(pending) >= window:
+            task, future = pending.popleft()
+            yield task, future.result()
+    while pending:
+        task, future = pending.popleft()
+        yield task, future.result()
+
+def write_ecopcr_files_to_fasta(ecopcrfiles, combined_fasta, output_dir, add_primer_sequences, processes=1, per_file_fasta=False, dereplicator=None):
+    """
+    Convert the ecopcr files to FASTA in a single pass, writing all.fna directly.
+
+    Files are split into line-aligned chunks parsed by a pool of processes. The chunks are written in
+    the order of the files, so that the headers (<assembly>|seq<n>, n counting the amplicons of the
+    assembly in its ecopcr file) and the order of the sequences are those of the per-file conversion.
+    With per_file_fasta, the FASTA file of each ecopcr file is also written. The records are also
+    given to the dereplicator, if any, with the digests of their sequences computed by the workers.
+    """
+    with_digests = dereplicator is not None
+    tasks = [(ecopcrfile, start, end, add_primer_sequences, with_digests) for ecopcrfile in ecopcrfiles for start, end in split_ecopcr_file(ecopcrfile)]
+    current_file = None
+    file_out = None
+    with ProcessPoolExecutor(max_workers=processes) as executor, open(combined_fasta, 'w') as fout:
+        try:
+            for task, (assemblies, sequences, digests) in ordered_results(executor, parse_ecopcr_chunk, tasks, 2 * processes):
+                if task[0] != current_file:
+                    current_file = task[0]
+                    logging.info(f'Processing {current_file}')
+                    assembly_counter = defaultdict(int)
+                    if per_file_fasta:
+                        if file_out is not None:
+                            file_out.close()
+                        output_file = os.path.join(output_dir, ''.join(os.path.basename(current_file).split('.')[:-1]) + '.fna')
+                        logging.info(f'Writing sequences in {output_file}')
+                        file_out = open(output_file, 'w')
+                headers = []
+                for assembly in assemblies:
+                    assembly_counter[assembly] += 1
+                    headers.append(f'{assembly}|seq{assembly_counter[assembly]}')
+                block = ''.join(f'>{header}\n{sequence}\n' for header, sequence in zip(headers, sequences))
+                if dereplicator is not None:
+                    dereplicator.add(headers, sequences, digests)
+                fout.write(block)
+                if file_out is not None:
+                    file_out.write(block)
+        finally:
+            if file_out is not None:
+                file_out.close()
+
+def cluster_order(cluster_line):
+    """Order of a cluster line of Dereplicator: decreasing size, then centroid label, then first record."""
+    size, index, label = cluster_line.split('\t', 3)[:3]
+    return -int(size), label, int(index)
+
+class Dereplicator:
+    """
+    Full-length dereplication of the amplicons, giving the derep.fasta and output_vsearch_cluster.txt files of
+    vsearch --derep_fulllength --sizein --sizeout followed by parse_uc_file, without running vsearch.
+
+    Identical sequences are found by a 128-bit digest of their sequence. The records are spread over
+    partition files by digest, so that each partition is dereplicated in memory on its own; the
+    clusters of all partitions are then merged by decreasing abundance, ties ordered by centroid label and
+    then by first occurrence, the order of vsearch --derep_fulllength.
+    The centroid is the first occurrence of the sequence, its label gets ;size=<abundance>.
+    """
+
+    def __init__(self, tmp_dir, n_partitions=DEREP_PARTITIONS):
+        self.tmp_dir = tmp_dir
+        self.n_partitions = n_partitions
+        self.n_records = 0
+        self.record_files = [open(self.partition_path('records', partition), 'w') for partition in range(n_partitions)]
+
+    def partition_path(self, kind, partition):
+        return os.path.join(self.tmp_dir, f'{kind}_{partition}.tsv')
+
+    def add(self, labels, sequences, digests):
+        """Add records, in input order, to the partition files."""
+        batches = defaultdict(list)
+        for label, sequence, digest in zip(labels, sequences, digests):
+            if MIN_SEQ_LENGTH <= len(sequence) <= MAX_SEQ_LENGTH:
+                batches[int(digest[:8], 16) % self.n_partitions].append(f'{self.n_records}\t{digest}\t{label}\t{sequence}\n')
+            self.n_records += 1
+        for partition, lines in batches.items():
+            self.record_files[partition].writelines(lines)
+
+    def dereplicate_partition(self, partition):
+        """Write the clusters of one partition (size, first record, centroid label, sequence, member assemblies), sorted like the output."""
+        clusters = {}
+        records_path = self.partition_path('records', partition)
+        with open(records_path, 'r') as f:
+            for line in f:
+                index, digest, label, sequence = line.rstrip('\n').split('\t')
+                key = bytes.fromhex(digest)
+                cluster = clusters.get(key)
+                if cluster is None:
+                    clusters[key] = [int(index), label, sequence, []]
+                else:
+                    cluster[3].append(sys.intern(label.split('|')[0]))
+        os.remove(records_path)
+        with open(self.partition_path('clusters', partition), 'w') as out:
+            for index, label, sequence, members in sorted(clusters.values(), key=lambda cluster: (-len(cluster[3]), cluster[1], cluster[0])):
+                out.write(f'{len(members) + 1}\t{index}\t{label}\t{sequence}\t{",".join(members)}\n')
+
+    def write(self, derep_fasta, cluster_file, groups_file=None):
+        """
+        Write the dereplicated sequences and the clusters (centroid assembly, then the assemblies of the other
+        sequences of its clusters, as parse_uc_file does). With groups_file, the group of each dereplicated
+        sequence (centroid assembly, then the assemblies of its other sequences) is also written, one line each.
+        """
+        for record_file in self.record_files:
+            record_file.close()
+        for partition in range(self.n_partitions):
+            self.dereplicate_partition(partition)
+
+        # Clusters whose centroids come from the same assembly are grouped on one line, members are spread over partitions by line
+        line_ranks = {}
+        cluster_parts = [open(self.partition_path('clusters', partition), 'r') for partition in range(self.n_partitions)]
+        member_files = [open(self.partition_path('members', partition), 'w') for partition in range(self.n_partitions)]
+        with open(derep_fasta, 'w') as fout, open(groups_file or os.devnull, 'w') as groups:
+            for line in heapq.merge(*cluster_parts, key=cluster_order):
+                size, _, label, sequence, members = line.rstrip('\n').split('\t')
+                fout.write(f'>{label};size={size}\n')
+                fout.write(''.join(sequence[i:i + FASTA_WIDTH] + '\n' for i in range(0, len(sequence), FASTA_WIDTH)))
+                centroid = label.split('|')[0]
+                groups.write(f'{centroid}\t{members}\n')
+                rank = line_ranks.setdefault(centroid, len(line_ranks))
+                member_files[rank % self.n_partitions].write(f'{rank}\t{centroid}\t{members}\n')
+        for f in cluster_parts + member_files:
+            f.close()
+
+        for partition in range(self.n_partitions):
+            lines = {}
+            with open(self.partition_path('members', partition), 'r') as f:
+                for line in f:
+                    rank, centroid, members = line.rstrip('\n').split('\t')
+                    lines.setdefault(int(rank), [centroid, []])[1].extend([members] if members else [])
+            with open(self.partition_path('lines', partition), 'w') as out:
+                for rank in sorted(lines):
+                    centroid, members = lines[rank]
+                    out.write(f'{rank}\t{centroid}\t{",".join(members)}\n')
+        line_parts = [open(self.partition_path('lines', partition), 'r') for partition in range(self.n_partitions)]
+        with open(cluster_file, 'w') as f:
+            for line in heapq.merge(*line_parts, key=lambda line: int(line.split('\t', 1)[0])):
+                f.write(line.split('\t', 1)[1])
+        for line_part in line_parts:
+            line_part.close()
+
+def parse_taxonomy_file(taxonomy_file, fasta_file):
+    """Taxonomy of the sequence IDs of a FASTA file, looked up in the indexed taxonomy file (see taxonomy_store.py)."""
+    with open(fasta_file, 'r') as f:
+        seq_ids = [line[1:].split("|")[0] for line in f if line.startswith(">")]
+    store = TaxonomyStore(taxonomy_file)
+    taxonomy_dict = store.lookup(seq_ids)
+    store.close()
     return taxonomy_dict
 
+def read_fasta_records(fin):
+    """(id, sequence lines) of each record of a FASTA file, the id being the header up to the first '|'. Records without sequence lines are skipped."""
+    seq_id = None
+    seq = []
+    for line in fin:
+        if line.startswith(">"):
+            if seq_id and seq:
+                yield seq_id, seq
+            seq_id = line[1:].split("|")[0]
+            seq = []
+        else:
+            seq.append(line.strip())
+    if seq_id and seq:
+        yield seq_id, seq
+
 def replace_fasta_headers_and_check_sequences(fasta_file, taxonomy_dict, output_file, log_file):
-    valid_nucleotides = set("ACTG")
+    """
+    Write the sequences made only of A, C, G, T with a unique ID and their taxonomy, and log the others.
+
+    A sequence is valid when deleting A, C, G and T from its bytes leaves nothing; the set of invalid
+    characters is only built for the sequences written to the log. An ID seen again gets the next
+    free .<n> suffix, the last suffix of each ID being kept so that numbering does not restart from 1.
+    """
     id_count = defaultdict(int)
     unique_id_set = set()
-    seq_id = None
-    seq = []
-    
-    with open(fasta_file, 'r') as fin, open(output_file, 'w') as fout, open(log_file, 'w') as flog:
-        for line in fin:
-            if line.startswith(">"):
-                if seq_id and seq:
-                    seq_str = "".join(seq)
-                    invalid_chars = set(seq_str) - valid_nucleotides
-                    if invalid_chars:
-                        invalid_char_str = ", ".join(invalid_chars)
-                        flog.write(f"Sequence {seq_id} contains invalid characters: {invalid_char_str}\n")
-                        flog.write(f"Sequence: {seq_str}\n\n")
-                    else:
-                        # Ensure the ID is unique by adding a suffix if necessary
-                        unique_id = seq_id
-                        while unique_id in unique_id_set:
-                            id_count[seq_id] += 1
-                            unique_id = f"{seq_id}.{id_count[seq_id]}"
-                        unique_id_set.add(unique_id)
-                        fout.write(f">{unique_id}| {taxonomy_dict.get(seq_id, '')}\n")
-                        fout.write(f"{seq_str}\n")
-                seq_id = line[1:].split("|")[0]
-                seq = []
-            else:
-                seq.append(line.strip())
-        
-        if seq_id and seq:
+
+    with open(fasta_file, 'r') as fin, open(output_file, 'w', buffering=WRITE_BUFFER_SIZE) as fout, \
+         open(log_file, 'w', buffering=WRITE_BUFFER_SIZE) as flog:
+        for seq_id, seq in read_fasta_records(fin):
             seq_str = "".join(seq)
-            invalid_chars = set(seq_str) - valid_nucleotides
-            if invalid_chars:
+            if seq_str.encode('utf-8', 'surrogateescape').translate(None, VALID_NUCLEOTIDES):
+                invalid_chars = set(seq_str) - set(VALID_NUCLEOTIDES.decode())
                 invalid_char_str = ", ".join(invalid_chars)
-                flog.write(f"Sequence {seq_id} contains invalid characters: {invalid_char_str}\n")
-                flog.write(f"Sequence: {seq_str}\n\n")
-            else:
-                unique_id = seq_id
-                while unique_id in unique_id_set:
-                    id_count[seq_id] += 1
-                    unique_id = f"{seq_id}.{id_count[seq_id]}"
-                unique_id_set.add(unique_id)
-                fout.write(f">{unique_id}| {taxonomy_dict.get(seq_id, '')}\n")
-                fout.write(f"{seq_str}\n")
-
-def parse_uc_file(uc_file, output_file):
-    """Parse the UC file and output clusters."""
+                flog.write(f"Sequence {seq_id} contains invalid characters: {invalid_char_str}\nSequence: {seq_str}\n\n")
+                continue
+            # Ensure the ID is unique by adding a suffix if necessary
+            unique_id = seq_id
+            while unique_id in unique_id_set:
+                id_count[seq_id] += 1
+                unique_id = f"{seq_id}.{id_count[seq_id]}"
+            unique_id_set.add(unique_id)
+            fout.write(f">{unique_id}| {taxonomy_dict.get(seq_id, '')}\n{seq_str}\n")
+
+def parse_uc_file(uc_file, output_file, groups_file=None):
+    """
+    Parse the UC file and output clusters. With groups_file, the group of each dereplicated sequence
+    (centroid ID, then the IDs of its other sequences) is also written, one line each.
+    """
     clusters = {}
+    groups = {}
     with open(uc_file, 'r') as f:
         for line in f:
             line = line.strip()
@@ -120,6 +301,7 @@ def parse_uc_file(uc_file, output_file):
                 centroid_id = fields[8].split('|')[0]
                 if centroid_id not in clusters:
                     clusters[centroid_id] = []
+                groups.setdefault(int(fields[1]), [centroid_id, []])
             elif record_type == 'H':
                 # Hit assigned to a centroid
                 sequence_id = fields[8].split('|')[0]
@@ -127,12 +309,19 @@ def parse_uc_file(uc_file, output_file):
                 if centroid_id not in clusters:
                     clusters[centroid_id] = []
                 clusters[centroid_id].append(sequence_id)
+                groups.setdefault(int(fields[1]), [centroid_id, []])[1].append(sequence_id)
     
     # Write the clusters to the output file
     with open(output_file, 'w') as f:
         for centroid, sequences in clusters.items():
             sequences_str = ','.join(sequences)
             f.write(f"{centroid}\t{sequences_str}\n")
+    if groups_file:
+        with open(groups_file, 'w') as f:
+            # One line per cluster number of vsearch, the labels of the centroids can repeat across ecopcr files
+            for cluster_number in sorted(groups):
+                centroid, sequences = groups[cluster_number]
+                f.write(f"{centroid}\t{','.join(sequences)}\n")
 
 def main():
     parser = ArgumentParser(description="Process EcoPCR output and annotate with taxonomy",
@@ -142,6 +331,10 @@ def main():
     parser.add_argument('--add_primer_sequences', help="Add primer sequences to amplicon sequences", action="store_true")
     parser.add_argument("-o", '--output_dir', help="Output directory", type=str, default='./')
     parser.add_argument("-t", '--taxonomy_file', help="Taxonomy file", type=str, required=True)
+    parser.add_argument("-p", "--processes", help="Number of processes parsing the ecopcr files", type=int, default=1)
+    parser.add_argument("--per_file_fasta", help="Also write the FASTA file of each ecopcr file", action="store_true")
+    parser.add_argument("--derep_engine", help="Dereplication of the amplicons: built-in or vsearch --derep_fulllength", choices=['builtin', 'vsearch'], default='builtin')
+    parser.add_argument("--derep_partitions", help="Number of partition files used by the built-in dereplication", type=int, default=DEREP_PARTITIONS)
     parser.add_argument("-v", "--verbose", help="Increase output verbosity", action="store_true")
     
     args = parser.parse_args()
@@ -160,32 +353,35 @@ def main():
 
     add_primer_sequences = args.add_primer_sequences
 
-    for ecopcrfile in ecopcrfiles:
-        logging.info(f'Processing {ecopcrfile}')
-        output_file = os.path.join(output_dir, ''.join(os.path.basename(ecopcrfile).split('.')[:-1]) + '.fna')
-        write_ecopcr_file_seq_to_fasta(ecopcrfile, output_file, add_primer_sequences=add_primer_sequences)
+    derep_fasta = os.path.join(output_dir, 'derep.fasta')
+    cluster_output_file = os.path.join(output_dir, 'output_vsearch_cluster.txt')
+    groups_file = os.path.join(output_dir, 'derep_groups.txt')
+    tmp_dir = tempfile.mkdtemp(prefix='derep_', dir=output_dir)
+    dereplicator = Dereplicator(tmp_dir, args.derep_partitions) if args.derep_engine == 'builtin' else None
 
-    # Combine all fasta files into one
+    # Convert all ecopcr files to a single fasta file
     combined_fasta = os.path.join(output_dir, 'all.fna')
-    with open(combined_fasta, 'w') as fout:
-        for ecopcrfile in ecopcrfiles:
-            fasta_file = os.path.join(output_dir, ''.join(os.path.basename(ecopcrfile).split('.')[:-1]) + '.fna')
-            with open(fasta_file, 'r') as fin:
-                fout.write(fin.read())
+    try:
+        write_ecopcr_files_to_fasta(ecopcrfiles, combined_fasta, output_dir, add_primer_sequences,
+                                    processes=args.processes, per_file_fasta=args.per_file_fasta, dereplicator=dereplicator)
+        if dereplicator is not None:
+            logging.info('Dereplicating sequences')
+            dereplicator.write(derep_fasta, cluster_output_file, groups_file)
+    finally:
+        shutil.rmtree(tmp_dir)
 
-    # Run vsearch with --uc option
-    derep_fasta = os.path.join(output_dir, 'derep.fasta')
-    uc_file = os.path.join(output_dir, 'output.uc')
-    logging.info('Running vsearch for dereplication')
-    run(['vsearch', '--derep_fulllength', combined_fasta, '--sizein', '--sizeout', '--output', derep_fasta, '--uc', uc_file])
+    if dereplicator is None:
+        # Run vsearch with --uc option
+        uc_file = os.path.join(output_dir, 'output.uc')
+        logging.info('Running vsearch for dereplication')
+        run(['vsearch', '--derep_fulllength', combined_fasta, '--sizein', '--sizeout', '--output', derep_fasta, '--uc', uc_file])
 
-    # Parse the UC file to generate the clusters
-    cluster_output_file = os.path.join(output_dir, 'output_vsearch_cluster.txt')
-    logging.info('Parsing UC file to generate cluster information')
-    parse_uc_file(uc_file, cluster_output_file)
+        # Parse the UC file to generate the clusters
+        logging.info('Parsing UC file to generate cluster information')
+        parse_uc_file(uc_file, cluster_output_file, groups_file)
 
     # Parse taxonomy file
-    taxonomy_dict = parse_taxonomy_file(args.taxonomy_file)
+    taxonomy_dict = parse_taxonomy_file(args.taxonomy_file, derep_fasta)
     final_output = os.path.join(output_dir, 'all_modified.fna')
     log_file = os.path.join(output_dir, 'invalid_sequences.log')
 
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+import numpy as np
+
+TAXONOMY_LEVELS = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+# Rank name ID of the ranks of a lineage that does not have the 7 ranks
+NO_RANK = -1
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+class LineageTable:
+    """
+    Distinct lineages (k__...;p__...;...;s__...) interned once as integer IDs.
+
+    Each rank name is also interned, and rank_array() gives the rank x lineage array of rank name IDs,
+    so that clusters can be compared on lineage IDs or on the IDs of one rank with integer operations.
+    Lineages without the 7 ranks keep their ID but have NO_RANK at every rank.
+    """
+
+    def __init__(self):
+        self.lineage_ids = {}
+        self.lineages = []
+        self.name_ids = {}
+        self.names = []
+        self.rank_rows = []
+        self._rank_array = None
+
+    def __len__(self):
+        return len(self.lineages)
+
+    def intern_name(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:
+            name_id = len(self.names)
+            self.name_ids[name] = name_id
+            self.names.append(name)
+        return name_id
+
+    def intern(self, lineage):
+        """ID of a lineage, added to the table the first time it is seen."""
+        lineage_id = self.lineage_ids.get(lineage)
+        if lineage_id is None:
+            lineage_id = len(self.lineages)
+            self.lineage_ids[lineage] = lineage_id
+            self.lineages.append(lineage)
+            ranks = lineage.split(";")
+            if len(ranks) == len(TAXONOMY_LEVELS):
+                self.rank_rows.append([self.intern_name(rank.strip()) for rank in ranks])
+            else:
+                self.rank_rows.append([NO_RANK] * len(TAXONOMY_LEVELS))
+            self._rank_array = None
+        return lineage_id
+
+    def intern_all(self, lineages):
+        """NumPy array of the IDs of a sequence of lineages (one per sequence)."""
+        return np.fromiter((self.intern(lineage) for lineage in lineages), dtype=np.int32)
+
+    def rank_array(self):
+        """Rank x lineage array (int32) of rank name IDs."""
+        if self._rank_array is None:
+            self._rank_array = np.array(self.rank_rows, dtype=np.int32).reshape(-1, len(TAXONOMY_LEVELS)).T
+        return self._rank_array
+
+    def rank_prefix_ids(self):
+        """
+        Rank x lineage array (int64) of the IDs of the lineages truncated after each rank (see rank_prefix), so that
+        two lineages have the same ID at a rank when they have the same prefix. A lineage with fewer ranks shares
+        the IDs of the ranks it has, and is its own taxon at the ranks it lacks.
+        """
+        prefix_ids = np.zeros((len(TAXONOMY_LEVELS), len(self)), dtype=np.int64)
+        for rank in range(len(TAXONOMY_LEVELS)):
+            ids = {}
+            prefix_ids[rank] = np.fromiter((ids.setdefault(self.rank_prefix(lineage_id, rank), len(ids)) for lineage_id in range(len(self))),
+                                           dtype=np.int64, count=len(self))
+        return prefix_ids
+
+    def rank_prefix(self, lineage_id, rank):
+        """Lineage truncated after a rank (the whole lineage at the species rank, or past its last rank)."""
+        ranks = self.lineages[lineage_id].split(";")
+        if rank >= min(len(ranks), len(TAXONOMY_LEVELS)) - 1:
+            return self.lineages[lineage_id]
+        return ";".join(ranks[:rank + 1])
+
+    def rank_names(self, rank, lineage_ids=None):
+        """Distinct names of a rank (index in TAXONOMY_LEVELS), among all lineages or the given ones, in order of first appearance."""
+        name_ids = self.rank_array()[rank]
+        if lineage_ids is not None:
+            name_ids = name_ids[lineage_ids]
+        name_ids = np.unique(name_ids[name_ids != NO_RANK])
+        return [self.names[name_id] for name_id in name_ids]
+
+def distinct_per_group(group_ids, values, n_values):
+    """
+    Distinct (group, value) pairs of per-sequence arrays of group IDs and of integer values below n_values.
+
+    Returns:
+    tuple: (groups, values) arrays of the distinct pairs, sorted by group then value.
+    """
+    pairs = np.unique(group_ids.astype(np.int64) * n_values + values)
+    return pairs // n_values, pairs % n_values
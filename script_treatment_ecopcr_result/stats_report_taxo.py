@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 
+import os
 import argparse
 import re
 import sys
+import numpy as np
+from lineage_table import LineageTable, TAXONOMY_LEVELS, distinct_per_group
+from taxonomy_store import TaxonomyStore, split_taxonomy_info
 
 __author__ = 'Gabryelle Agoutin - INRAE'
 __copyright__ = 'Copyright (C) 2024 INRAE'
@@ -11,120 +15,141 @@ __version__ = '1.0'
 __email__ = 'gabryelle.agoutin@inrae.fr'
 __status__ = 'prod'
 
+# Number of dereplication groups whose taxonomy is looked up at once
+LOOKUP_BATCH_SIZE = 10000
 
 
-
-def filter_lines_by_keywords(cluster_file, include_keywords=None, exclude_keywords=None):
-    """Filter lines within clusters based on required and excluded keywords in taxonomy."""
-
-    # Compile regex patterns
+def read_cluster_file(cluster_file):
+    """Clusters of a cluster.txt file (Launch_swarm.py output): (cluster number, {seq_id: line}) in file order."""
     cluster_pattern = re.compile(r"Cluster (\d+):")
-
-    filtered_clusters = []
-    rejected_clusters = []
-    current_cluster_content = {}
-    current_cluster_taxonomies = set()
     current_cluster = None
-    cluster_lines = {}
-    all_taxonomies = set()
-
-    # Read and process the cluster file
+    current_cluster_content = {}
     with open(cluster_file, 'r') as f:
-        cluster_lines = f.readlines()
-
-        for line in cluster_lines:
+        for line in f:
             line = line.strip()
             cluster_match = cluster_pattern.match(line)
             if cluster_match:
                 if current_cluster is not None:
-                    # Filter lines within the cluster
-                    filtered_lines = {}
-                    for seq_id, content in current_cluster_content.items():
-                        # Extract taxonomy information
-                        parts = content.split("\t")
-                        if len(parts) == 3:
-                            taxonomy = parts[2]
-                            all_taxonomies.add(taxonomy)
-                            include_condition = not include_keywords or any(keyword in taxonomy for keyword in include_keywords)
-                            exclude_condition = not exclude_keywords or not any(keyword in taxonomy for keyword in exclude_keywords)
-                            if include_condition and exclude_condition:
-                                filtered_lines[seq_id] = content
-                    # Add the cluster if it has any valid lines
-                    if filtered_lines:
-                        filtered_clusters.append((current_cluster, filtered_lines))
-                    else:
-                        rejected_clusters.append((current_cluster, current_cluster_content))
-
-                # Reset for the new cluster
+                    yield current_cluster, current_cluster_content
                 current_cluster = cluster_match.group(1)
-                current_cluster_taxonomies = set()
                 current_cluster_content = {}
             else:
                 parts = line.split("\t")
                 if len(parts) == 3:
                     seq_id = parts[0].strip()
                     current_cluster_content[seq_id] = line
-
-        # Process the last cluster
-        if current_cluster is not None:
-            filtered_lines = {}
-            for seq_id, content in current_cluster_content.items():
-                parts = content.split("\t")
-                if len(parts) == 3:
-                    taxonomy = parts[2]
-                    include_condition = not include_keywords or any(keyword in taxonomy for keyword in include_keywords)
-                    exclude_condition = not exclude_keywords or not any(keyword in taxonomy for keyword in exclude_keywords)
-                    if include_condition and exclude_condition:
-                        filtered_lines[seq_id] = content
-            if filtered_lines:
-                filtered_clusters.append((current_cluster, filtered_lines))
-            else:
-                rejected_clusters.append((current_cluster, current_cluster_content))
-
+    if current_cluster is not None:
+        yield current_cluster, current_cluster_content
+
+def read_exact_sequence_clusters(derep_groups_file, taxonomy_store, batch_size=LOOKUP_BATCH_SIZE):
+    """
+    Clusters of identical amplicons, read from the dereplication groups (derep_groups.txt) instead of a Swarm
+    run: each line (centroid, then the other sequences with the same amplicon) is a cluster, numbered from 1 in
+    file order, with the lines of cluster.txt (seq_id, taxid, lineage). output_vsearch_cluster.txt can't be used
+    here, its lines merge the amplicons whose centroids come from the same assembly.
+
+    The file is streamed and the taxonomy of the sequence IDs is looked up in the indexed
+    name_seq_with_taxo.txt (see taxonomy_store.py) by batches of lines. IDs without taxonomy are left out,
+    as their "No info found" line of cluster.txt.
+    """
+    def batch_clusters(batch):
+        taxonomy_dict = taxonomy_store.lookup(seq_id for number, seq_ids in batch for seq_id in seq_ids)
+        for number, seq_ids in batch:
+            content = {}
+            for seq_id in seq_ids:
+                info = taxonomy_dict.get(seq_id)
+                if info is not None:
+                    taxid, tax = split_taxonomy_info(info)
+                    content[seq_id] = f"{seq_id}\t{taxid}\t{tax}"
+            yield str(number), content
+
+    batch = []
+    number = 0
+    with open(derep_groups_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            parts = line.split('\t')
+            number += 1
+            batch.append((number, [parts[0]] + (parts[1].split(',') if len(parts) > 1 and parts[1] else [])))
+            if len(batch) == batch_size:
+                yield from batch_clusters(batch)
+                batch = []
+    yield from batch_clusters(batch)
+
+def filter_clusters(clusters, include_keywords=None, exclude_keywords=None):
+    """Filter lines within clusters ((cluster number, {seq_id: line}) pairs) based on required and excluded keywords in taxonomy."""
+    filtered_clusters = []
+    rejected_clusters = []
+    all_taxonomies = set()
+    for cluster, content in clusters:
+        filtered_lines = {}
+        for seq_id, line in content.items():
+            # Extract taxonomy information
+            taxonomy = line.split("\t")[2]
+            all_taxonomies.add(taxonomy)
+            include_condition = not include_keywords or any(keyword in taxonomy for keyword in include_keywords)
+            exclude_condition = not exclude_keywords or not any(keyword in taxonomy for keyword in exclude_keywords)
+            if include_condition and exclude_condition:
+                filtered_lines[seq_id] = line
+        # Add the cluster if it has any valid lines
+        if filtered_lines:
+            filtered_clusters.append((cluster, filtered_lines))
+        else:
+            rejected_clusters.append((cluster, content))
     return filtered_clusters, rejected_clusters, all_taxonomies
 
-def calculate_statistics(filtered_clusters, output_stats_file, output_taxo_file, output_taxo_good_discriminated_file):
-    """Calculate and write statistics based on filtered clusters, and save unique taxonomies."""
+def filter_lines_by_keywords(cluster_file, include_keywords=None, exclude_keywords=None):
+    """Filter lines within clusters based on required and excluded keywords in taxonomy."""
+    return filter_clusters(read_cluster_file(cluster_file), include_keywords, exclude_keywords)
+
+def calculate_statistics(filtered_clusters, output_stats_file, output_taxo_file, output_taxo_good_discriminated_file,
+                         output_rank_stats_file=None):
+    """
+    Calculate and write statistics based on filtered clusters, and save unique taxonomies.
+
+    Each distinct taxonomy is interned once in a LineageTable, and the clusters are compared on the
+    lineage IDs of their sequences: a cluster is well discriminated when it has a single lineage ID.
+    With output_rank_stats_file, the same statistics are also computed at each rank (see calculate_rank_statistics).
+    """
+
+    lineage_table = LineageTable()
+    member_clusters = []
+    member_lineages = []
+    for cluster_index, (cluster, content) in enumerate(filtered_clusters):
+        for line in content.values():
+            parts = line.split("\t")
+            if len(parts) == 3:
+                member_clusters.append(cluster_index)
+                member_lineages.append(lineage_table.intern(parts[2]))
 
     total_clusters = len(filtered_clusters)
-    good_discrimination = 0
-    bad_discrimination = 0
-    bad_clusters = []
-    unique_taxonomies = set()
-    good_discriminated_taxonomies = set()
-    bad_discriminated_taxonomies = set()
-
-    # Dictionaries to track well and poorly discriminated clusters by taxonomy
+    # Distinct (cluster, lineage) pairs, sorted by cluster
+    cluster_ids, lineage_ids = distinct_per_group(np.array(member_clusters, dtype=np.int64),
+                                                  np.array(member_lineages, dtype=np.int64), max(len(lineage_table), 1))
+    good_clusters = np.bincount(cluster_ids, minlength=total_clusters) == 1
+    good_pairs = good_clusters[cluster_ids]
+
+    good_discrimination = int(good_clusters.sum())
+    bad_discrimination = total_clusters - good_discrimination
+    bad_clusters = [filtered_clusters[i] for i in np.flatnonzero(~good_clusters)]
+    good_lineages = np.unique(lineage_ids[good_pairs])
+    bad_lineages = np.unique(lineage_ids[~good_pairs])
+
+    unique_taxonomies = lineage_table.lineages
+    good_discriminated_taxonomies = [lineage_table.lineages[i] for i in good_lineages]
+
+    # Taxonomies that are both well and poorly discriminated, with their clusters
+    overlapping_lineages = np.intersect1d(good_lineages, bad_lineages)
+    overlapping_taxonomies = sorted(lineage_table.lineages[i] for i in overlapping_lineages)
     taxonomy_good_clusters = {}
     taxonomy_bad_clusters = {}
-
-    for cluster, content in filtered_clusters:
-        taxonomies = set()
-        for line in content.values():
-            parts = line.split("\t")
-            if len(parts) == 3:
-                taxonomy = parts[2]
-                taxonomies.add(taxonomy)
-                unique_taxonomies.add(taxonomy)
-
-        if len(taxonomies) == 1:
-            good_discrimination += 1
-            good_discriminated_taxonomies.update(taxonomies)
-            for taxonomy in taxonomies:
-                if taxonomy not in taxonomy_good_clusters:
-                    taxonomy_good_clusters[taxonomy] = []
-                taxonomy_good_clusters[taxonomy].append(cluster)
-        else:
-            bad_discrimination += 1
-            bad_clusters.append((cluster, content))
-            bad_discriminated_taxonomies.update(taxonomies)
-            for taxonomy in taxonomies:
-                if taxonomy not in taxonomy_bad_clusters:
-                    taxonomy_bad_clusters[taxonomy] = []
-                taxonomy_bad_clusters[taxonomy].append(cluster)
-
-    # Taxonomies that are both well and poorly discriminated
-    overlapping_taxonomies = good_discriminated_taxonomies & bad_discriminated_taxonomies
+    for lineage_id in overlapping_lineages:
+        taxonomy = lineage_table.lineages[lineage_id]
+        lineage_pairs = lineage_ids == lineage_id
+        taxonomy_good_clusters[taxonomy] = [filtered_clusters[i][0] for i in cluster_ids[lineage_pairs & good_pairs]]
+        taxonomy_bad_clusters[taxonomy] = [filtered_clusters[i][0] for i in cluster_ids[lineage_pairs & ~good_pairs]]
     num_overlapping_taxonomies = len(overlapping_taxonomies)
 
     percentage_good_discrimination = (good_discrimination / total_clusters * 100) if total_clusters > 0 else 0
@@ -177,6 +202,61 @@ def calculate_statistics(filtered_clusters, output_stats_file, output_taxo_file,
     print(f"Percentage of good discriminated taxonomies: {percentage_good_taxonomies:.2f}%")
     print(f"Number of taxonomies both good and bad discriminated: {num_overlapping_taxonomies}")
 
+    if output_rank_stats_file:
+        calculate_rank_statistics(lineage_table, np.array(member_clusters, dtype=np.int64), np.array(member_lineages, dtype=np.int64),
+                                  total_clusters, output_rank_stats_file, output_taxo_file, output_taxo_good_discriminated_file)
+
+def rank_file(output_file, rank):
+    """Per-rank output file: uniq_taxo.txt -> uniq_taxo_genus.txt"""
+    base, ext = os.path.splitext(output_file)
+    return f"{base}_{TAXONOMY_LEVELS[rank].lower()}{ext}"
+
+def calculate_rank_statistics(lineage_table, member_clusters, member_lineages, total_clusters, output_rank_stats_file,
+                              output_taxo_file, output_taxo_good_discriminated_file):
+    """
+    Discrimination at each of the 7 ranks, in one pass over the cluster members.
+
+    At a rank, the taxa are the lineages truncated after this rank (LineageTable.rank_prefix_ids), and a cluster
+    is well discriminated when its sequences have a single taxon: the number of distinct taxa of each cluster is
+    counted for all ranks from the same (cluster, lineage) pairs. At the species rank, the results are those of stats.txt.
+
+    Writes the rank x metric table to output_rank_stats_file, and the unique and well discriminated taxa of each
+    rank to per-rank uniq_taxo files (see rank_file).
+    """
+    # Each distinct (cluster, lineage) pair once: the ranks only need the lineage of the pairs
+    cluster_ids, lineage_ids = distinct_per_group(member_clusters, member_lineages, max(len(lineage_table), 1))
+    prefix_ids = lineage_table.rank_prefix_ids()
+    metrics = ["unique_taxa", "good_discriminated_taxa", "percentage_good_discriminated_taxa", "taxa_both_good_and_bad",
+               "clusters", "good_discriminated_clusters", "bad_discriminated_clusters", "percentage_good_discriminated_clusters"]
+
+    with open(output_rank_stats_file, 'w') as f:
+        f.write("rank\t" + "\t".join(metrics) + "\n")
+        for rank, level in enumerate(TAXONOMY_LEVELS):
+            taxa = prefix_ids[rank]
+            groups, taxon_ids = distinct_per_group(cluster_ids, taxa[lineage_ids], int(taxa.max(initial=0)) + 1)
+            good_clusters = np.bincount(groups, minlength=total_clusters) == 1
+            good_pairs = good_clusters[groups]
+            good_taxa = np.unique(taxon_ids[good_pairs])
+            bad_taxa = np.unique(taxon_ids[~good_pairs])
+            unique_taxa = np.unique(taxon_ids)
+            good_discrimination = int(good_clusters.sum())
+
+            # One lineage of each taxon gives its name
+            taxon_lineages = dict(zip(taxa[lineage_ids].tolist(), lineage_ids.tolist()))
+            with open(rank_file(output_taxo_file, rank), 'w') as out:
+                for taxon in sorted(lineage_table.rank_prefix(taxon_lineages[taxon], rank) for taxon in unique_taxa.tolist()):
+                    out.write(f"{taxon}\n")
+            with open(rank_file(output_taxo_good_discriminated_file, rank), 'w') as out:
+                for taxon in sorted(lineage_table.rank_prefix(taxon_lineages[taxon], rank) for taxon in good_taxa.tolist()):
+                    out.write(f"{taxon}\n")
+
+            percentage_good_taxa = (len(good_taxa) / len(unique_taxa) * 100) if len(unique_taxa) > 0 else 0
+            percentage_good_clusters = (good_discrimination / total_clusters * 100) if total_clusters > 0 else 0
+            values = [len(unique_taxa), len(good_taxa), f"{percentage_good_taxa:.2f}", len(np.intersect1d(good_taxa, bad_taxa)),
+                      total_clusters, good_discrimination, total_clusters - good_discrimination, f"{percentage_good_clusters:.2f}"]
+            f.write(level + "\t" + "\t".join(str(value) for value in values) + "\n")
+    print(f"Discrimination by rank written to {output_rank_stats_file}")
+
 def generate_html_output(txt_file, html_file):
     """Generate an HTML file from a text file with clickable taxid links."""
     with open(txt_file, 'r') as f, open(html_file, 'w') as out_file:
@@ -278,8 +358,11 @@ def generate_html_output_from_stats(stats_file, output_html_file):
 def main():
     # Argument parser
     parser = argparse.ArgumentParser(description="Filter lines within clusters based on taxonomy, generate corrected clusters and statistics.",
-       epilog="python stats_report.py -c cluster.txt -t all_modified.fna -o stats.txt -r cluster_corrected.txt -u uniq_taxo_good_discriminated.txt")
-    parser.add_argument("-c", "--cluster_file", type=str, required=True, help="Input file containing cluster information (e.g., cluster.txt).")
+       epilog="python stats_report.py -c cluster.txt -t all_modified.fna -o stats.txt -r cluster_corrected.txt -u uniq_taxo_good_discriminated.txt ; "
+              "exact-sequence mode: python stats_report_taxo.py -derep derep_groups.txt -taxo name_seq_with_taxo.txt -o stats.txt -r cluster_corrected.txt")
+    parser.add_argument("-c", "--cluster_file", type=str, help="Input file containing cluster information (e.g., cluster.txt).")
+    parser.add_argument("-derep", "--derep_groups_file", type=str, help="Exact-sequence mode, instead of -c: the dereplication groups (derep_groups.txt, one line per dereplicated amplicon, written by format_ecopcr_result.py) are the clusters, so no Swarm run is needed (100%% identity).")
+    parser.add_argument("-taxo", "--taxonomy_file", type=str, help="The taxonomy file (name_seq_with_taxo.txt), required with -derep.")
     parser.add_argument("-o", "--output_stats_file", type=str, required=True, help="Output file for the statistics report (e.g., stats.txt).")
     parser.add_argument("-r", "--output_corrected_file", type=str, required=True, help="Output file for the filtered clusters (e.g., cluster_corrected.txt).")
     parser.add_argument("-i", "--include_keywords", type=str, nargs='*', help="Keywords that must be present in taxonomy to keep a line (e.g., f__Lactobacillaceae).")
@@ -287,15 +370,27 @@ def main():
     parser.add_argument("-l", "--log_file", type=str, help="Output file to log rejected clusters (optional).")
     parser.add_argument("-u", "--unique_taxo_file", type=str, default="uniq_taxo.txt", help="Output file for unique taxonomies (default: uniq_taxo.txt).")
     parser.add_argument("-g", "--unique_taxo_good_discriminated_file", type=str, default="uniq_taxo_good_discriminated.txt", help="Output file for good discriminated taxonomies (default: uniq_taxo_good_discriminated.txt).")
+    parser.add_argument("-m", "--rank_stats_file", type=str, help="Output table of the discrimination at each rank (e.g., stats_by_rank.tsv), with per-rank uniq_taxo files (uniq_taxo_genus.txt, ...).")
     args = parser.parse_args()
+    if bool(args.cluster_file) == bool(args.derep_groups_file):
+        parser.error("one of -c (cluster.txt) or -derep (exact-sequence mode) is required")
+    if args.derep_groups_file and not args.taxonomy_file:
+        parser.error("-taxo is required with -derep")
 
     # Filter lines within clusters based on inclusion and exclusion keywords
     try:
-        filtered_clusters, rejected_clusters, all_taxonomies = filter_lines_by_keywords(
-            args.cluster_file,
+        if args.derep_groups_file:
+            taxonomy_store = TaxonomyStore(args.taxonomy_file)
+            clusters = read_exact_sequence_clusters(args.derep_groups_file, taxonomy_store)
+        else:
+            clusters = read_cluster_file(args.cluster_file)
+        filtered_clusters, rejected_clusters, all_taxonomies = filter_clusters(
+            clusters,
             include_keywords=args.include_keywords,
             exclude_keywords=args.exclude_keywords,
         )
+        if args.derep_groups_file:
+            taxonomy_store.close()
     # Check keywords in taxonomy
         if args.include_keywords:
             for keyword in args.include_keywords:
@@ -326,7 +421,8 @@ def main():
             filtered_clusters,
             args.output_stats_file,
             args.unique_taxo_file,
-            args.unique_taxo_good_discriminated_file
+            args.unique_taxo_good_discriminated_file,
+            args.rank_stats_file
         )
         # html
         output_html_stats_file = args.output_stats_file.replace('.txt', '.html')
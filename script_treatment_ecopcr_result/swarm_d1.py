@@ -0,0 +1,439 @@
+#!/usr/bin/env python
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+import re
+import logging
+from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+NUCLEOTIDES = [b'A', b'C', b'G', b'T']
+# Abundance annotation at the end of a label, as read by swarm without -z
+ABUNDANCE_PATTERN = re.compile(r'_([0-9]+)$')
+# Swarms lighter than this mass are grafted in fastidious mode (swarm -b)
+BOUNDARY = 3
+
+# Polynomial hashing (modulo 2^64) of the sequences and of their microvariants; other characters than A, C, G, T get code 5
+CODES = np.full(256, 5, dtype=np.uint64)
+for _code, _nucleotide in enumerate(NUCLEOTIDES, start=1):
+    CODES[ord(_nucleotide)] = _code
+NUCLEOTIDE_CODES = np.arange(1, len(NUCLEOTIDES) + 1, dtype=np.uint64)
+HASH_BASE = np.uint64(0x100000001B3)
+# Number of microvariant hashes computed at once
+BLOCK_SIZE = 1 << 22
+# Memory (bytes) of the microvariant index of the fastidious step, above which it is built in several passes
+INDEX_MEMORY = 256 * 1024 * 1024
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+def read_amplicons(fasta_file, append_abundance=None):
+    """
+    Read the amplicons of a dereplicated FASTA file as swarm does.
+
+    The label is the header up to the first space, its abundance the _<n> suffix of the label. When it has
+    none, append_abundance is used and added to the label ('<label>_<n>', as in swarm outputs).
+
+    Returns:
+    tuple: (list of labels, list of sequences (upper-case bytes), NumPy array of abundances)
+    """
+    labels = []
+    sequences = []
+    abundances = []
+    with open(fasta_file, 'rb') as f:
+        seq = []
+        for line in f:
+            if line.startswith(b'>'):
+                if labels:
+                    sequences.append(b''.join(seq).upper())
+                    seq = []
+                label = line[1:].split(None, 1)[0].decode() if line[1:].strip() else ''
+                match = ABUNDANCE_PATTERN.search(label)
+                if match:
+                    abundances.append(int(match.group(1)))
+                elif append_abundance is not None:
+                    abundances.append(append_abundance)
+                    label = f'{label}_{append_abundance}'
+                else:
+                    raise ValueError(f'Abundance annotation not found for sequence {label} (use -a to set a default abundance)')
+                labels.append(label)
+            else:
+                seq.append(line.strip())
+        if labels:
+            sequences.append(b''.join(seq).upper())
+    return labels, sequences, np.array(abundances, dtype=np.int64)
+
+def sort_amplicons(labels, sequences, abundances):
+    """Amplicons in swarm's order: decreasing abundance, then label. The rank in this order is the amplicon ID."""
+    order = sorted(range(len(labels)), key=lambda i: (-abundances[i], labels[i]))
+    return [labels[i] for i in order], [sequences[i] for i in order], abundances[order]
+
+def sequence_codes(sequences):
+    """Matrix (uint64) of the nucleotide codes of sequences of the same length, one row per sequence."""
+    return CODES[np.frombuffer(b''.join(sequences), dtype=np.uint8).reshape(len(sequences), -1)]
+
+def hash_powers(length):
+    """HASH_BASE ** k modulo 2^64 for k in 0..length."""
+    return np.concatenate([np.ones(1, dtype=np.uint64), np.cumprod(np.full(length, HASH_BASE, dtype=np.uint64))])
+
+def prefix_hashes(codes):
+    """Hashes of the prefixes of each sequence: column i is the hash of the first i nucleotides."""
+    prefix = np.zeros((codes.shape[0], codes.shape[1] + 1), dtype=np.uint64)
+    for i in range(codes.shape[1]):
+        prefix[:, i + 1] = prefix[:, i] * HASH_BASE + codes[:, i]
+    return prefix
+
+def sequence_hashes(sequences):
+    """Hash of each sequence of a list of sequences of the same length."""
+    return prefix_hashes(sequence_codes(sequences))[:, -1]
+
+def variant_hashes(codes, length):
+    """
+    Hashes of the variants of the given length of sequences of the same length (codes: see sequence_codes):
+    deletions (length - 1), substitutions (same length, the sequence itself included) or insertions (length + 1).
+
+    Returns:
+    NumPy array: one row per sequence, column k being the hash of variant_sequence(sequence, length, k).
+    """
+    n_sequences, seq_length = codes.shape
+    powers = hash_powers(seq_length + 1)
+    prefix = prefix_hashes(codes)
+    full = prefix[:, -1:]
+    if length == seq_length:
+        weights = powers[seq_length - 1 - np.arange(seq_length)]
+        hashes = full[:, :, None] + (NUCLEOTIDE_CODES[None, None, :] - codes[:, :, None]) * weights[None, :, None]
+        return hashes.reshape(n_sequences, -1)
+    positions = np.arange(seq_length + 1)
+    suffix = full - prefix * powers[seq_length - positions]
+    if length == seq_length - 1:
+        return prefix[:, :-1] * powers[seq_length - 1 - positions[:-1]] + suffix[:, 1:]
+    if length == seq_length + 1:
+        hashes = (prefix * powers[seq_length + 1 - positions])[:, :, None] + \
+                 NUCLEOTIDE_CODES[None, None, :] * powers[seq_length - positions][None, :, None] + suffix[:, :, None]
+        return hashes.reshape(n_sequences, -1)
+    raise ValueError(f'No variant of length {length} for sequences of length {seq_length}')
+
+def variant_sequence(seq, length, k):
+    """Variant k of the given length of a sequence (see variant_hashes)."""
+    if len(seq) == length + 1:
+        return seq[:k] + seq[k + 1:]
+    pos, nucleotide = divmod(k, len(NUCLEOTIDES))
+    if len(seq) == length:
+        return seq[:pos] + NUCLEOTIDES[nucleotide] + seq[pos + 1:]
+    return seq[:pos] + NUCLEOTIDES[nucleotide] + seq[pos:]
+
+def hash_matches(sorted_hashes, hashes):
+    """Pairs of positions (in hashes, in sorted_hashes) of equal hashes."""
+    left = np.searchsorted(sorted_hashes, hashes, 'left')
+    counts = np.searchsorted(sorted_hashes, hashes, 'right') - left
+    positions = np.repeat(np.arange(len(hashes)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return positions, np.repeat(left, counts) + offsets
+
+def length_edges(task):
+    """
+    Pairs of amplicons one difference apart, found from the amplicons of one length: substitutions
+    between them, and insertions leading to amplicons one nucleotide longer (deletions are the same pairs
+    seen from the longer amplicon).
+
+    The hashes of the microvariants of the amplicons are searched among the hashes of the amplicons,
+    and each match is checked on the sequences.
+
+    Returns:
+    tuple: (sources, targets) NumPy arrays of amplicon IDs.
+    """
+    ids, sequences, longer_ids, longer_sequences = task
+    targets_by_length = []
+    for target_ids, target_sequences in ((ids, sequences), (longer_ids, longer_sequences)):
+        if target_ids:
+            hashes = sequence_hashes(target_sequences)
+            order = np.argsort(hashes)
+            targets_by_length.append((len(target_sequences[0]), hashes[order], np.array(target_ids, dtype=np.int64)[order]))
+    sequence_of = dict(zip(ids, sequences))
+    sequence_of.update(zip(longer_ids, longer_sequences))
+
+    edges = set()
+    codes = sequence_codes(sequences)
+    ids = np.array(ids, dtype=np.int64)
+    for length, target_hashes, target_ids in targets_by_length:
+        n_variants = len(NUCLEOTIDES) * (codes.shape[1] + (length - codes.shape[1]))
+        rows = max(1, BLOCK_SIZE // n_variants)
+        for start in range(0, len(ids), rows):
+            hashes = variant_hashes(codes[start:start + rows], length)
+            positions, matches = hash_matches(target_hashes, hashes.ravel())
+            sources = ids[start + positions // hashes.shape[1]]
+            targets = target_ids[matches]
+            keep = sources < targets if length == codes.shape[1] else np.ones(len(sources), dtype=bool)
+            for source, target, k in zip(sources[keep].tolist(), targets[keep].tolist(), (positions[keep] % hashes.shape[1]).tolist()):
+                if (source, target) not in edges and variant_sequence(sequence_of[source], length, k) == sequence_of[target]:
+                    edges.add((source, target))
+    edges = sorted(edges)
+    return np.array([edge[0] for edge in edges], dtype=np.int64), np.array([edge[1] for edge in edges], dtype=np.int64)
+
+def band_edges(tasks):
+    """Pairs of amplicons one difference apart found from the amplicons of a band of consecutive lengths (see length_edges)."""
+    edges = [length_edges(task) for task in tasks]
+    return (np.concatenate([edge[0] for edge in edges] + [np.zeros(0, dtype=np.int64)]),
+            np.concatenate([edge[1] for edge in edges] + [np.zeros(0, dtype=np.int64)]))
+
+def split_bands(costs, n_bands):
+    """Split consecutive items into at most n_bands bands of about the same total cost, as lists of indexes."""
+    total = sum(costs)
+    bands = [[]]
+    band_cost = 0
+    for i, cost in enumerate(costs):
+        if bands[-1] and band_cost + cost / 2 > total * len(bands) / n_bands and len(bands) < n_bands:
+            bands.append([])
+        bands[-1].append(i)
+        band_cost += cost
+    return bands
+
+def build_graph(sequences, processes=1, bands=None):
+    """
+    Graph of the amplicons one difference apart, as a CSR adjacency (indptr, neighbours sorted by ID).
+
+    Two amplicons one difference apart differ in length by at most one, so the pairs are searched
+    length by length by a pool of processes, each one only indexing the amplicons of two lengths.
+    With bands, the lengths are grouped into this number of bands of consecutive lengths of similar
+    cost, one task each: a band also reads the amplicons of the length after its last one, so the pairs
+    crossing its upper border are found in it, and the edges of all bands make the same graph.
+    """
+    if len(set(sequences)) != len(sequences):
+        raise ValueError('Some sequences are duplicated, the input must be dereplicated')
+    by_length = defaultdict(list)
+    for amplicon, seq in enumerate(sequences):
+        by_length[len(seq)].append(amplicon)
+    tasks = []
+    for length, ids in sorted(by_length.items()):
+        longer_ids = by_length.get(length + 1, [])
+        tasks.append((ids, [sequences[i] for i in ids], longer_ids, [sequences[i] for i in longer_ids]))
+    costs = [(len(task[0]) + len(task[2])) * len(task[1][0]) for task in tasks]
+    if bands is not None:
+        length_bands = split_bands(costs, bands)
+        tasks = [[tasks[i] for i in band] for band in length_bands]
+        costs = [sum(costs[i] for i in band) for band in length_bands]
+        logging.info(f'{len(tasks)} length bands')
+    # the largest tasks first, so that they do not end last
+    tasks = [task for cost, task in sorted(zip(costs, tasks), key=lambda item: item[0], reverse=True)]
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        edges = list(executor.map(band_edges if bands is not None else length_edges, tasks))
+    sources = np.concatenate([edge[0] for edge in edges] + [np.zeros(0, dtype=np.int64)])
+    targets = np.concatenate([edge[1] for edge in edges] + [np.zeros(0, dtype=np.int64)])
+    sources, targets = np.concatenate([sources, targets]), np.concatenate([targets, sources])
+    order = np.lexsort((targets, sources))
+    indptr = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(sources, minlength=len(sequences)), out=indptr[1:])
+    return indptr, targets[order]
+
+def grow_swarms(indptr, neighbours, abundances):
+    """
+    Swarm clustering with d = 1: amplicons are taken as seeds in ID order (decreasing abundance) and each
+    swarm grows, generation by generation, with the amplicons one difference away not yet in a swarm and
+    not more abundant than the amplicon they connect to.
+
+    Returns:
+    list of list: the amplicon IDs of each swarm, seed first, in the order of the seeds.
+    """
+    indptr = indptr.tolist()
+    neighbours = neighbours.tolist()
+    abundances = abundances.tolist()
+    swarmed = [False] * len(abundances)
+    swarms = []
+    for seed in range(len(abundances)):
+        if swarmed[seed]:
+            continue
+        swarmed[seed] = True
+        swarm = [seed]
+        generation = [seed]
+        while generation:
+            next_generation = []
+            for amplicon in generation:
+                for neighbour in neighbours[indptr[amplicon]:indptr[amplicon + 1]]:
+                    if not swarmed[neighbour] and abundances[neighbour] <= abundances[amplicon]:
+                        swarmed[neighbour] = True
+                        next_generation.append(neighbour)
+            next_generation.sort()
+            swarm.extend(next_generation)
+            generation = next_generation
+        swarms.append(swarm)
+    return swarms
+
+def length_groups(ids, sequences):
+    """(IDs array, codes matrix) of the amplicons of each length."""
+    by_length = defaultdict(list)
+    for amplicon, seq in zip(ids, sequences):
+        by_length[len(seq)].append((amplicon, seq))
+    return [(np.array([amplicon for amplicon, seq in group], dtype=np.int64), sequence_codes([seq for amplicon, seq in group]))
+            for group in by_length.values()]
+
+def group_variant_hashes(groups, length, n_passes=1, current_pass=0):
+    """Hashes of the variants of the given length of groups of amplicons (see length_groups), by blocks: (hashes, amplicon IDs, variant numbers)."""
+    for ids, codes in groups:
+        n_variants = codes.shape[1] * len(NUCLEOTIDES) + len(NUCLEOTIDES)
+        rows = max(1, BLOCK_SIZE // n_variants)
+        for start in range(0, len(ids), rows):
+            hashes = variant_hashes(codes[start:start + rows], length)
+            variant_numbers = np.tile(np.arange(hashes.shape[1]), hashes.shape[0])
+            amplicons = np.repeat(ids[start:start + rows], hashes.shape[1])
+            hashes = hashes.ravel()
+            if n_passes > 1:
+                selected = hashes % np.uint64(n_passes) == np.uint64(current_pass)
+                hashes, amplicons, variant_numbers = hashes[selected], amplicons[selected], variant_numbers[selected]
+            yield hashes, amplicons, variant_numbers
+
+def length_grafts(task):
+    """
+    Most abundant heavy amplicon (lowest ID) at most two differences away from each light amplicon, among the
+    pairs whose intermediate sequence (one difference from both) has the given length.
+
+    The hashes of the variants of this length of the smaller side are sorted in a NumPy array (in several
+    passes on parts of the hash values when it would use more than INDEX_MEMORY), and those of the other
+    side are searched in it. Each match is checked on the sequences of the two variants.
+
+    Returns:
+    dict: light amplicon ID -> heavy amplicon ID
+    """
+    length, light_ids, light_sequences, heavy_ids, heavy_sequences = task
+    index_light = len(light_ids) <= len(heavy_ids)
+    light_groups = length_groups(light_ids, light_sequences)
+    heavy_groups = length_groups(heavy_ids, heavy_sequences)
+    index_groups, search_groups = (light_groups, heavy_groups) if index_light else (heavy_groups, light_groups)
+    sequence_of = dict(zip(light_ids, light_sequences))
+    sequence_of.update(zip(heavy_ids, heavy_sequences))
+
+    n_index_variants = sum(codes.shape[0] * (codes.shape[1] + 1) * len(NUCLEOTIDES) for ids, codes in index_groups)
+    n_passes = max(1, -(-n_index_variants * 24 // INDEX_MEMORY))
+    no_parent = max(max(light_ids), max(heavy_ids)) + 1
+    best_parent = np.full(no_parent, no_parent, dtype=np.int64)
+    for current_pass in range(n_passes):
+        index = [np.concatenate(values) for values in zip(*group_variant_hashes(index_groups, length, n_passes, current_pass))]
+        if not index or len(index[0]) == 0:
+            continue
+        order = np.argsort(index[0])
+        index_hashes, index_amplicons, index_variants = index[0][order], index[1][order], index[2][order]
+        for hashes, amplicons, variant_numbers in group_variant_hashes(search_groups, length, n_passes, current_pass):
+            positions, matches = hash_matches(index_hashes, hashes)
+            if index_light:
+                lights, light_variants = index_amplicons[matches], index_variants[matches]
+                heavies, heavy_variants = amplicons[positions], variant_numbers[positions]
+            else:
+                lights, light_variants = amplicons[positions], variant_numbers[positions]
+                heavies, heavy_variants = index_amplicons[matches], index_variants[matches]
+            improving = heavies < best_parent[lights]
+            lights, heavies = lights[improving], heavies[improving]
+            light_variants, heavy_variants = light_variants[improving], heavy_variants[improving]
+            # candidates of each light amplicon by increasing heavy amplicon ID: the first one confirmed is kept
+            order = np.lexsort((heavies, lights))
+            for light, heavy, light_variant, heavy_variant in zip(lights[order].tolist(), heavies[order].tolist(),
+                                                                  light_variants[order].tolist(), heavy_variants[order].tolist()):
+                if heavy < best_parent[light] and \
+                   variant_sequence(sequence_of[light], length, light_variant) == variant_sequence(sequence_of[heavy], length, heavy_variant):
+                    best_parent[light] = heavy
+    return {light: int(best_parent[light]) for light in light_ids if best_parent[light] < no_parent}
+
+def graft_light_swarms(swarms, sequences, abundances, boundary=BOUNDARY, processes=1):
+    """
+    Fastidious step of swarm: each light swarm (mass below boundary) that has an amplicon at most two differences
+    away from an amplicon of a heavy swarm is grafted onto the heavy swarm of the most abundant such amplicon.
+
+    Two amplicons are at most two differences apart when they have a common sequence at most one difference
+    away from both, whose length is within one of theirs. The pairs are therefore searched by length of this
+    intermediate sequence, by a pool of processes, each one only using the amplicons of three lengths.
+
+    Returns:
+    list of list: the swarms, grafted light swarms appended to their heavy swarm (in graft order) and removed.
+    """
+    swarm_of = np.empty(len(abundances), dtype=np.int64)
+    for swarm_id, swarm in enumerate(swarms):
+        swarm_of[swarm] = swarm_id
+    heavy_swarms = np.array([abundances[swarm].sum() >= boundary for swarm in swarms], dtype=bool)
+    is_heavy = heavy_swarms[swarm_of]
+    if is_heavy.all() or not is_heavy.any():
+        return swarms
+
+    light_by_length = defaultdict(list)
+    heavy_by_length = defaultdict(list)
+    for amplicon, seq in enumerate(sequences):
+        (heavy_by_length if is_heavy[amplicon] else light_by_length)[len(seq)].append(amplicon)
+    tasks = []
+    for length in range(max(1, min(map(len, sequences)) - 1), max(map(len, sequences)) + 2):
+        light_ids = light_by_length.get(length - 1, []) + light_by_length.get(length, []) + light_by_length.get(length + 1, [])
+        heavy_ids = heavy_by_length.get(length - 1, []) + heavy_by_length.get(length, []) + heavy_by_length.get(length + 1, [])
+        if light_ids and heavy_ids:
+            tasks.append((length, light_ids, [sequences[i] for i in light_ids], heavy_ids, [sequences[i] for i in heavy_ids]))
+    tasks.sort(key=lambda task: (len(task[1]) + len(task[3])) * task[0], reverse=True)
+
+    parents = {}
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for length_parents in executor.map(length_grafts, tasks):
+            for light_amplicon, heavy_amplicon in length_parents.items():
+                if heavy_amplicon < parents.get(light_amplicon, len(sequences)):
+                    parents[light_amplicon] = heavy_amplicon
+
+    # Grafts sorted by parent then child: each light swarm goes to the first parent of its amplicons
+    grafted = {}
+    for child, parent in sorted(parents.items(), key=lambda graft: (graft[1], graft[0])):
+        light_swarm = swarm_of[child]
+        if light_swarm not in grafted:
+            grafted[light_swarm] = swarm_of[parent]
+    for light_swarm, heavy_swarm in grafted.items():
+        swarms[heavy_swarm] = swarms[heavy_swarm] + swarms[light_swarm]
+    logging.info(f'{len(grafted)} light swarms grafted')
+    return [swarm for swarm_id, swarm in enumerate(swarms) if swarm_id not in grafted]
+
+def cluster_fasta(fasta_file, output_file, processes=1, append_abundance=None, fastidious=False, boundary=BOUNDARY, bands=None):
+    """
+    Cluster a dereplicated FASTA file with d = 1 and write the swarms as swarm -o does: one line per swarm, labels separated by spaces.
+    bands: number of length bands whose edges are searched concurrently (see build_graph); the swarms are then grown once on the whole graph.
+    """
+    labels, sequences, abundances = read_amplicons(fasta_file, append_abundance)
+    labels, sequences, abundances = sort_amplicons(labels, sequences, abundances)
+    logging.info(f'{len(labels)} amplicons read from {fasta_file}')
+    indptr, neighbours = build_graph(sequences, processes, bands)
+    swarms = grow_swarms(indptr, neighbours, abundances)
+    logging.info(f'{len(swarms)} swarms')
+    if fastidious:
+        swarms = graft_light_swarms(swarms, sequences, abundances, boundary, processes)
+    with open(output_file, 'w') as f:
+        for swarm in swarms:
+            f.write(' '.join(labels[amplicon] for amplicon in swarm) + '\n')
+    return len(swarms)
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = ArgumentParser(description="Swarm clustering with d = 1 (and its fastidious option) without the swarm binary. "
+                                        "The output is written as with swarm -o.",
+                            formatter_class=ArgumentDefaultsHelpFormatter,
+                            epilog="Exemple: python swarm_d1.py -t 4 -a 1 -f all_modified.fna -o fichier_swarm.txt")
+    parser.add_argument("fasta_file", type=str, help="Dereplicated FASTA file")
+    parser.add_argument("-o", "--output_file", type=str, required=True, help="Output file, one swarm per line")
+    parser.add_argument("-t", "--threads", type=int, default=1, help="Number of processes searching the amplicons one difference apart")
+    parser.add_argument("-a", "--append_abundance", type=int, help="Abundance of the amplicons without abundance annotation")
+    parser.add_argument("-f", "--fastidious", action="store_true", help="Graft light swarms onto heavy swarms at most two differences away")
+    parser.add_argument("-b", "--boundary", type=int, default=BOUNDARY, help="Minimum mass of a heavy swarm in fastidious mode")
+    parser.add_argument("--bands", type=int, default=None, help="Search the edges by this number of bands of consecutive lengths instead of length by length")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    n_swarms = cluster_fasta(args.fasta_file, args.output_file, args.threads, args.append_abundance, args.fastidious, args.boundary, args.bands)
+    logging.info(f'{n_swarms} swarms written to {args.output_file}')
+
+if __name__ == '__main__':
+    main()
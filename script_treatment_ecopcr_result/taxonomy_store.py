@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+__author__ = 'Gabryelle Agoutin - INRAE'
+__copyright__ = 'Copyright (C) 2024 INRAE'
+__license__ = 'GNU General Public License'
+__version__ = '1.0'
+__email__ = 'gabryelle.agoutin@inrae.fr'
+__status__ = 'prod'
+
+import os
+import sqlite3
+import hashlib
+import logging
+import tempfile
+from argparse import ArgumentParser
+
+# Number of rows inserted at once while building the store, and of IDs per lookup query
+BATCH_SIZE = 100000
+QUERY_SIZE = 500
+
+
+##################################################################################################################################################
+#
+# FUNCTIONS
+#
+##################################################################################################################################################
+
+
+def get_store_path(taxonomy_file):
+    """name_seq_with_taxo.txt is indexed in name_seq_with_taxo.txt.sqlite"""
+    return taxonomy_file + '.sqlite'
+
+def get_cache_store_path(taxonomy_file):
+    """Index of a taxonomy file in a directory that is not writable: in the user's cache directory, named after its path."""
+    cache_dir = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'TaxonMarker')
+    file_hash = hashlib.sha1(os.path.abspath(taxonomy_file).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, f'{os.path.basename(taxonomy_file)}.{file_hash}.sqlite')
+
+def is_writable_dir(directory):
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return False
+    return os.access(directory, os.W_OK)
+
+def split_taxonomy_info(info):
+    """Taxid and lineage of a taxonomy information 'taxid=<taxid>; <lineage>' ("Unknown" when missing)."""
+    parts = info.split(' ', 1)
+    taxid_part = parts[0] if parts else ""
+    tax_part = parts[1] if len(parts) > 1 else ""
+    taxid = taxid_part.split('=')[1].split(';')[0] if 'taxid=' in taxid_part else "Unknown"
+    tax = tax_part.strip() if tax_part else "Unknown"
+    return taxid, tax
+
+def parse_header(line):
+    """(sequence ID, taxonomy information) of a name_seq_with_taxo.txt header: >ID|contig taxid=<taxid>; <taxonomy>"""
+    parts = line.strip()[1:].split(" ", 1)
+    return parts[0].split("|")[0], parts[1].strip() if len(parts) > 1 else ""
+
+def read_headers(taxonomy_file):
+    """(sequence ID, taxonomy information) of each header of a taxonomy file."""
+    with open(taxonomy_file, 'r') as f:
+        for line in f:
+            if line.startswith(">"):
+                yield parse_header(line)
+
+def is_up_to_date(store_path, taxonomy_file):
+    """Whether an index was built from the current version (size and modification time) of the taxonomy file."""
+    if not os.path.exists(store_path):
+        return False
+    stat = os.stat(taxonomy_file)
+    try:
+        connection = sqlite3.connect(f'file:{store_path}?mode=ro', uri=True)
+    except sqlite3.Error:
+        return False
+    try:
+        source = connection.execute('SELECT size, mtime FROM source').fetchone()
+    except sqlite3.DatabaseError:
+        source = None
+    finally:
+        connection.close()
+    return source == (stat.st_size, stat.st_mtime)
+
+def build_store(taxonomy_file, store_path=None, force=False):
+    """
+    Index the headers of a taxonomy file by sequence ID in an SQLite file (next to it by default).
+
+    As with a dictionary filled in file order, the last header of an ID gives its taxonomy.
+    The store is written to a temporary file of its own and renamed at the end, unless another run
+    has installed an up-to-date store in the meantime (force: replace it anyway), so that concurrent
+    runs never replace a store by an incomplete one.
+    """
+    store_path = store_path or get_store_path(taxonomy_file)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(store_path) + '.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(store_path)))
+    os.close(fd)
+    logging.info(f'Indexing {taxonomy_file} in {store_path}')
+    try:
+        connection = sqlite3.connect(tmp_path)
+        connection.execute('PRAGMA journal_mode = OFF')
+        connection.execute('PRAGMA synchronous = OFF')
+        connection.execute('CREATE TABLE taxonomy (seq_id TEXT PRIMARY KEY, taxonomy_info TEXT) WITHOUT ROWID')
+        connection.execute('CREATE TABLE source (size INTEGER, mtime REAL)')
+        stat = os.stat(taxonomy_file)
+        n_headers = 0
+        batch = []
+        for header in read_headers(taxonomy_file):
+            batch.append(header)
+            if len(batch) == BATCH_SIZE:
+                connection.executemany('INSERT OR REPLACE INTO taxonomy VALUES (?, ?)', batch)
+                n_headers += len(batch)
+                batch = []
+        connection.executemany('INSERT OR REPLACE INTO taxonomy VALUES (?, ?)', batch)
+        n_headers += len(batch)
+        connection.execute('INSERT INTO source VALUES (?, ?)', (stat.st_size, stat.st_mtime))
+        connection.commit()
+        connection.close()
+        if not force and is_up_to_date(store_path, taxonomy_file):
+            logging.info(f'{store_path} was built by another run')
+        else:
+            os.replace(tmp_path, store_path)
+            logging.info(f'{n_headers} headers indexed')
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return store_path
+
+class TaxonomyStore:
+    """
+    Read-only access to the taxonomy of sequence IDs of name_seq_with_taxo.txt.
+
+    The file is indexed once (see build_store); the index is rebuilt when the file changes. It is kept next
+    to the file, or in the user's cache directory when the file's directory is not writable; when neither can
+    be written, the headers are read in a dictionary as before the index.
+    Lookups only read the pages of the requested IDs, so the whole file is never loaded in memory.
+    """
+
+    def __init__(self, taxonomy_file):
+        self.taxonomy_file = taxonomy_file
+        self.connection = None
+        self.taxonomy_dict = None
+        store_path = self.find_store_path()
+        if store_path is None:
+            logging.info(f'No writable directory to index {taxonomy_file}, reading it in memory')
+            self.taxonomy_dict = dict(read_headers(taxonomy_file))
+            return
+        if not is_up_to_date(store_path, taxonomy_file):
+            build_store(taxonomy_file, store_path)
+        self.connection = sqlite3.connect(f'file:{store_path}?mode=ro', uri=True)
+
+    def find_store_path(self):
+        """Up-to-date store next to the file or in the cache, else the first of these places that is writable (None if none is)."""
+        store_paths = [get_store_path(self.taxonomy_file), get_cache_store_path(self.taxonomy_file)]
+        for store_path in store_paths:
+            if is_up_to_date(store_path, self.taxonomy_file):
+                return store_path
+        for store_path in store_paths:
+            if is_writable_dir(os.path.dirname(os.path.abspath(store_path))):
+                return store_path
+        return None
+
+    def get(self, seq_id, default=None):
+        if self.taxonomy_dict is not None:
+            return self.taxonomy_dict.get(seq_id, default)
+        row = self.connection.execute('SELECT taxonomy_info FROM taxonomy WHERE seq_id = ?', (seq_id,)).fetchone()
+        return row[0] if row else default
+
+    def lookup(self, seq_ids):
+        """Dictionary of the taxonomy information of the given IDs found in the store."""
+        seq_ids = list(set(seq_ids))
+        if self.taxonomy_dict is not None:
+            return {seq_id: self.taxonomy_dict[seq_id] for seq_id in seq_ids if seq_id in self.taxonomy_dict}
+        taxonomy_dict = {}
+        for i in range(0, len(seq_ids), QUERY_SIZE):
+            batch = seq_ids[i:i + QUERY_SIZE]
+            query = f'SELECT seq_id, taxonomy_info FROM taxonomy WHERE seq_id IN ({",".join("?" * len(batch))})'
+            taxonomy_dict.update(self.connection.execute(query, batch))
+        return taxonomy_dict
+
+    def distinct_taxonomies(self):
+        """Each distinct taxonomy information of the store, once."""
+        if self.taxonomy_dict is not None:
+            yield from set(self.taxonomy_dict.values())
+            return
+        for row in self.connection.execute('SELECT DISTINCT taxonomy_info FROM taxonomy'):
+            yield row[0]
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+##################################################################################################################################################
+#
+# MAIN
+#
+##################################################################################################################################################
+
+def main():
+    parser = ArgumentParser(description="Index name_seq_with_taxo.txt (<file>.sqlite next to it) for fast lookups of the taxonomy of sequence IDs. "
+                                        "The index is also built automatically by the scripts that read the file.",
+                            epilog="Exemple: python taxonomy_store.py /PATH/BD_TaxonMarker/BD_ecoPCR/name_seq_with_taxo.txt -q GCA_018630415.1")
+    parser.add_argument("taxonomy_file", type=str, help="Taxonomy file (name_seq_with_taxo.txt)")
+    parser.add_argument("-q", "--query", type=str, nargs='*', help="Sequence IDs to look up")
+    parser.add_argument("-f", "--force", help="Rebuild the index even if it is up to date", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if args.force:
+        build_store(args.taxonomy_file, force=True)
+    store = TaxonomyStore(args.taxonomy_file)
+    for seq_id in args.query or []:
+        print(f"{seq_id}\t{store.get(seq_id, 'Not found')}")
+    store.close()
+
+if __name__ == '__main__':
+    main()